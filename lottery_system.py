@@ -5,22 +5,3331 @@
 支援隨機抽取、避免重複、歷史記錄和郵件通知功能
 """
 
+import time
+
+# 模組開始載入的時間 (--profile-startup 以此計算匯入耗時)
+_MODULE_START = time.perf_counter()
+
 import tkinter as tk
-from tkinter import ttk, messagebox, scrolledtext, font
+from tkinter import ttk, messagebox, scrolledtext, font, filedialog
 import json
 import random
+import secrets
+import argparse
+import csv
+import sys
 import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+from email import message_from_bytes
+from email.header import Header
+from email.utils import formataddr, formatdate, make_msgid, parseaddr
+import base64
+import html
+import string
+import socketserver
+import subprocess
+import tempfile
+import uuid
 from datetime import datetime
 import os
 import math
+import mmap
+import struct
+import hashlib
+import threading
+import multiprocessing
+import atexit
+import bisect
+import contextlib
+import functools
+import heapq
+import itertools
+import gzip
+import lzma
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+from array import array
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+
+_IMPORTS_DONE = time.perf_counter()
+
+# 關鍵字抽籤時的拒絕取樣次數上限, 超過後改為完整掃描可用關鍵字
+_KEYWORD_REJECTION_TRIES = 32
+
+
+def _synchronized(lock_name):
+    """方法裝飾器: 呼叫期間持有 self.<lock_name> (可重入鎖)"""
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with getattr(self, lock_name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class _KeywordListView:
+    """緊湊名冊中單一參與者關鍵字清單的檢視 (行為類似 list)"""
+
+    __slots__ = ('_roster', '_row')
+
+    def __init__(self, roster, row):
+        self._roster = roster
+        self._row = row
+
+    def _strings(self):
+        strings = self._roster.keyword_strings
+        return [strings[k] for k in self._roster.keywords_of(self._row)]
+
+    def __len__(self):
+        return len(self._roster.keywords_of(self._row))
+
+    def __iter__(self):
+        return iter(self._strings())
+
+    def __getitem__(self, index):
+        return self._strings()[index]
+
+    def __contains__(self, keyword):
+        kid = self._roster.keyword_ids.get(keyword)
+        return kid is not None and kid in self._roster.keywords_of(self._row)
+
+    def __eq__(self, other):
+        return self._strings() == list(other)
+
+    def __repr__(self):
+        return repr(self._strings())
+
+    def append(self, keyword):
+        self._roster.add_keyword(self._row, keyword)
+
+    def remove(self, keyword):
+        self._roster.remove_keyword(self._row, keyword)
+
+
+class _ParticipantView(Mapping):
+    """緊湊名冊中單一參與者的唯讀 dict 形狀檢視
+
+    注意: 列號在刪除參與者後會位移, 檢視物件僅適合短暫使用
+    """
+
+    __slots__ = ('_roster', '_row')
+    _KEYS = ('name', 'email', 'keywords')
+
+    def __init__(self, roster, row):
+        self._roster = roster
+        self._row = row
+
+    def __getitem__(self, key):
+        if key == 'name':
+            return self._roster.names[self._row]
+        if key == 'email':
+            return self._roster.emails[self._row]
+        if key == 'keywords':
+            return _KeywordListView(self._roster, self._row)
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._KEYS)
+
+    def __len__(self):
+        return len(self._KEYS)
+
+
+class CompactRoster:
+    """緊湊參與者名冊 - 大量參與者時使用的記憶體精簡模型
+
+    - 關鍵字字串只保存一份, 以整數 ID 表示 (interning)
+    - 姓名、郵箱以平行清單保存, 不再為每人建立 dict
+    - 關鍵字擁有關係以 CSR 陣列保存: 第 i 人的關鍵字為
+      kw_ids[kw_offsets[i]:kw_offsets[i + 1]]
+
+    迭代與索引回傳 dict 形狀的檢視; 需要真正的 dict 時使用 get() / to_list()
+    """
+
+    def __init__(self):
+        self.names = []              # 姓名 (依列號)
+        self.emails = []             # 郵箱 (依列號)
+        self.email_index = {}        # email -> 列號
+        self.keyword_strings = []    # 關鍵字 ID -> 字串
+        self.keyword_ids = {}        # 字串 -> 關鍵字 ID
+        self.kw_offsets = array('I', [0])
+        self.kw_ids = array('I')
+        # 已修改但尚未合併回 CSR 的列: 列號 -> 關鍵字 ID 清單
+        self._pending = {}
+
+    @classmethod
+    def from_participants(cls, participants):
+        """由 dict 形狀的參與者清單建立緊湊名冊"""
+        roster = cls()
+        for p in participants:
+            roster.append(p)
+        return roster
+
+    # ========== 基本存取 ==========
+
+    def __len__(self):
+        return len(self.emails)
+
+    def __iter__(self):
+        for row in range(len(self.emails)):
+            yield _ParticipantView(self, row)
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self.emails)
+        if not 0 <= row < len(self.emails):
+            raise IndexError('roster index out of range')
+        return _ParticipantView(self, row)
+
+    def __bool__(self):
+        return bool(self.emails)
+
+    def intern(self, keyword):
+        """取得關鍵字的整數 ID, 不存在時新增"""
+        kid = self.keyword_ids.get(keyword)
+        if kid is None:
+            kid = len(self.keyword_strings)
+            self.keyword_ids[keyword] = kid
+            self.keyword_strings.append(keyword)
+        return kid
+
+    def find(self, email):
+        """根據郵箱取得列號, 找不到時回傳 None"""
+        return self.email_index.get(email)
+
+    def keywords_of(self, row):
+        """取得指定列的關鍵字 ID 序列"""
+        pending = self._pending.get(row)
+        if pending is not None:
+            return pending
+        return self.kw_ids[self.kw_offsets[row]:self.kw_offsets[row + 1]]
+
+    def get(self, row):
+        """取得指定列的參與者 dict (邊界輸出格式)"""
+        strings = self.keyword_strings
+        return {
+            'name': self.names[row],
+            'email': self.emails[row],
+            'keywords': [strings[k] for k in self.keywords_of(row)]
+        }
+
+    def to_list(self):
+        """轉換為 dict 形狀的參與者清單 (用於儲存 JSON)"""
+        return [self.get(row) for row in range(len(self.emails))]
+
+    def keyword_count(self):
+        """取得所有參與者的關鍵字總數"""
+        self.compact()
+        return len(self.kw_ids)
+
+    # ========== 修改 ==========
+
+    def append(self, participant):
+        """新增一位參與者 (dict 形狀)"""
+        row = len(self.emails)
+        self.names.append(participant['name'])
+        self.emails.append(participant['email'])
+        self.email_index[participant['email']] = row
+        self.kw_ids.extend(self.intern(k) for k in participant.get('keywords', []))
+        self.kw_offsets.append(len(self.kw_ids))
+
+    def update(self, row, participant):
+        """以 dict 形狀的資料取代指定列的姓名與關鍵字"""
+        self.names[row] = participant['name']
+        self._pending[row] = [self.intern(k) for k in participant.get('keywords', [])]
+
+    def add_keyword(self, row, keyword):
+        ids = list(self.keywords_of(row))
+        ids.append(self.intern(keyword))
+        self._pending[row] = ids
+
+    def remove_keyword(self, row, keyword):
+        kid = self.keyword_ids.get(keyword)
+        ids = list(self.keywords_of(row))
+        if kid is None or kid not in ids:
+            raise ValueError(keyword)
+        ids.remove(kid)
+        self._pending[row] = ids
+
+    def remove_emails(self, emails):
+        """一次移除多位參與者 (單次掃描重建陣列)
+
+        Returns:
+            實際移除的人數
+        """
+        self.compact()
+        names, kept_emails = [], []
+        offsets, ids = array('I', [0]), array('I')
+        for row, email in enumerate(self.emails):
+            if email in emails:
+                continue
+            names.append(self.names[row])
+            kept_emails.append(email)
+            ids.extend(self.kw_ids[self.kw_offsets[row]:self.kw_offsets[row + 1]])
+            offsets.append(len(ids))
+
+        removed = len(self.emails) - len(kept_emails)
+        if removed:
+            self.names, self.emails = names, kept_emails
+            self.kw_offsets, self.kw_ids = offsets, ids
+            self.email_index = {email: row for row, email in enumerate(kept_emails)}
+        return removed
+
+    def compact(self):
+        """將已修改的列合併回 CSR 陣列"""
+        if not self._pending:
+            return
+        offsets, ids = array('I', [0]), array('I')
+        for row in range(len(self.emails)):
+            ids.extend(self.keywords_of(row))
+            offsets.append(len(ids))
+        self.kw_offsets, self.kw_ids = offsets, ids
+        self._pending = {}
+
+
+class RosterSnapshot:
+    """參與者名冊的二進位快照 - 以 mmap 讀取, 啟動時不需解析 JSON
+
+    檔案配置 (little-endian):
+    - 標頭: 魔術字、版本、來源 JSON 的 mtime/大小/SHA-256、各區段位移
+    - 參與者紀錄: 固定寬度 (姓名位移/長度, 郵箱位移/長度, 關鍵字起點/數量)
+    - 關鍵字表: 固定寬度 (字串位移/長度), 索引即關鍵字 ID
+    - 關鍵字參照: uint32 關鍵字 ID 陣列 (CSR)
+    - 郵箱索引: 依郵箱排序的 uint32 列號, 供二分搜尋
+    - 字串表: 所有 UTF-8 字串串接
+
+    行為類似唯讀的參與者清單, 存取時才解碼個別紀錄。
+    """
+
+    MAGIC = b'LTRS'
+    VERSION = 1
+    _HEADER = struct.Struct('<4sHHqQ32sIIIQQQQQ')
+    _RECORD = struct.Struct('<QIQIII')
+    _KEYWORD = struct.Struct('<QI')
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+        header = self._parse_header(self._mm[:self._HEADER.size])
+        if header is None:
+            self.close()
+            raise ValueError(f"無效的快照檔案: {path}")
+        (self.source_mtime_ns, self.source_size, self.source_hash,
+         self.count, self.keyword_total, self.kwref_count,
+         self._records_off, self._keywords_off, self._kwrefs_off,
+         self._index_off, self._strings_off) = header
+        self._kwrefs = memoryview(self._mm)[
+            self._kwrefs_off:self._kwrefs_off + 4 * self.kwref_count].cast('I')
+        self._index = memoryview(self._mm)[
+            self._index_off:self._index_off + 4 * self.count].cast('I')
+
+    @classmethod
+    def _parse_header(cls, data):
+        if len(data) < cls._HEADER.size:
+            return None
+        fields = cls._HEADER.unpack_from(data)
+        magic, version, little_endian = fields[:3]
+        # 陣列區段以原生位元組順序存取, 與目前平台不符時視為無效
+        if magic != cls.MAGIC or version != cls.VERSION or little_endian != (sys.byteorder == 'little'):
+            return None
+        return fields[3:]
+
+    @classmethod
+    def read_header(cls, path):
+        """只讀取標頭 (不建立 mmap), 無效時回傳 None"""
+        try:
+            with open(path, 'rb') as f:
+                return cls._parse_header(f.read(cls._HEADER.size))
+        except OSError:
+            return None
+
+    @staticmethod
+    def hash_file(path):
+        """計算檔案的 SHA-256"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return digest.digest()
+
+    @classmethod
+    def open_if_fresh(cls, path, source_path):
+        """若快照與來源 JSON 一致則開啟快照, 否則回傳 None
+
+        先比對 mtime 與大小; mtime 不同但大小相同時再比對內容雜湊,
+        內容未變時只更新標頭中的 mtime。
+        """
+        header = cls.read_header(path)
+        if header is None:
+            return None
+        try:
+            stat = os.stat(source_path)
+        except OSError:
+            return None
+
+        mtime_ns, size, source_hash = header[:3]
+        if size != stat.st_size:
+            return None
+        if mtime_ns != stat.st_mtime_ns:
+            if cls.hash_file(source_path) != source_hash:
+                return None
+            try:
+                with open(path, 'r+b') as f:
+                    f.seek(8)
+                    f.write(struct.pack('<q', stat.st_mtime_ns))
+            except OSError:
+                pass
+
+        try:
+            return cls(path)
+        except (OSError, ValueError):
+            return None
+
+    @classmethod
+    def write(cls, path, participants, source_path):
+        """由參與者清單建立快照檔案 (先寫入暫存檔再原子替換)"""
+        stat = os.stat(source_path)
+        source_hash = cls.hash_file(source_path)
+
+        strings = bytearray()
+        records = bytearray()
+        keyword_table = bytearray()
+        keyword_ids = {}
+        kwrefs = array('I')
+        email_bytes = []
+
+        def put(text):
+            data = text.encode('utf-8')
+            offset = len(strings)
+            strings.extend(data)
+            return offset, len(data)
+
+        for p in participants:
+            name_off, name_len = put(p['name'])
+            email_off, email_len = put(p['email'])
+            email_bytes.append(bytes(strings[email_off:email_off + email_len]))
+            start = len(kwrefs)
+            for keyword in p.get('keywords', []):
+                kid = keyword_ids.get(keyword)
+                if kid is None:
+                    kid = len(keyword_ids)
+                    keyword_ids[keyword] = kid
+                    keyword_table.extend(cls._KEYWORD.pack(*put(keyword)))
+                kwrefs.append(kid)
+            records.extend(cls._RECORD.pack(name_off, name_len, email_off, email_len,
+                                            start, len(kwrefs) - start))
+
+        index = array('I', sorted(range(len(email_bytes)), key=email_bytes.__getitem__))
+
+        records_off = cls._HEADER.size
+        keywords_off = records_off + len(records)
+        kwrefs_off = keywords_off + len(keyword_table)
+        index_off = kwrefs_off + 4 * len(kwrefs)
+        strings_off = index_off + 4 * len(index)
+        header = cls._HEADER.pack(
+            cls.MAGIC, cls.VERSION, sys.byteorder == 'little',
+            stat.st_mtime_ns, stat.st_size, source_hash,
+            len(email_bytes), len(keyword_ids), len(kwrefs),
+            records_off, keywords_off, kwrefs_off, index_off, strings_off
+        )
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            for part in (header, records, keyword_table, kwrefs.tobytes(), index.tobytes(), strings):
+                f.write(part)
+        os.replace(tmp_path, path)
+
+    def close(self):
+        """釋放 mmap 與檔案"""
+        if self._mm is None:
+            return
+        self._kwrefs.release()
+        self._index.release()
+        self._mm.close()
+        self._file.close()
+        self._mm = None
+
+    # ========== 唯讀清單介面 ==========
+
+    def _str(self, offset, length):
+        start = self._strings_off + offset
+        return self._mm[start:start + length].decode('utf-8')
+
+    def _record(self, row):
+        return self._RECORD.unpack_from(self._mm, self._records_off + row * self._RECORD.size)
+
+    def _keyword(self, kid):
+        return self._str(*self._KEYWORD.unpack_from(self._mm, self._keywords_off + kid * self._KEYWORD.size))
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += self.count
+        if not 0 <= row < self.count:
+            raise IndexError('snapshot index out of range')
+        return self.get(row)
+
+    def __iter__(self):
+        for row in range(self.count):
+            yield self.get(row)
+
+    def get(self, row):
+        """取得指定列的參與者 dict"""
+        name_off, name_len, email_off, email_len, start, n = self._record(row)
+        return {
+            'name': self._str(name_off, name_len),
+            'email': self._str(email_off, email_len),
+            'keywords': [self._keyword(k) for k in self._kwrefs[start:start + n]]
+        }
+
+    def email_at(self, row):
+        _, _, email_off, email_len, _, _ = self._record(row)
+        return self._str(email_off, email_len)
+
+    def email_list(self):
+        """依列號順序取得所有郵箱"""
+        size = self._RECORD.size
+        end = self._records_off + self.count * size
+        strings = self._mm
+        base = self._strings_off
+        return [strings[base + off:base + off + n].decode('utf-8')
+                for _, _, off, n, _, _ in self._RECORD.iter_unpack(strings[self._records_off:end])]
+
+    def name_list(self):
+        """依列號順序取得所有姓名"""
+        size = self._RECORD.size
+        end = self._records_off + self.count * size
+        strings = self._mm
+        base = self._strings_off
+        return [strings[base + off:base + off + n].decode('utf-8')
+                for off, n, _, _, _, _ in self._RECORD.iter_unpack(strings[self._records_off:end])]
+
+    def find(self, email):
+        """以排序郵箱索引二分搜尋, 回傳列號或 None"""
+        target = email.encode('utf-8')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            row = self._index[mid]
+            _, _, off, n, _, _ = self._record(row)
+            start = self._strings_off + off
+            value = self._mm[start:start + n]
+            if value < target:
+                lo = mid + 1
+            elif value > target:
+                hi = mid
+            else:
+                return row
+        return None
+
+    def to_list(self):
+        """轉換為 dict 形狀的參與者清單"""
+        return list(self)
+
+    def to_compact_roster(self):
+        """直接由快照陣列建立 CompactRoster (不經過 dict)"""
+        roster = CompactRoster()
+        base = self._strings_off
+        mm = self._mm
+        end = self._records_off + self.count * self._RECORD.size
+        offsets = array('I')
+        for name_off, name_len, email_off, email_len, start, _ in \
+                self._RECORD.iter_unpack(mm[self._records_off:end]):
+            roster.names.append(mm[base + name_off:base + name_off + name_len].decode('utf-8'))
+            roster.emails.append(mm[base + email_off:base + email_off + email_len].decode('utf-8'))
+            offsets.append(start)
+        offsets.append(self.kwref_count)
+        roster.kw_offsets = offsets
+        roster.email_index = {email: row for row, email in enumerate(roster.emails)}
+        roster.keyword_strings = [self._keyword(k) for k in range(self.keyword_total)]
+        roster.keyword_ids = {k: i for i, k in enumerate(roster.keyword_strings)}
+        roster.kw_ids = array('I', self._kwrefs)
+        return roster
+
+
+# ========== 參與者搜尋 ==========
+
+class ParticipantSearchIndex:
+    """參與者即時搜尋索引 - 姓名與郵箱的前綴索引加上三字元 (trigram) 索引
+
+    - 前綴: 排序的 (詞, 編號) 清單, 以二分搜尋找出以查詢字串開頭的姓名、姓名中的詞或郵箱
+    - 子字串: trigram -> 編號陣列, 取最少出現的 trigram 候選後再驗證
+    - 新增/刪除為增量更新 (刪除以標記處理, 前綴清單在下次查詢時才重新排序)
+    搜尋結果直接回傳郵箱, 不需從顯示文字反解析。
+    """
+
+    def __init__(self, rows=()):
+        """
+        Args:
+            rows: 可迭代的 (姓名, 郵箱)
+        """
+        self._entries = []   # 編號 -> (郵箱, 姓名, 小寫姓名, 小寫郵箱), 刪除後為 None
+        self._ids = {}       # 郵箱 -> 編號
+        self._prefix = []    # 排序的 (詞, 編號)
+        self._sorted = True
+        self._grams = {}     # trigram -> array('I') 編號 (遞增)
+        for name, email in rows:
+            self.add(name, email)
+
+    def __len__(self):
+        return len(self._ids)
+
+    @staticmethod
+    def _tokens(name_lower, email_lower):
+        tokens = {name_lower, email_lower}
+        tokens.update(name_lower.split())
+        return tokens
+
+    def add(self, name, email):
+        if email in self._ids:
+            self.remove(email)
+        eid = len(self._entries)
+        name_lower, email_lower = name.lower(), email.lower()
+        self._entries.append((email, name, name_lower, email_lower))
+        self._ids[email] = eid
+        for token in self._tokens(name_lower, email_lower):
+            self._prefix.append((token, eid))
+        self._sorted = False
+        text = f"{name_lower}\t{email_lower}"
+        for gram in {text[i:i + 3] for i in range(len(text) - 2)}:
+            postings = self._grams.get(gram)
+            if postings is None:
+                postings = self._grams[gram] = array('I')
+            postings.append(eid)
+
+    def remove(self, email):
+        eid = self._ids.pop(email, None)
+        if eid is not None:
+            self._entries[eid] = None
+
+    def search(self, query, limit=20):
+        """搜尋姓名或郵箱
+
+        前綴符合的排在前面, 其次是子字串符合 (查詢至少 3 個字元時使用 trigram 索引,
+        較短的查詢才掃描全部)。
+
+        Returns:
+            [(郵箱, 姓名), ...] 最多 limit 筆
+        """
+        query = query.strip().lower()
+        entries = self._entries
+        if not query:
+            return [entry[:2] for entry in itertools.islice(
+                (entry for entry in entries if entry is not None), limit)]
+
+        if not self._sorted:
+            self._prefix.sort()
+            self._sorted = True
+
+        found, results = set(), []
+        prefix = self._prefix
+        pos = bisect.bisect_left(prefix, (query,))
+        while pos < len(prefix) and len(results) < limit:
+            token, eid = prefix[pos]
+            if not token.startswith(query):
+                break
+            pos += 1
+            entry = entries[eid]
+            if entry is not None and eid not in found:
+                found.add(eid)
+                results.append(entry[:2])
+
+        if len(results) < limit:
+            if len(query) >= 3:
+                grams = [self._grams.get(query[i:i + 3]) for i in range(len(query) - 2)]
+                if not all(grams):
+                    return results
+                candidates = min(grams, key=len)
+            else:
+                candidates = range(len(entries))
+            for eid in candidates:
+                entry = entries[eid]
+                if entry is None or eid in found:
+                    continue
+                if query in entry[2] or query in entry[3]:
+                    found.add(eid)
+                    results.append(entry[:2])
+                    if len(results) >= limit:
+                        break
+        return results
+
+
+# ========== 關鍵字抽籤 ==========
+
+def _draw_keyword_ids(kw_offsets, kw_ids, keyword_total, selected_rows, rng, rounds=2,
+                      banned=None, banned_weight=0.0):
+    """在 CSR 整數陣列上執行關鍵字抽籤
+
+    每一輪中, 每位被選中的參與者從「非自己擁有、且本次抽籤尚未用過」的
+    關鍵字出現位置中等機率抽取 1 個。先以拒絕取樣嘗試, 失敗多次才完整掃描。
+
+    Args:
+        kw_offsets: CSR 偏移陣列
+        kw_ids: CSR 關鍵字 ID 陣列
+        keyword_total: 關鍵字 ID 總數 (用於已使用標記)
+        selected_rows: 參與抽籤的列號清單
+        rng: 提供 randrange / choice 的亂數來源
+        rounds: 抽籤輪數
+        banned: 與 selected_rows 對應的關鍵字 ID 集合 (例如近期已分配給該參與者的), 可選
+        banned_weight: banned 關鍵字的相對權重 (0 表示完全排除, 介於 0 與 1 之間表示降低機率)
+
+    Returns:
+        (assignments, failure)
+        assignments: 與 selected_rows 對應的關鍵字 ID 清單
+        failure: 成功時為 None, 否則為 (輪次, selected_rows 索引, 可用數量)
+    """
+    total = len(kw_ids)
+    used = bytearray(keyword_total)
+    assignments = [[] for _ in selected_rows]
+
+    for round_no in range(1, rounds + 1):
+        for i, row in enumerate(selected_rows):
+            start, end = kw_offsets[row], kw_offsets[row + 1]
+            avoid = banned[i] if banned else ()
+            pick = -1
+            if total:
+                for _ in range(_KEYWORD_REJECTION_TRIES):
+                    j = rng.randrange(total)
+                    if start <= j < end or used[kw_ids[j]]:
+                        continue
+                    # 近期分配過的關鍵字以 banned_weight 的機率接受 (拒絕取樣即為加權抽樣)
+                    if avoid and kw_ids[j] in avoid and rng.random() >= banned_weight:
+                        continue
+                    pick = j
+                    break
+            if pick < 0:
+                candidates = [j for j in range(total)
+                              if not start <= j < end and not used[kw_ids[j]]]
+                if avoid:
+                    preferred = [j for j in candidates if kw_ids[j] not in avoid]
+                    if banned_weight <= 0:
+                        candidates = preferred
+                    elif preferred and len(preferred) < len(candidates):
+                        weights = [banned_weight if kw_ids[j] in avoid else 1.0 for j in candidates]
+                        pick = rng.choices(candidates, weights)[0]
+                if not candidates:
+                    return assignments, (round_no, i, 0)
+                if pick < 0:
+                    pick = rng.choice(candidates)
+
+            kid = kw_ids[pick]
+            used[kid] = 1
+            assignments[i].append(kid)
+
+    return assignments, None
+
+
+# ========== 亂數來源 ==========
+
+def seed_commitment(seed):
+    """種子的承諾值 (SHA-256): 可在抽籤前公布, 揭曉後以種子驗證"""
+    return hashlib.sha256(seed.encode('utf-8')).hexdigest()
+
+
+class _NumpyRandom:
+    """numpy.random.Generator (PCG64) 的 random 模組相容介面
+
+    一般抽樣與加權抽樣以陣列運算完成 (向量化路徑); 逐次呼叫的 randrange / random
+    供關鍵字抽籤的拒絕取樣使用。
+    """
+
+    def __init__(self, seed):
+        try:
+            import numpy
+        except ImportError:
+            raise ValueError("numpy 亂數來源需要安裝 NumPy (pip install numpy)")
+        self._np = numpy
+        self.generator = numpy.random.default_rng(seed)
+
+    def random(self):
+        return float(self.generator.random())
+
+    def randrange(self, n):
+        return int(self.generator.integers(n))
+
+    def choice(self, seq):
+        return seq[self.randrange(len(seq))]
+
+    def choices(self, population, weights):
+        p = self._np.asarray(weights, dtype=float)
+        return [population[int(self.generator.choice(len(population), p=p / p.sum()))]]
+
+    def sample(self, population, k):
+        if k > len(population):
+            raise ValueError("Sample larger than population")
+        return [population[i] for i in self.generator.choice(len(population), k, replace=False).tolist()]
+
+    def shuffle(self, items):
+        items[:] = [items[i] for i in self.generator.permutation(len(items)).tolist()]
+
+    def weighted_sample(self, population, weights, count):
+        """向量化的 Efraimidis-Spirakis 加權抽樣 (與 weighted_sample 相同語意)"""
+        np = self._np
+        population = list(population)
+        w = np.asarray(weights, dtype=float)
+        positive = np.flatnonzero(w > 0)
+        count = min(count, len(positive))
+        if count <= 0:
+            return []
+        keys = np.log(1.0 - self.generator.random(len(positive))) / w[positive]
+        top = np.argpartition(-keys, count - 1)[:count]
+        top = top[np.argsort(-keys[top], kind='stable')]
+        return [population[i] for i in positive[top].tolist()]
+
+
+class RandomSource:
+    """可替換的抽籤亂數來源 - 每次抽籤建立一個產生器, 並產生寫入歷史記錄的資訊
+
+    - 'seeded': 每次以 secrets 產生 128 位元種子建立 random.Random (預設, 可重播)
+    - 'system': secrets.SystemRandom (作業系統的密碼學亂數, 無法重播)
+    - 'numpy': NumPy Generator (PCG64), 以種子的 SHA-256 初始化 (可重播, 抽樣向量化)
+
+    可重播的來源會記錄 {"backend", "seed", "commitment"}; 指定 seed 時改為
+    依序使用 "<seed>-1"、"<seed>-2"... 作為每次抽籤的種子 (方便測試與演練)。
+    """
+
+    BACKENDS = ('seeded', 'system', 'numpy')
+
+    def __init__(self, backend='seeded', seed=None):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"不支援的亂數來源: {backend} (可用: {', '.join(self.BACKENDS)})")
+        if backend == 'numpy':
+            _NumpyRandom(0)  # 未安裝 NumPy 時立即回報
+        self.backend = backend
+        self.seed = seed
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _next_seed(self):
+        if self.seed is None:
+            return secrets.token_hex(16)
+        with self._lock:
+            self._counter += 1
+            return f"{self.seed}-{self._counter}"
+
+    def generator(self, seed=None):
+        """建立一次抽籤使用的產生器
+
+        Args:
+            seed: 指定本次抽籤的種子 (預設自動產生)
+
+        Returns:
+            (rng, info) - info 寫入歷史記錄的 rng 欄位
+        """
+        if self.backend == 'system':
+            return secrets.SystemRandom(), {'backend': 'system'}
+        seed = seed or self._next_seed()
+        info = {'backend': self.backend, 'seed': seed, 'commitment': seed_commitment(seed)}
+        return self.replay(info), info
+
+    @staticmethod
+    def replay(info):
+        """依歷史記錄的 rng 資訊重建產生器 (與抽籤時的亂數序列相同)"""
+        seed = info.get('seed')
+        if info.get('backend') == 'system' or not seed:
+            raise ValueError("此記錄使用系統亂數來源, 無法重播")
+        if seed_commitment(seed) != info.get('commitment', seed_commitment(seed)):
+            raise ValueError("種子與承諾值不符")
+        if info['backend'] == 'numpy':
+            return _NumpyRandom(int.from_bytes(hashlib.sha256(seed.encode('utf-8')).digest(), 'big'))
+        return random.Random(seed)
+
+
+def format_rng_info(info):
+    """歷史記錄中亂數來源資訊的顯示文字 (沒有時為空字串)"""
+    if not info:
+        return ""
+    if 'seed' not in info:
+        return f"亂數來源: {info['backend']}\n"
+    return f"亂數來源: {info['backend']}（種子: {info['seed']}）\n"
+
+
+class DrawResult(list):
+    """禮物抽籤結果 (參與者 dict 清單); rng 為本次抽籤的亂數來源資訊"""
+    rng = None
+
+
+class KeywordDrawResult(dict):
+    """關鍵字抽籤結果 ({email: {name, email, keywords}}); rng 為本次抽籤的亂數來源資訊
+
+    分群抽籤時 groups 為 [[群組, 人數], ...], 結果依此順序逐群排列。
+    """
+    rng = None
+    groups = None
+
+
+class DrawAuditStore:
+    """抽籤輸入的內容定址儲存 - 供重播驗證
+
+    每份輸入 (候選名單、權重、近期排除等) 以正規化 JSON 的 SHA-256 命名,
+    以 gzip 壓縮存放在 draw_audit/, 相同的輸入只存一份; 歷史記錄只保存雜湊。
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest + '.json.gz')
+
+    @staticmethod
+    def _canonical(doc):
+        return json.dumps(doc, ensure_ascii=False, separators=(',', ':'), sort_keys=True).encode('utf-8')
+
+    @classmethod
+    def digest(cls, doc):
+        """只計算抽籤輸入的雜湊, 不保存 (未開啟 --audit 時記錄在歷史中, 供呼叫端提供名單驗證)"""
+        return hashlib.sha256(cls._canonical(doc)).hexdigest()
+
+    def put(self, doc):
+        """保存抽籤輸入, 回傳其雜湊"""
+        data = self._canonical(doc)
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest)
+        if not os.path.exists(path):
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    def get(self, digest):
+        """讀取抽籤輸入並驗證雜湊"""
+        with gzip.open(self._path(digest), 'rb') as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise ValueError("抽籤輸入檔案已被修改")
+        return json.loads(data)
+
+
+def _sample_rows(rng, population, count, weights=None):
+    """抽籤與重播共用: 由候選中不重複抽取 count 個 (有權重時依權重)"""
+    if weights is not None:
+        return weighted_sample(population, weights, count, rng)
+    return rng.sample(population, count)
+
+
+def replay_draw_input(doc, rng):
+    """以抽籤輸入與重建的產生器重新推導禮物抽籤結果 (郵箱清單)"""
+    return _sample_rows(rng, doc['candidates'], doc['count'], doc.get('weights'))
+
+
+def replay_keyword_input(doc, rng):
+    """以抽籤輸入與重建的產生器重新推導關鍵字抽籤結果 ({郵箱: [關鍵字...]})"""
+    roster = CompactRoster.from_participants(
+        {'name': '', 'email': email, 'keywords': keywords} for email, keywords in doc['roster'])
+    rows = rng.sample(range(len(roster)), doc['count'])
+    banned = None
+    if doc.get('banned') is not None:
+        banned = [{roster.keyword_ids[k] for k in doc['banned'].get(roster.emails[row], ())
+                   if k in roster.keyword_ids} for row in rows]
+    assignments, failure = _draw_keyword_ids(
+        roster.kw_offsets, roster.kw_ids, len(roster.keyword_strings), rows, rng,
+        banned=banned, banned_weight=doc.get('banned_weight', 0.0))
+    if failure:
+        raise ValueError("重播時關鍵字不足")
+    strings = roster.keyword_strings
+    return {roster.emails[row]: [strings[k] for k in ids] for row, ids in zip(rows, assignments)}
+
+
+# ========== 分群關鍵字抽籤 ==========
+
+# 關鍵字總數少於此值時在目前行程中依序執行 (行程池的啟動成本高於抽籤本身)
+SHARD_POOL_MIN_KEYWORDS = 20000
+
+
+def shard_rng_info(info, group):
+    """分群抽籤中單一群組的亂數來源資訊 - 種子由本次種子與群組名稱衍生, 各群組可獨立重建"""
+    if 'seed' not in info:
+        return {'backend': info['backend']}
+    seed = f"{info['seed']}/{group}"
+    return {'backend': info['backend'], 'seed': seed, 'commitment': seed_commitment(seed)}
+
+
+def keyword_shard_tasks(roster, groups, info, banned=None, banned_weight=0.0):
+    """依群組切出各自的子 CSR 名冊, 建立互相獨立的關鍵字抽籤工作
+
+    子名冊沿用全域關鍵字 ID, 關鍵字池只包含同群組成員的關鍵字。
+
+    Args:
+        roster: CompactRoster
+        groups: [(群組, [列號...]), ...]
+        info: 本次抽籤的亂數來源資訊 (各群組的種子由此衍生)
+        banned: {列號: 關鍵字 ID 集合} (近期分配過的), 可選
+        banned_weight: 近期關鍵字的相對權重
+
+    Returns:
+        傳給 _keyword_shard 的工作清單 (與 groups 對應)
+    """
+    offsets, kw_ids = roster.kw_offsets, roster.kw_ids
+    keyword_total = len(roster.keyword_strings)
+    tasks = []
+    for group, rows in groups:
+        sub_offsets = array('I', [0])
+        sub_ids = array('I')
+        for row in rows:
+            sub_ids.extend(kw_ids[offsets[row]:offsets[row + 1]])
+            sub_offsets.append(len(sub_ids))
+        sub_banned = None if banned is None else [banned.get(row, ()) for row in rows]
+        tasks.append((sub_offsets, sub_ids, keyword_total, shard_rng_info(info, group),
+                      sub_banned, banned_weight))
+    return tasks
+
+
+def _keyword_shard(task):
+    """執行單一群組的關鍵字抽籤 (群組內所有人參加; 可在工作行程中執行)
+
+    Returns:
+        (order, assignments, failure) - order 為抽籤順序 (群組內的索引),
+        assignments 與 order 對應, failure 同 _draw_keyword_ids
+    """
+    offsets, kw_ids, keyword_total, info, banned, banned_weight = task
+    rng = secrets.SystemRandom() if info['backend'] == 'system' else RandomSource.replay(info)
+    count = len(offsets) - 1
+    order = rng.sample(range(count), count)
+    if banned is not None:
+        banned = [banned[i] for i in order]
+    assignments, failure = _draw_keyword_ids(offsets, kw_ids, keyword_total, order, rng,
+                                             banned=banned, banned_weight=banned_weight)
+    return order, assignments, failure
+
+
+def run_keyword_shards(tasks, workers=None):
+    """執行各群組的抽籤工作, 回傳與 tasks 對應的結果
+
+    有多個群組且關鍵字總數夠多時使用行程池 (大群組先送出), 總耗時約為最大群組的耗時;
+    否則在目前行程中依序執行。
+
+    Args:
+        workers: 工作行程數 (預設為 CPU 數, 1 表示不使用行程池)
+    """
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    if workers <= 1 or sum(len(task[1]) for task in tasks) < SHARD_POOL_MIN_KEYWORDS:
+        return [_keyword_shard(task) for task in tasks]
+
+    order = sorted(range(len(tasks)), key=lambda i: len(tasks[i][1]), reverse=True)
+    results = [None] * len(tasks)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for i, result in zip(order, pool.map(_keyword_shard, [tasks[i] for i in order])):
+            results[i] = result
+    return results
+
+
+def replay_sharded_keyword_input(doc, info):
+    """以分群抽籤的輸入與種子重新推導結果 ({郵箱: [關鍵字...]})"""
+    roster = CompactRoster.from_participants(
+        {'name': '', 'email': email, 'keywords': keywords} for email, keywords in doc['roster'])
+    rows_of = {email: row for row, email in enumerate(roster.emails)}
+    groups = [(group, [rows_of[email] for email in emails]) for group, emails in doc['groups']]
+    banned = None
+    if doc.get('banned') is not None:
+        banned = {rows_of[email]: {roster.keyword_ids[k] for k in keywords if k in roster.keyword_ids}
+                  for email, keywords in doc['banned'].items()}
+    tasks = keyword_shard_tasks(roster, groups, info, banned, doc.get('banned_weight', 0.0))
+    strings = roster.keyword_strings
+    expected = {}
+    for (group, rows), (order, assignments, failure) in zip(groups, run_keyword_shards(tasks, workers=1)):
+        if failure:
+            raise ValueError(f"重播時群組 {group} 的關鍵字不足")
+        for i, ids in zip(order, assignments):
+            expected[roster.emails[rows[i]]] = [strings[k] for k in ids]
+    return expected
+
+
+# ========== 名單檔案串流抽籤 ==========
+
+def iter_roster_file(path):
+    """逐行讀取名單檔案, 產生 {name, email} dict
+
+    支援格式:
+    - .jsonl / .ndjson: 每行一個 JSON 物件, 需含 email 欄位
+    - 其他 (CSV): 可有標題列 (name/email 或 姓名/郵箱), 否則視為「姓名,郵箱」
+
+    不會一次讀入整個檔案, 適合數百萬行的名單。
+    """
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        if ext in ('.jsonl', '.ndjson'):
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                email = str(record.get('email', '')).strip()
+                if email:
+                    yield {'name': str(record.get('name', '')).strip(), 'email': email}
+            return
+
+        name_col, email_col = 0, 1
+        for i, row in enumerate(csv.reader(f)):
+            if i == 0:
+                header = [c.strip().lower() for c in row]
+                if 'email' in header or '郵箱' in header:
+                    email_col = header.index('email') if 'email' in header else header.index('郵箱')
+                    if 'name' in header:
+                        name_col = header.index('name')
+                    elif '姓名' in header:
+                        name_col = header.index('姓名')
+                    continue
+            if len(row) <= max(name_col, email_col):
+                continue
+            email = row[email_col].strip()
+            if email:
+                yield {'name': row[name_col].strip(), 'email': email}
+
+
+def load_email_set(path):
+    """從檔案載入郵箱集合 (每行一個, 忽略空行與 # 開頭的註解)"""
+    emails = set()
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    emails.add(line)
+    return emails
+
+
+def _open_unit(rng):
+    """取得 (0, 1) 區間的亂數"""
+    u = rng.random()
+    while u == 0.0:
+        u = rng.random()
+    return u
+
+
+def reservoir_sample(iterable, count, rng=random):
+    """蓄水池抽樣 (Algorithm L) - 單次掃描、固定記憶體
+
+    Args:
+        iterable: 任意可迭代的資料來源
+        count: 抽取數量
+        rng: 亂數來源
+
+    Returns:
+        (sample, seen) - 抽中的項目 (已隨機排序) 與掃描的項目總數
+    """
+    it = iter(iterable)
+    reservoir = []
+    for item in it:
+        reservoir.append(item)
+        if len(reservoir) >= count:
+            break
+    seen = len(reservoir)
+    if seen < count or count <= 0:
+        return reservoir[:max(count, 0)], seen
+
+    def skip(log_w):
+        # 以幾何分布決定下一個進入蓄水池的項目; log(1 - w) 以 expm1 計算避免精度流失
+        return int(math.log(_open_unit(rng)) / math.log(-math.expm1(log_w)))
+
+    # 以幾何分布跳過不會進入蓄水池的項目, 避免每一項都呼叫亂數
+    log_w = math.log(_open_unit(rng)) / count
+    next_index = seen + skip(log_w)
+    for item in it:
+        if seen == next_index:
+            reservoir[rng.randrange(count)] = item
+            log_w += math.log(_open_unit(rng)) / count
+            next_index += skip(log_w) + 1
+        seen += 1
+
+    rng.shuffle(reservoir)
+    return reservoir, seen
+
+
+def weighted_sample(population, weights, count, rng=random):
+    """依權重不重複抽樣 (Efraimidis-Spirakis: 每項取 log(u)/w, 保留最大的 count 項)
+
+    權重為 0 的項目不會被抽中。
+
+    Returns:
+        抽中的項目清單 (數量可能少於 count, 若正權重的項目不足)
+    """
+    vectorized = getattr(rng, 'weighted_sample', None)
+    if vectorized is not None:
+        return vectorized(population, weights, count)
+    keys = ((math.log(_open_unit(rng)) / w, item)
+            for item, w in zip(population, weights) if w > 0)
+    return [item for _, item in heapq.nlargest(count, keys, key=lambda pair: pair[0])]
+
+
+def reservoir_draw_file(path, count, exclude=None, rng=random):
+    """直接從名單檔案串流抽籤, 不載入整份名單
+
+    Args:
+        path: 名單檔案路徑 (CSV / JSONL)
+        count: 抽取數量
+        exclude: 需排除的郵箱集合 (例如已抽中的人)
+        rng: 亂數來源
+
+    Returns:
+        (success, selected, message)
+    """
+    exclude = exclude or set()
+    if not os.path.exists(path):
+        return False, [], f"找不到名單檔案: {path}"
+
+    eligible = (p for p in iter_roster_file(path) if p['email'] not in exclude)
+    try:
+        selected, seen = reservoir_sample(eligible, count, rng)
+    except (OSError, UnicodeDecodeError, csv.Error) as e:
+        return False, [], f"讀取名單檔案失敗: {e}"
+
+    if seen < count:
+        return False, [], f"可抽取人數不足（可抽取: {seen}, 需要: {count}）"
+    return True, selected, f"抽籤成功（共掃描 {seen} 位可抽取者）"
+
+
+def replay_stream_input(doc, rng):
+    """以抽籤輸入與重建的產生器重新執行串流抽籤 (郵箱清單); 名單檔案須與抽籤時相同"""
+    path = doc['source']
+    if not os.path.exists(path) or RosterSnapshot.hash_file(path).hex() != doc['source_sha256']:
+        raise ValueError(f"名單檔案已變更或不存在: {path}")
+    success, selected, message = reservoir_draw_file(path, doc['count'], set(doc['exclude']), rng)
+    if not success:
+        raise ValueError(message)
+    return [p['email'] for p in selected]
+
+
+# ========== 分組 ==========
+
+def partition_rows(count, team_count, rng, strata=None, separate=()):
+    """將列號 0..count-1 分成 team_count 組 - 洗牌後依序發牌 (單次掃描)
+
+    有 strata 時先依屬性分桶 (桶內為洗牌順序) 再連續發牌, 每種屬性在各組的人數
+    最多相差 1, 各組總人數也最多相差 1; 最後隨機對應組別編號, 多出的人不會固定在前幾組。
+    separate 中的每個集合須分到不同組: 衝突的人與允許組別中不受限制、屬性相同的人交換,
+    不破壞平衡 (找不到同屬性的人時才與其他屬性交換)。
+
+    Args:
+        count: 人數
+        team_count: 組數
+        rng: 提供 shuffle / randrange / choice 的亂數來源
+        strata: 與列號對應的屬性 ID (0 起算的整數), None 表示不平衡屬性
+        separate: 必須分開的列號集合清單
+
+    Returns:
+        (team_of, relaxed) - team_of[列號] 為組別 (0 起算); relaxed 為不同屬性交換的次數
+
+    Raises:
+        ValueError: 必須分開的條件無法滿足
+    """
+    order = list(range(count))
+    rng.shuffle(order)
+    if strata is not None:
+        buckets = [[] for _ in range(max(strata, default=-1) + 1)]
+        for row in order:
+            buckets[strata[row]].append(row)
+        rng.shuffle(buckets)
+        order = [row for bucket in buckets for row in bucket]
+
+    labels = list(range(team_count))
+    rng.shuffle(labels)
+    team_of = array('I', bytes(4 * count))
+    for position, row in enumerate(order):
+        team_of[row] = labels[position % team_count]
+
+    relaxed = 0
+    if not separate:
+        return team_of, relaxed
+
+    constrained = {}  # 列號 -> 所屬的必須分開集合編號
+    for k, rows in enumerate(separate):
+        if len(rows) > team_count:
+            raise ValueError(f"必須分開的 {len(rows)} 人超過組數 {team_count}")
+        for row in rows:
+            constrained.setdefault(row, []).append(k)
+
+    # 可交換的人: (組別, 屬性) -> 不受限制的列號
+    pool = {}
+    for row in order:
+        if row not in constrained:
+            pool.setdefault((team_of[row], strata[row] if strata is not None else 0), []).append(row)
+
+    placed = [set() for _ in separate]  # 每個集合已確定的組別
+    for row, sets in constrained.items():
+        forbidden = set().union(*(placed[k] for k in sets))
+        team = team_of[row]
+        if team in forbidden:
+            stratum = strata[row] if strata is not None else 0
+            allowed = [t for t in range(team_count) if t not in forbidden]
+            same = [t for t in allowed if pool.get((t, stratum))]
+            if same:
+                target = rng.choice(same)
+                key = (target, stratum)
+            else:
+                keys = [key for key, rows in pool.items() if key[0] in allowed and rows]
+                if not keys:
+                    raise ValueError("沒有可交換的人, 無法滿足必須分開的條件")
+                key = rng.choice(keys)
+                target = key[0]
+                relaxed += 1
+            rows = pool[key]
+            i = rng.randrange(len(rows))
+            partner = rows[i]
+            rows[i] = rows[-1]
+            rows.pop()
+            team_of[partner] = team
+            pool.setdefault((team, strata[partner] if strata is not None else 0), []).append(partner)
+            team_of[row] = team = target
+        for k in sets:
+            placed[k].add(team)
+    return team_of, relaxed
+
+
+def load_attribute_map(path):
+    """從 CSV 載入每人的分組屬性 (郵箱,屬性; 第一列為標題時略過)"""
+    attributes = {}
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f:
+        for row in csv.reader(f):
+            if len(row) >= 2 and '@' in row[0]:
+                attributes[row[0].strip()] = row[1].strip()
+    return attributes
+
+
+def load_separate_groups(path):
+    """從檔案載入必須分開的人 (每行以逗號分隔的郵箱, 忽略空行與 # 開頭的註解)"""
+    groups = []
+    with open(path, 'r', encoding='utf-8-sig') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                emails = [email.strip() for email in line.split(',') if email.strip()]
+                if len(emails) > 1:
+                    groups.append(emails)
+    return groups
+
+
+class TeamResult(list):
+    """分組結果 ([{team, members: [{name, email}, ...]}, ...]); rng 為本次分組的亂數來源資訊"""
+    rng = None
+
+
+# ========== 檔案寫入 ==========
+
+def atomic_write_text(path, text):
+    """原子寫入文字檔: 先寫入同目錄的暫存檔並 fsync, 再以 os.replace 取代原檔
+
+    寫入途中當機時, 原檔保持完整 (不會出現被截斷的檔案)。
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def file_stamp(path):
+    """檔案的 (inode, 大小, 修改時間) 戳記, 檔案不存在時為 None
+
+    只需一次 stat; 戳記不同表示檔案被其他程式附加或取代 (原子寫入會換 inode)。
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class FileLock:
+    """跨程序的協作式檔案鎖 (POSIX flock / Windows msvcrt.locking)
+
+    同一目錄下執行的多個 lottery_system.py 在寫入共用檔案前取得此鎖。
+    程序內可重入, 並以內部 RLock 讓各執行緒互斥; 只有遵守此鎖的程式會互斥,
+    手動編輯檔案不受限制 (由戳記檢查偵測)。
+    """
+
+    def __init__(self, path, timeout=10.0, poll=0.02):
+        self.path = path
+        self.timeout = timeout
+        self.poll = poll
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def _lock_os(self, f):
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+
+    def _unlock_os(self, f):
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def acquire(self):
+        """取得鎖; 其他程序持有時輪詢等待, 超過 timeout 秒拋出 TimeoutError"""
+        self._lock.acquire()
+        if self._depth == 0:
+            f = open(self.path, 'a+b')
+            deadline = time.monotonic() + self.timeout
+            while True:
+                try:
+                    self._lock_os(f)
+                    break
+                except OSError:
+                    if time.monotonic() >= deadline:
+                        f.close()
+                        self._lock.release()
+                        raise TimeoutError(f"等待檔案鎖逾時: {self.path}")
+                    time.sleep(self.poll)
+            self._file = f
+        self._depth += 1
+        return self
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            try:
+                self._unlock_os(self._file)
+            finally:
+                self._file.close()
+                self._file = None
+        self._lock.release()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+# ========== 匯出 ==========
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+DRAW_HISTORY_FIELDS = ('timestamp', 'mode', 'count', 'rank', 'name', 'email')
+KEYWORD_HISTORY_FIELDS = ('timestamp', 'mode', 'display_mode', 'name', 'email', 'keywords')
+ROSTER_FIELDS = ('name', 'email', 'keywords')
+
+
+def export_format(path, fmt=None):
+    """決定匯出格式: 指定的 fmt, 否則依副檔名 (.jsonl / .json 為 JSONL, 其餘為 CSV)"""
+    if fmt:
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"不支援的匯出格式: {fmt}")
+        return fmt
+    return 'jsonl' if path.lower().endswith(('.jsonl', '.json')) else 'csv'
+
+
+def draw_history_rows(record):
+    """禮物抽籤記錄 -> CSV 列 (每位中獎者一列)"""
+    for rank, p in enumerate(record['selected'], 1):
+        yield {'timestamp': record['timestamp'], 'mode': record['mode'], 'count': record['count'],
+               'rank': rank, 'name': p['name'], 'email': p['email']}
+
+
+def keyword_history_rows(record):
+    """關鍵字抽籤記錄 -> CSV 列 (每位參與者一列, 關鍵字以 ; 分隔)"""
+    for data in record['results'].values():
+        yield {'timestamp': record['timestamp'], 'mode': record['mode'],
+               'display_mode': record.get('display_mode', ''), 'name': data['name'],
+               'email': data['email'], 'keywords': ';'.join(data['keywords'])}
+
+
+def roster_rows(participant):
+    """參與者 -> CSV 列"""
+    yield {'name': participant['name'], 'email': participant['email'],
+           'keywords': ';'.join(participant.get('keywords', []))}
+
+
+def export_records(path, records, fieldnames, rows_of, fmt=None):
+    """串流匯出記錄到 CSV 或 JSONL 檔案
+
+    逐筆寫入, 記憶體用量與總筆數無關; 先寫入暫存檔, 完成後才取代目標檔案。
+
+    Args:
+        path: 輸出檔案路徑
+        records: 可迭代的記錄 (可為產生器)
+        fieldnames: CSV 欄位
+        rows_of: 將一筆記錄展開為 CSV 列的函式
+        fmt: 'csv' / 'jsonl', 預設依副檔名
+
+    Returns:
+        int: 匯出的記錄筆數
+    """
+    fmt = export_format(path, fmt)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    count = 0
+    try:
+        # CSV 加上 BOM, 試算表軟體才能正確辨識中文
+        with open(tmp_path, 'w', encoding='utf-8-sig' if fmt == 'csv' else 'utf-8', newline='') as f:
+            if fmt == 'csv':
+                writer = csv.DictWriter(f, fieldnames=fieldnames)
+                writer.writeheader()
+                for record in records:
+                    writer.writerows(rows_of(record))
+                    count += 1
+            else:
+                for record in records:
+                    f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    count += 1
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return count
+
+
+class DebouncedWriter:
+    """延遲合併寫入 - 標記變更後, 在一段安靜期後於背景執行緒寫入一次
+
+    連續快速的變更只會觸發一次寫入; flush() 可立即寫入 (例如程式結束時)。
+    寫入失敗時保留變更標記, 下次 flush 會再嘗試。
+    """
+
+    def __init__(self, write, delay=0.5):
+        """
+        Args:
+            write: 實際寫入函式, 成功回傳 True
+            delay: 安靜期秒數
+        """
+        self._write = write
+        self.delay = delay
+        self._lock = threading.Lock()        # 保護 dirty / timer 狀態
+        self._write_lock = threading.Lock()  # 同一時間只允許一個寫入
+        self._timer = None
+        self._dirty = False
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    def mark_dirty(self):
+        """標記有未寫入的變更, 並重新開始安靜期計時"""
+        with self._lock:
+            self._dirty = True
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """立即寫入尚未寫入的變更"""
+        with self._write_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not self._dirty:
+                    return True
+                self._dirty = False
+            success = self._write()
+            if not success:
+                with self._lock:
+                    self._dirty = True
+            return success
+
+
+# ========== 已抽取狀態日誌 ==========
+
+class DrawJournal:
+    """已抽取狀態的預寫日誌 (write-ahead journal)
+
+    每次抽籤、重置、復原都先附加一行到日誌檔並 fsync, 當機或關閉後重新啟動時
+    由「檢查點 + 之後的日誌」重建已抽取清單。每 checkpoint_interval 筆操作
+    寫入一次壓縮後的檢查點並清空日誌, 重播時間不隨使用時間增加。
+
+    狀態以「抽籤批次」堆疊保存, 復原上次抽籤只需彈出最後一批。
+    """
+
+    def __init__(self, path, checkpoint_path, checkpoint_interval=100):
+        self.path = path
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.batches = []  # 自上次重置以來的抽籤批次 [[{name, email}, ...], ...]
+        self._seq = 0
+        self._ops_since_checkpoint = 0
+
+    def recover(self):
+        """由檢查點與日誌重建狀態
+
+        Returns:
+            已抽取的參與者清單 (依抽取順序)
+        """
+        self.batches = []
+        self._seq = 0
+        try:
+            if os.path.exists(self.checkpoint_path):
+                with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                    checkpoint = json.load(f)
+                self._seq = checkpoint.get('seq', 0)
+                self.batches = checkpoint.get('batches', [])
+        except Exception as e:
+            print(f"載入抽籤檢查點失敗: {e}")
+
+        self._ops_since_checkpoint = 0
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # 寫入途中中斷的殘缺行
+                    if entry.get('seq', 0) <= self._seq:
+                        continue
+                    self._apply(entry)
+                    self._seq = entry['seq']
+                    self._ops_since_checkpoint += 1
+
+        return self.drawn_items()
+
+    def drawn_items(self):
+        return [p for batch in self.batches for p in batch]
+
+    def _apply(self, entry):
+        op = entry['op']
+        if op == 'draw':
+            self.batches.append(entry['items'])
+        elif op == 'undo':
+            if self.batches:
+                self.batches.pop()
+        elif op == 'retract':
+            index = self._find_batch(entry['emails'])
+            if index is not None:
+                del self.batches[index]
+        elif op == 'reset':
+            self.batches = []
+        elif op == 'forget':
+            emails = set(entry['emails'])
+            self.batches = [[p for p in batch if p['email'] not in emails] for batch in self.batches]
+
+    def _record(self, op, **fields):
+        self._seq += 1
+        entry = dict(op=op, seq=self._seq, **fields)
+        self._apply(entry)
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            print(f"寫入抽籤日誌失敗: {e}")
+
+        self._ops_since_checkpoint += 1
+        if self._ops_since_checkpoint >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def record_draw(self, selected):
+        self._record('draw', items=[{'name': p['name'], 'email': p['email']} for p in selected])
+
+    def record_reset(self):
+        self._record('reset')
+
+    def record_forget(self, emails):
+        """參與者被刪除時, 從已抽取狀態中移除"""
+        self._record('forget', emails=sorted(emails))
+
+    def record_undo(self):
+        """復原最後一批抽籤, 回傳被復原的批次 (沒有可復原時回傳 None)"""
+        if not self.batches:
+            return None
+        batch = self.batches[-1]
+        self._record('undo')
+        return batch
+
+    def _find_batch(self, emails):
+        """最近一批郵箱集合等於 emails 的批次位置"""
+        emails = set(emails)
+        for index in range(len(self.batches) - 1, -1, -1):
+            if {p['email'] for p in self.batches[index]} == emails:
+                return index
+        return None
+
+    def record_retract(self, emails):
+        """撤回指定的一批抽籤 (依郵箱找出批次, 不論之後是否還有其他抽籤)
+
+        Returns:
+            被撤回的批次, 找不到 (例如已重置) 時回傳 None
+        """
+        index = self._find_batch(emails)
+        if index is None:
+            return None
+        batch = self.batches[index]
+        self._record('retract', emails=sorted({p['email'] for p in batch}))
+        return batch
+
+    def checkpoint(self):
+        """寫入壓縮後的檢查點並清空日誌"""
+        try:
+            atomic_write_text(self.checkpoint_path, json.dumps(
+                {'seq': self._seq, 'batches': self.batches}, ensure_ascii=False))
+            with open(self.path, 'w', encoding='utf-8'):
+                pass
+            self._ops_since_checkpoint = 0
+        except OSError as e:
+            print(f"寫入抽籤檢查點失敗: {e}")
+
+
+# ========== 歷史記錄儲存 ==========
+
+class ParticipantSnapshotTable:
+    """歷史記錄共用的參與者快照表與關鍵字表 (append-only JSON Lines)
+
+    - 參與者版本: {"t": "p", "id", "name", "email", "kw": [關鍵字 ID...]}
+      同一郵箱的姓名或關鍵字變更時新增一個版本, 舊記錄仍指向當時的版本
+    - 關鍵字: {"t": "k", "id", "s": 字串}
+
+    歷史記錄只保存版本 ID 與關鍵字 ID, 讀取時再合併 (join) 回完整資料。
+    第一次使用時才載入, 大小只隨「不同的參與者版本」增加, 與抽籤次數無關。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._people = None    # 版本 ID -> (name, email, 關鍵字 ID tuple)
+        self._keywords = []    # 關鍵字 ID -> 字串
+        self._keyword_ids = {}
+        self._latest = {}      # email -> 最新版本 ID
+        self._pending = []     # 尚未寫入檔案的新項目
+        self._size = 0         # 已讀取的檔案位移
+        self._lock = threading.RLock()  # 兩種歷史記錄共用, 讀寫可能來自不同執行緒
+
+    def _ensure_loaded(self):
+        if self._people is not None:
+            return
+        self._people = []
+        self._read_from(0)
+
+    def _read_from(self, pos):
+        """讀取 pos 之後的項目 (其他程式寫入中的殘缺行留待下次)"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(pos)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                pos += len(line)
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('t') == 'k':
+                    self._keyword_ids[entry['s']] = len(self._keywords)
+                    self._keywords.append(entry['s'])
+                elif entry.get('t') == 'p':
+                    self._latest[entry['email']] = len(self._people)
+                    self._people.append((entry['name'], entry['email'], tuple(entry['kw'])))
+        self._size = pos
+
+    @_synchronized('_lock')
+    def refresh(self):
+        """讀取其他程式附加的項目 (檔案未變大時只需一次 stat)
+
+        新增 ID 前必須在跨程序檔案鎖內呼叫, 才不會與其他程式配發相同的 ID。
+        """
+        if self._people is None:
+            return
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if size > self._size:
+            self._read_from(self._size)
+
+    @_synchronized('_lock')
+    def keyword_id(self, keyword):
+        """取得關鍵字 ID, 不存在時新增"""
+        self._ensure_loaded()
+        kid = self._keyword_ids.get(keyword)
+        if kid is None:
+            kid = len(self._keywords)
+            self._keyword_ids[keyword] = kid
+            self._keywords.append(keyword)
+            self._pending.append({'t': 'k', 'id': kid, 's': keyword})
+        return kid
+
+    @_synchronized('_lock')
+    def person_id(self, name, email, keywords=None):
+        """取得參與者版本 ID, 與最新版本不同時新增版本
+
+        Args:
+            keywords: 參與者擁有的關鍵字; None 表示不在意 (沿用最新版本)
+        """
+        self._ensure_loaded()
+        latest = self._latest.get(email)
+        if latest is not None:
+            latest_name, _, latest_kw = self._people[latest]
+            if latest_name == name and (
+                    keywords is None or latest_kw == tuple(self.keyword_id(k) for k in keywords)):
+                return latest
+
+        kw = tuple(self.keyword_id(k) for k in keywords or [])
+        pid = len(self._people)
+        self._people.append((name, email, kw))
+        self._latest[email] = pid
+        self._pending.append({'t': 'p', 'id': pid, 'name': name, 'email': email, 'kw': list(kw)})
+        return pid
+
+    @_synchronized('_lock')
+    def person_ids(self, people):
+        """批次取得多位參與者 ({name, email}) 的版本 ID, 不在意關鍵字 (只取得一次鎖)"""
+        self._ensure_loaded()
+        latest, versions = self._latest, self._people
+        ids = []
+        for p in people:
+            pid = latest.get(p['email'])
+            if pid is None or versions[pid][0] != p['name']:
+                pid = self.person_id(p['name'], p['email'])
+            ids.append(pid)
+        return ids
+
+    @_synchronized('_lock')
+    def commit(self):
+        """將新增的項目寫入檔案 (必須在引用它們的歷史記錄寫入之前呼叫)"""
+        if not self._pending:
+            return
+        with open(self.path, 'ab') as f:
+            for entry in self._pending:
+                f.write((json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+                        .encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+            self._size = f.tell()
+        self._pending = []
+
+    @_synchronized('_lock')
+    def person(self, pid):
+        """取得參與者版本的 dict"""
+        self._ensure_loaded()
+        if pid >= len(self._people):
+            self.refresh()  # 其他程式新增的版本
+        name, email, kw = self._people[pid]
+        return {'name': name, 'email': email, 'keywords': [self.keyword(k) for k in kw]}
+
+    @_synchronized('_lock')
+    def people(self, pids):
+        """批次取得參與者版本的 {name, email} (不含關鍵字)"""
+        self._ensure_loaded()
+        if pids and max(pids) >= len(self._people):
+            self.refresh()
+        versions = self._people
+        return [{'name': versions[pid][0], 'email': versions[pid][1]} for pid in pids]
+
+    @_synchronized('_lock')
+    def keyword(self, kid):
+        self._ensure_loaded()
+        if kid >= len(self._keywords):
+            self.refresh()
+        return self._keywords[kid]
+
+
+class HistoryCodec:
+    """歷史記錄正規化編解碼 (版本 2)
+
+    - 禮物抽籤: selected 由參與者 dict 清單改為參與者版本 ID 清單
+    - 關鍵字抽籤: results 由 {email: {...}} 改為 [[版本 ID, [關鍵字 ID...]], ...]
+    沒有版本欄位的舊記錄原樣讀取。
+    """
+
+    VERSION = 2
+
+    def __init__(self, table):
+        self.table = table
+
+    def encode_draw(self, record):
+        self.table.refresh()
+        stored = dict(record, v=self.VERSION)
+        stored['selected'] = [self.table.person_id(p['name'], p['email'], p.get('keywords', []))
+                              for p in record['selected']]
+        self.table.commit()
+        return stored
+
+    def decode_draw(self, stored):
+        if stored.get('v') != self.VERSION:
+            return stored
+        record = dict(stored)
+        del record['v']
+        record['selected'] = [self.table.person(pid) for pid in stored['selected']]
+        return record
+
+    def encode_keyword(self, record):
+        self.table.refresh()
+        stored = dict(record, v=self.VERSION)
+        results = record['results'].values()
+        stored['results'] = [
+            [pid, [self.table.keyword_id(k) for k in data['keywords']]]
+            for pid, data in zip(self.table.person_ids(results), results)
+        ]
+        self.table.commit()
+        return stored
+
+    def decode_keyword(self, stored):
+        if stored.get('v') != self.VERSION:
+            return stored
+        record = dict(stored)
+        del record['v']
+        results = {}
+        for pid, kids in stored['results']:
+            person = self.table.person(pid)
+            results[person['email']] = {
+                'name': person['name'],
+                'email': person['email'],
+                'keywords': [self.table.keyword(k) for k in kids]
+            }
+        record['results'] = results
+        return record
+
+    def encode_teams(self, record):
+        self.table.refresh()
+        stored = dict(record, v=self.VERSION)
+        stored['teams'] = [self.table.person_ids(team['members']) for team in record['teams']]
+        self.table.commit()
+        return stored
+
+    def decode_teams(self, stored):
+        if stored.get('v') != self.VERSION:
+            return stored
+        record = dict(stored)
+        del record['v']
+        record['teams'] = [{'team': number, 'members': self.table.people(pids)}
+                           for number, pids in enumerate(stored['teams'], 1)]
+        return record
+
+
+class HistoryArchive:
+    """歷史記錄封存區 - 依期間 (月/年) 分段的唯讀 JSON Lines 檔, 可用 gzip / lzma 壓縮
+
+    manifest 記錄每個分段的期間、起始記錄編號、筆數、時間範圍與壓縮方式,
+    封存區的記錄編號接續在熱檔 (HistoryStore 的資料檔) 之前, 封存後編號不變。
+    讀取壓縮分段時整段解壓縮, 並快取最近使用的分段。
+    """
+
+    CODECS = {
+        None: (open, '.jsonl'),
+        'gzip': (gzip.open, '.jsonl.gz'),
+        'lzma': (lzma.open, '.jsonl.xz'),
+    }
+    _CACHE_SIZE = 2
+
+    def __init__(self, path):
+        """
+        Args:
+            path: 熱檔路徑, 分段與 manifest 存放在同目錄的 history_archive/ 下
+        """
+        self.directory = os.path.join(os.path.dirname(path), 'history_archive')
+        self.stem = os.path.basename(path).rsplit('.jsonl', 1)[0]
+        self.manifest_path = os.path.join(self.directory, self.stem + '.manifest.json')
+        self.segments = []  # [{file, period, start, count, first, last, codec, size}, ...]
+        self.pending = None  # 封存途中的熱檔暫存檔 (當機後開啟時完成取代)
+        self._starts = []
+        self._cache = deque(maxlen=self._CACHE_SIZE)  # [(分段檔名, 各行資料), ...]
+        self.load()
+
+    def load(self):
+        self.segments, self.pending = [], None
+        if os.path.exists(self.manifest_path):
+            try:
+                with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.segments = data.get('segments', [])
+                self.pending = data.get('pending')
+            except Exception as e:
+                print(f"載入歷史封存清單失敗: {e}")
+        self._starts = [seg['start'] for seg in self.segments]
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        data = {'segments': self.segments}
+        if self.pending:
+            data['pending'] = self.pending
+        atomic_write_text(self.manifest_path, json.dumps(data, ensure_ascii=False, indent=2))
+        self._starts = [seg['start'] for seg in self.segments]
+
+    @property
+    def count(self):
+        """封存的記錄總數 (也是熱檔第一筆的記錄編號)"""
+        last = self.segments[-1] if self.segments else None
+        return last['start'] + last['count'] if last else 0
+
+    # ========== 讀取 ==========
+
+    def _lines(self, seg):
+        for name, lines in self._cache:
+            if name == seg['file']:
+                return lines
+        opener = self.CODECS[seg.get('codec')][0]
+        with opener(os.path.join(self.directory, seg['file']), 'rb') as f:
+            lines = [line for line in f.read().splitlines() if line.strip()]
+        self._cache.append((seg['file'], lines))
+        return lines
+
+    def _segment_of(self, number):
+        return bisect.bisect_right(self._starts, number) - 1
+
+    def read_lines(self, start, stop):
+        """讀取第 start 到 stop-1 筆記錄的原始行"""
+        lines = []
+        pos = self._segment_of(start)
+        while start < stop and pos < len(self.segments):
+            seg = self.segments[pos]
+            end = min(stop, seg['start'] + seg['count'])
+            lines.extend(self._lines(seg)[start - seg['start']:end - seg['start']])
+            start = end
+            pos += 1
+        return lines
+
+    def read_line(self, number):
+        seg = self.segments[self._segment_of(number)]
+        return self._lines(seg)[number - seg['start']]
+
+    # ========== 寫入 ==========
+
+    def write_segment(self, period, start, lines, codec='gzip'):
+        """寫入一個分段檔並登記到 manifest (需另外呼叫 save)
+
+        Args:
+            period: 期間 (例如 "2024-12")
+            start: 第一筆的記錄編號
+            lines: 各行原始資料 (bytes, 含換行)
+            codec: None / 'gzip' / 'lzma'
+        """
+        opener, ext = self.CODECS[codec]
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"{self.stem}.{period}.{start:08d}{ext}"
+        path = os.path.join(self.directory, name)
+        tmp_path = path + '.tmp'
+        with opener(tmp_path, 'wb') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, path)
+        first, last = (json.loads(lines[i]).get('timestamp', '') for i in (0, -1))
+        self.segments.append({
+            'file': name, 'period': period, 'start': start, 'count': len(lines),
+            'first': first, 'last': last, 'codec': codec, 'size': os.path.getsize(path)
+        })
+        return name
+
+    def compact(self, codec='gzip'):
+        """合併同一期間的相鄰分段, 並以指定壓縮方式重新寫入
+
+        Returns:
+            int: 重新寫入的分段數
+        """
+        groups = []
+        for seg in self.segments:
+            if groups and groups[-1][-1]['period'] == seg['period']:
+                groups[-1].append(seg)
+            else:
+                groups.append([seg])
+
+        old_files = [seg['file'] for seg in self.segments]
+        rewritten = 0
+        segments = []
+        for group in groups:
+            if len(group) == 1 and group[0].get('codec') == codec:
+                segments.append(group[0])
+                continue
+            lines = [line + b'\n' for seg in group for line in self._lines(seg)]
+            self.segments = []
+            self.write_segment(group[0]['period'], group[0]['start'], lines, codec)
+            segments.extend(self.segments)
+            rewritten += 1
+
+        self.segments = segments
+        self.save()
+        kept = {seg['file'] for seg in segments}
+        for name in old_files:
+            if name not in kept:
+                os.remove(os.path.join(self.directory, name))
+        self._cache.clear()
+        return rewritten
+
+    def clear(self):
+        """刪除所有分段與 manifest"""
+        for seg in self.segments:
+            path = os.path.join(self.directory, seg['file'])
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        self.segments, self.pending, self._starts = [], None, []
+        self._cache.clear()
+
+
+class HistoryStore:
+    """歷史記錄儲存 - JSON Lines 檔案搭配位移索引, 延遲開啟
+
+    - 建立時不讀取檔案, 第一次存取時才開啟
+    - 記憶體只保留最後 tail_size 筆 (供畫面顯示)
+    - 較舊的記錄依位移索引 (.idx) 按需從磁碟讀取
+    - 新增記錄只附加一行, 不再重寫整個檔案
+
+    位移索引為 uint64 陣列: [已索引的資料結尾, 第 0 筆位移, 第 1 筆位移, ...]。
+    索引落後於資料檔 (例如寫入途中當機) 時, 開啟時只掃描未索引的部分。
+    行為類似唯讀清單: 支援 len、索引、切片、迭代與倒序迭代。
+
+    rotate() 將前幾個期間的記錄移到 HistoryArchive 的壓縮分段, 熱檔只保留目前期間;
+    記錄編號涵蓋封存區與熱檔, 讀取時自動跨分段。
+    """
+
+    _CHUNK = 500  # 串流讀取時每次讀取的筆數
+
+    def __init__(self, path, legacy_path=None, tail_size=200, encode=None, decode=None,
+                 file_lock=None):
+        """
+        Args:
+            path: JSON Lines 資料檔路徑
+            legacy_path: 舊版 JSON 陣列格式的檔案, 第一次開啟時自動轉換
+            tail_size: 記憶體中保留的最近記錄筆數
+            encode: 寫入前轉換記錄的函式 (例如 HistoryCodec 正規化)
+            decode: 讀取後還原記錄的函式
+            file_lock: 與其他程序共用資料檔時的 FileLock (寫入與重新索引時持有)
+        """
+        self.path = path
+        self._encode = encode or (lambda record: record)
+        self._decode = decode or (lambda stored: stored)
+        self.indexes = []     # 新增/清空記錄時同步更新的次要索引 (HistoryIndex)
+        self.index_path = path + '.idx'
+        self.legacy_path = legacy_path
+        self.tail_size = tail_size
+        self._offsets = None  # 每筆記錄的起始位移, 開啟後才載入
+        self._end = 0         # 已索引的資料結尾位移
+        self._tail = None     # 最近 tail_size 筆記錄
+        self.archive = None   # 封存分段, 開啟後才載入
+        self._base = 0        # 熱檔第一筆的記錄編號 (= 封存筆數)
+        self.lock = threading.RLock()  # 讀取、附加與封存互斥 (索引與統計也以此鎖保護)
+        self.file_lock = file_lock or contextlib.nullcontext()
+        self._stamp = None           # 上次同步時資料檔的戳記
+        self._manifest_stamp = None  # 上次同步時封存 manifest 的戳記
+
+    # ========== 開啟與索引 ==========
+
+    def _ensure_open(self):
+        if self._offsets is not None:
+            return
+        with self.file_lock:
+            self._migrate_legacy()
+            self.archive = HistoryArchive(self.path)
+            self._finish_rotation()
+            self._base = self.archive.count
+
+            self._offsets = array('Q')
+            self._end = 0
+            size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+            if os.path.exists(self.index_path):
+                data = array('Q')
+                with open(self.index_path, 'rb') as f:
+                    data.frombytes(f.read())
+                if data and data[0] <= size:
+                    covered = data[0]
+                    self._offsets = array('Q', (off for off in data[1:] if off < covered))
+                    self._end = covered
+
+            if self._end < size:
+                self._scan_from(self._end)
+                self._write_index()
+            self._remember_stamps()
+
+    def _remember_stamps(self):
+        self._stamp = file_stamp(self.path)
+        self._manifest_stamp = file_stamp(self.archive.manifest_path)
+
+    def _sync(self):
+        """偵測其他程式的寫入 (沒有變更時只需兩次 stat)
+
+        只有附加時補上新記錄的位移; 熱檔被取代 (封存、清空) 時重新開啟。
+        次要索引與統計依記錄編號在下次使用時補上差距。
+        """
+        if self._stamp == file_stamp(self.path) and \
+                self._manifest_stamp == file_stamp(self.archive.manifest_path):
+            return
+        with self.file_lock:
+            stamp = file_stamp(self.path)
+            manifest_stamp = file_stamp(self.archive.manifest_path)
+            appended = (stamp and self._stamp and stamp[0] == self._stamp[0]
+                        and stamp[1] >= self._end and manifest_stamp == self._manifest_stamp)
+            if appended:
+                self._scan_from(self._end)
+                self._stamp = stamp
+            else:
+                self._offsets = None
+                self._ensure_open()
+            self._tail = None
+
+    def _migrate_legacy(self):
+        """將舊版 JSON 陣列格式的歷史記錄轉換為 JSON Lines"""
+        if not self.legacy_path or os.path.exists(self.path) or not os.path.exists(self.legacy_path):
+            return
+        try:
+            with open(self.legacy_path, 'r', encoding='utf-8') as f:
+                records = json.load(f)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for record in records:
+                    f.write(self._dumps(self._encode(record)))
+            os.replace(tmp_path, self.path)
+            os.replace(self.legacy_path, self.legacy_path + '.bak')
+        except Exception as e:
+            print(f"轉換舊版歷史記錄失敗: {e}")
+
+    def _scan_from(self, pos):
+        """從指定位移開始掃描資料檔, 補上未索引的記錄"""
+        with open(self.path, 'r+b') as f:
+            f.seek(pos)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # 寫入途中中斷的殘缺行, 截斷以免污染之後的附加
+                    f.truncate(pos)
+                    break
+                if line.strip():
+                    self._offsets.append(pos)
+                pos += len(line)
+        self._end = pos
+
+    def _write_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(array('Q', [self._end]).tobytes())
+            f.write(self._offsets.tobytes())
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def _dumps(record):
+        return json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+    # ========== 讀取 ==========
+
+    def _read_range(self, start, stop):
+        """讀取第 start 到 stop-1 筆記錄"""
+        if start >= stop:
+            return []
+        decode = self._decode
+        records = []
+        if start < self._base:
+            lines = self.archive.read_lines(start, min(stop, self._base))
+            records.extend(decode(json.loads(line)) for line in lines)
+            start = self._base
+        if start < stop:
+            start, stop = start - self._base, stop - self._base
+            begin = self._offsets[start]
+            end = self._offsets[stop] if stop < len(self._offsets) else self._end
+            with open(self.path, 'rb') as f:
+                f.seek(begin)
+                data = f.read(end - begin)
+            records.extend(decode(json.loads(line)) for line in data.splitlines() if line.strip())
+        return records
+
+    @_synchronized('lock')
+    def __len__(self):
+        self._ensure_open()
+        self._sync()
+        return self._base + len(self._offsets)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __getitem__(self, index):
+        count = len(self)
+        if isinstance(index, slice):
+            start, stop, step = index.indices(count)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return self.page(start, stop)
+        if index < 0:
+            index += count
+        if not 0 <= index < count:
+            raise IndexError('history index out of range')
+        return self.page(index, index + 1)[0]
+
+    @_synchronized('lock')
+    def page(self, start, stop):
+        """取得第 start 到 stop-1 筆記錄 (落在記憶體視窗內時不讀磁碟)"""
+        count = len(self)
+        start, stop = max(0, start), min(stop, count)
+        tail = self._load_tail()
+        tail_start = count - len(tail)
+        if start >= tail_start:
+            return list(tail)[start - tail_start:stop - tail_start]
+        return self._read_range(start, stop)
+
+    def _load_tail(self):
+        if self._tail is None:
+            count = len(self)
+            self._tail = deque(self._read_range(max(0, count - self.tail_size), count),
+                               maxlen=self.tail_size)
+        return self._tail
+
+    @_synchronized('lock')
+    def tail(self, n=None):
+        """取得記憶體中最近的記錄 (舊到新)"""
+        records = list(self._load_tail())
+        return records if n is None else records[-n:]
+
+    def __iter__(self):
+        count = len(self)
+        for start in range(0, count, self._CHUNK):
+            yield from self.page(start, min(start + self._CHUNK, count))
+
+    def __reversed__(self):
+        stop = len(self)
+        while stop > 0:
+            start = max(0, stop - self._CHUNK)
+            yield from reversed(self.page(start, stop))
+            stop = start
+
+    # ========== 寫入 ==========
+
+    @_synchronized('lock')
+    def append(self, record):
+        """附加一筆記錄 (持有跨程序檔案鎖, 先同步其他程式的寫入)"""
+        with self.file_lock:
+            self._ensure_open()
+            self._sync()
+            line = self._dumps(self._encode(record)).encode('utf-8')
+            with open(self.path, 'ab') as f:
+                offset = f.tell()
+                if offset != self._end:
+                    # 資料檔在索引之後被其他程式附加過, 先補上索引
+                    self._scan_from(self._end)
+                    offset = self._end
+                    self._tail = None
+                f.write(line)
+            self._offsets.append(offset)
+            self._end = offset + len(line)
+
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'r+b') as f:
+                    f.seek(0, os.SEEK_END)
+                    f.write(array('Q', [offset]).tobytes())
+                    f.seek(0)
+                    f.write(array('Q', [self._end]).tobytes())
+            else:
+                self._write_index()
+            self._stamp = file_stamp(self.path)
+
+        if self._tail is not None:
+            # 快取實際寫入的內容 (而非呼叫端的物件), 呼叫端之後修改記錄不會影響已保存的歷史
+            self._tail.append(self._decode(json.loads(line)))
+
+        number = self._base + len(self._offsets) - 1
+        for index in self.indexes:
+            index.add(number, record)
+        return number
+
+    @_synchronized('lock')
+    def read_many(self, numbers):
+        """依記錄編號讀取多筆記錄 (只開啟一次檔案)"""
+        count = len(self)
+        tail = self._load_tail()
+        tail_start = count - len(tail)
+        decode = self._decode
+        records = []
+        with open(self.path, 'rb') if numbers else contextlib.nullcontext() as f:
+            for number in numbers:
+                if number >= tail_start:
+                    records.append(tail[number - tail_start])
+                    continue
+                if number < self._base:
+                    records.append(decode(json.loads(self.archive.read_line(number))))
+                    continue
+                f.seek(self._offsets[number - self._base])
+                records.append(decode(json.loads(f.readline())))
+        return records
+
+    @_synchronized('lock')
+    def clear(self):
+        """刪除所有記錄 (包含封存分段)"""
+        self._ensure_open()
+        with self.file_lock:
+            for path in (self.path, self.index_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            self.archive.clear()
+            self._remember_stamps()
+        self._base = 0
+        self._offsets = array('Q')
+        self._end = 0
+        self._tail = None
+        for index in self.indexes:
+            index.clear()
+
+    # ========== 封存 ==========
+
+    @staticmethod
+    def period_of(timestamp, period='month'):
+        """取得時間戳記所屬期間: 'month' -> "2024-12", 'year' -> "2024" """
+        return timestamp[:7] if period == 'month' else timestamp[:4]
+
+    @_synchronized('lock')
+    def rotate(self, period='month', codec='gzip', current=None):
+        """將目前期間之前的記錄移到封存分段, 每個期間一個分段
+
+        Args:
+            period: 'month' 或 'year'
+            codec: 分段壓縮方式 None / 'gzip' / 'lzma'
+            current: 目前期間 (預設依現在時間), 此期間及之後的記錄留在熱檔
+
+        Returns:
+            int: 封存的記錄筆數
+        """
+        self._ensure_open()
+        with self.file_lock:
+            self._sync()
+            if current is None:
+                current = self.period_of(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), period)
+
+            with open(self.path, 'rb') if self._offsets else contextlib.nullcontext() as f:
+                data = f.read(self._end) if f else b''
+            lines = [line + b'\n' for line in data.splitlines() if line.strip()]
+
+            # 只封存開頭連續屬於較早期間的記錄, 保持記錄編號連續
+            groups = []
+            moved = 0
+            for line in lines:
+                stamp = json.loads(line).get('timestamp', '')
+                key = self.period_of(stamp, period)
+                if not stamp or key >= current:
+                    break
+                if groups and groups[-1][0] == key:
+                    groups[-1][1].append(line)
+                else:
+                    groups.append((key, [line]))
+                moved += 1
+            if not moved:
+                return 0
+
+            start = self._base
+            for key, group in groups:
+                self.archive.write_segment(key, start, group, codec)
+                start += len(group)
+
+            # manifest 為提交點: 先寫好新的熱檔暫存檔, 再登記分段與待完成的取代
+            tmp_path = self.path + '.rotate.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.writelines(lines[moved:])
+                f.flush()
+                os.fsync(f.fileno())
+            self.archive.pending = os.path.basename(tmp_path)
+            self.archive.save()
+            self._finish_rotation()
+
+            self._base = self.archive.count
+            self._offsets = array('Q')
+            self._end = 0
+            self._scan_from(0)
+            self._write_index()
+            self._remember_stamps()
+            return moved
+
+    def _finish_rotation(self):
+        """完成 manifest 已提交的熱檔取代 (封存途中當機時於開啟時補做)"""
+        if not self.archive.pending:
+            return
+        tmp_path = os.path.join(os.path.dirname(self.path), self.archive.pending)
+        if os.path.exists(self.index_path):
+            os.remove(self.index_path)
+        if os.path.exists(tmp_path):
+            os.replace(tmp_path, self.path)
+        self.archive.pending = None
+        self.archive.save()
+
+    @property
+    def is_open(self):
+        return self._offsets is not None
+
+    @property
+    def hot_count(self):
+        """熱檔中的記錄筆數"""
+        with self.lock:
+            self._ensure_open()
+            return len(self._offsets)
+
+    @_synchronized('lock')
+    def compact_archive(self, codec='gzip'):
+        """合併同期間的封存分段並改用指定壓縮方式"""
+        self._ensure_open()
+        with self.file_lock:
+            self._sync()
+            rewritten = self.archive.compact(codec)
+            self._remember_stamps()
+        return rewritten
+
+    @_synchronized('lock')
+    def archive_info(self):
+        """取得封存狀態: 分段清單、封存筆數與熱檔筆數"""
+        self._ensure_open()
+        return {
+            'segments': list(self.archive.segments),
+            'archived': self._base,
+            'hot': len(self._offsets),
+            'hot_size': self._end,
+        }
+
+
+class HistoryIndex:
+    """歷史記錄的次要索引 - 依郵箱、模式與時間查詢
+
+    - 郵箱 -> 記錄編號清單 (支援完整郵箱或前綴, 例如 "alice@")
+    - 模式 -> 記錄編號清單
+    - 記錄編號 -> 時間戳記 (時間遞增時以二分搜尋取得時間區間)
+
+    第一次查詢時掃描一次歷史記錄建立索引, 之後隨 HistoryStore.append 增量更新。
+    關閉時寫入 .qidx 檔, 下次只需補上新增的記錄。
+    """
+
+    def __init__(self, store, emails_of):
+        """
+        Args:
+            store: 要建立索引的 HistoryStore
+            emails_of: 由記錄取得相關郵箱的函式
+        """
+        self.store = store
+        self.lock = store.lock
+        self.path = store.path + '.qidx'
+        self._emails_of = emails_of
+        self._built = False
+        self._dirty = False
+        store.indexes.append(self)
+        self._reset()
+
+    def _reset(self):
+        self.count = 0          # 已建立索引的記錄數
+        self.by_email = {}      # email -> [記錄編號]
+        self.by_mode = {}       # mode -> [記錄編號]
+        self.timestamps = []    # 記錄編號 -> 時間戳記
+        self.monotonic = True   # 時間戳記是否隨記錄編號遞增
+        self._sorted_emails = None
+
+    def _ensure_built(self):
+        if self._built:
+            # 補上其他程式附加的記錄; 記錄變少 (被清空) 時重建
+            stop = len(self.store)
+            if self.count <= stop:
+                if self.count < stop:
+                    self._catch_up(stop)
+                return
+        self._built = True
+        self._reset()
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('count', 0) <= len(self.store):
+                    self.count = data['count']
+                    self.by_email = data['by_email']
+                    self.by_mode = data['by_mode']
+                    self.timestamps = data['timestamps']
+                    self.monotonic = data['monotonic']
+        except Exception as e:
+            print(f"載入歷史索引失敗: {e}")
+            self._reset()
+        self._catch_up(len(self.store))
+
+    def _catch_up(self, stop):
+        """為第 count 到 stop-1 筆記錄建立索引"""
+        for number, record in enumerate(self.store.page(self.count, stop), self.count):
+            self._index(number, record)
+
+    def _index(self, number, record):
+        for email in set(self._emails_of(record)):
+            self.by_email.setdefault(email, []).append(number)
+            self._sorted_emails = None
+        self.by_mode.setdefault(record.get('mode', ''), []).append(number)
+        timestamp = record.get('timestamp', '')
+        if self.timestamps and timestamp < self.timestamps[-1]:
+            self.monotonic = False
+        self.timestamps.append(timestamp)
+        self.count = number + 1
+        self._dirty = True
+
+    def add(self, number, record):
+        """HistoryStore 新增記錄時呼叫"""
+        if not self._built:
+            return  # 尚未建立, 之後建立時會一併掃描
+        if number > self.count:
+            self._catch_up(number)
+        if number == self.count:
+            self._index(number, record)
+
+    def clear(self):
+        self._reset()
+        self._built = True
+        self._dirty = False
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @_synchronized('lock')
+    def save(self):
+        """寫入索引檔 (有變更時)"""
+        if not self._dirty:
+            return
+        try:
+            atomic_write_text(self.path, json.dumps({
+                'count': self.count,
+                'by_email': self.by_email,
+                'by_mode': self.by_mode,
+                'timestamps': self.timestamps,
+                'monotonic': self.monotonic
+            }, ensure_ascii=False, separators=(',', ':')))
+            self._dirty = False
+        except OSError as e:
+            print(f"儲存歷史索引失敗: {e}")
+
+    # ========== 查詢 ==========
+
+    def _email_postings(self, email):
+        if email in self.by_email:
+            return self.by_email[email]
+        # 前綴查詢: 在排序後的郵箱清單中二分搜尋
+        if self._sorted_emails is None:
+            self._sorted_emails = sorted(self.by_email)
+        keys = self._sorted_emails
+        numbers = set()
+        for i in range(bisect.bisect_left(keys, email), len(keys)):
+            if not keys[i].startswith(email):
+                break
+            numbers.update(self.by_email[keys[i]])
+        return sorted(numbers)
+
+    def _time_range(self, since, until):
+        """以時間區間篩選, 回傳 (起始編號, 結束編號) 或符合的編號集合"""
+        # until 只給日期時包含整天
+        until = until + '\uffff' if until else None
+        if self.monotonic:
+            lo = bisect.bisect_left(self.timestamps, since) if since else 0
+            hi = bisect.bisect_right(self.timestamps, until) if until else self.count
+            return range(lo, hi)
+        return {n for n, ts in enumerate(self.timestamps)
+                if (not since or ts >= since) and (not until or ts <= until)}
+
+    @_synchronized('lock')
+    def search(self, email=None, mode=None, since=None, until=None):
+        """查詢符合條件的記錄編號 (由舊到新)
+
+        Args:
+            email: 完整郵箱或郵箱前綴
+            mode: 通知模式
+            since / until: 時間區間 (字串比較, 可只給日期如 "2025-12" 或 "2025-12-24")
+        """
+        self._ensure_built()
+        candidates = None
+        if email:
+            candidates = self._email_postings(email)
+        if mode:
+            postings = self.by_mode.get(mode, [])
+            candidates = postings if candidates is None else \
+                sorted(set(candidates).intersection(postings))
+        if since or until:
+            window = self._time_range(since, until)
+            if candidates is None:
+                candidates = sorted(window) if isinstance(window, set) else list(window)
+            else:
+                candidates = [n for n in candidates if n in window]
+        if candidates is None:
+            candidates = range(self.count)
+        return candidates
+
+
+# ========== 郵件範本 ==========
+
+# 內建範本 (mail_templates.json 不存在或缺少某類範本時使用)
+DEFAULT_MAIL_TEMPLATES = {
+    'draw': {
+        'subject': '抽籤通知',
+        'text': """您好 $name,
+
+恭喜您在本次抽籤中被抽中!
+
+抽籤時間: $timestamp
+
+此郵件由抽籤系統自動傳送。
+""",
+        'html': ''
+    },
+    'keyword': {
+        'subject': '關鍵字抽籤通知',
+        'text': """您好 $name,
+
+恭喜您在本次關鍵字抽籤中抽到以下關鍵字:
+
+$keywords
+
+抽籤時間: $timestamp
+
+此郵件由抽籤系統自動傳送。
+""",
+        'html': ''
+    },
+    'team': {
+        'subject': '分組通知',
+        'text': """您好 $name,
+
+您被分到第 $team 組 (共 $team_count 組, 本組 $team_size 人)。
+
+分組時間: $timestamp
+
+此郵件由抽籤系統自動傳送。
+""",
+        'html': ''
+    },
+    'test': {
+        'subject': '抽籤系統 - 測試郵件',
+        'text': """這是一封測試郵件。
+
+如果您收到此郵件,說明 SMTP 設定正確。
+
+此郵件由抽籤系統自動傳送。
+""",
+        'html': ''
+    },
+}
+
+# 各類範本可用的欄位
+MAIL_TEMPLATE_FIELDS = {
+    'draw': ('name', 'email', 'timestamp'),
+    'keyword': ('name', 'email', 'timestamp', 'keywords', 'keyword1', 'keyword2', 'keyword_count'),
+    'team': ('name', 'email', 'timestamp', 'team', 'team_count', 'team_size', 'teammates'),
+    'test': ('email', 'timestamp'),
+}
+
+# 預覽用的範例資料
+MAIL_TEMPLATE_SAMPLE = {
+    'name': '王小明', 'email': 'xiaoming@example.com', 'timestamp': '2025-12-24 20:00:00',
+    'keywords': ['咖啡', '文具'],
+    'team': {'team': 3, 'team_count': 8, 'team_size': 3, 'teammates': '王小明\n李小華\n陳大文'},
+}
+
+
+class MailTemplate:
+    """郵件範本 - 以 $name 或 ${name} 標記欄位 ($$ 為 $ 字元)
+
+    建立時解析一次為「文字片段 / 欄位」清單, 套用時只需串接字串。
+    """
+
+    def __init__(self, source, fields):
+        """
+        Args:
+            source: 範本內容
+            fields: 允許使用的欄位名稱
+
+        Raises:
+            ValueError: 範本含有未知欄位或無效的 $ 用法
+        """
+        self.source = source
+        self.literals = ['']
+        self.fields = []
+        pos = 0
+        for match in string.Template.pattern.finditer(source):
+            self.literals[-1] += source[pos:match.start()]
+            pos = match.end()
+            if match.group('escaped') is not None:
+                self.literals[-1] += '$'
+                continue
+            name = match.group('named') or match.group('braced')
+            if name is None:
+                raise ValueError(f"範本第 {source.count(chr(10), 0, match.start()) + 1} 行有無效的 $ 用法")
+            if name not in fields:
+                raise ValueError(f"未知的欄位: ${name} (可用: {', '.join(fields)})")
+            self.fields.append(name)
+            self.literals.append('')
+        self.literals[-1] += source[pos:]
+
+    def render(self, values):
+        parts = [self.literals[0]]
+        for field, literal in zip(self.fields, self.literals[1:]):
+            parts.append(values[field])
+            parts.append(literal)
+        return ''.join(parts)
+
+
+def _encode_header(value, header_name=None):
+    """編碼郵件標頭 (非 ASCII 時使用 RFC 2047, 折行一律使用 CRLF)"""
+    try:
+        value.encode('ascii')
+        return value
+    except UnicodeEncodeError:
+        return Header(value, 'utf-8', header_name=header_name).encode(linesep='\r\n')
+
+
+def _encode_address(value):
+    """編碼收件人地址, 回傳 (標頭文字, 信封郵箱)
+
+    姓名以 RFC 2047 編碼, 非 ASCII 網域轉為 IDNA (punycode);
+    郵箱本身 (@ 之前) 含非 ASCII 字元時原樣保留, 傳送時再回報該收件人失敗。
+    """
+    name, addr = parseaddr(value)
+    addr = addr or value
+    local, at, domain = addr.rpartition('@')
+    if at and not domain.isascii():
+        try:
+            addr = f"{local}@{domain.encode('idna').decode('ascii')}"
+        except UnicodeError:
+            pass
+    header = f"{_encode_header(name)} <{addr}>" if name else addr
+    return header, addr
+
+
+def _base64_body(text):
+    return base64.encodebytes(text.encode('utf-8')).replace(b'\n', b'\r\n')
+
+
+class PreparedMail:
+    """已產生好的郵件 (原始位元組), 可直接交給 SMTP 連線傳送"""
+
+    __slots__ = ('from_addr', 'to_addr', 'data')
+
+    def __init__(self, from_addr, to_addr, data):
+        self.from_addr = from_addr
+        self.to_addr = to_addr
+        self.data = data
+
+    def send(self, server):
+        if not self.to_addr.isascii():
+            # 在送出 MAIL FROM 之前拒絕, 連線不會停在未完成的交易中
+            raise ValueError(f"收件人郵箱含非 ASCII 字元, SMTP 伺服器無法傳送: {self.to_addr}")
+        server.sendmail(self.from_addr, [self.to_addr], self.data)
+
+    def as_message(self):
+        """轉為 email.message.Message (預覽或檢查用)"""
+        return message_from_bytes(self.data)
+
+
+class MailBatch:
+    """同一批郵件的共用骨架 - 固定的標頭、MIME 分隔線與各部分標頭只產生一次
+
+    每位收件人只需套用範本並以 base64 編碼正文。
+    """
+
+    _PART_HEADER = ('Content-Type: text/{subtype}; charset="utf-8"\r\n'
+                    'MIME-Version: 1.0\r\n'
+                    'Content-Transfer-Encoding: base64\r\n\r\n')
+
+    def __init__(self, from_addr, subject, text, html_body=None):
+        """
+        Args:
+            from_addr: 寄件人
+            subject / text / html_body: 已編譯的 MailTemplate (html_body 可為 None)
+        """
+        self.from_addr = parseaddr(from_addr)[1] or from_addr  # 信封寄件人只用郵箱
+        self.subject = subject
+        self.text = text
+        self.html = html_body
+        boundary = f"{'=' * 15}{uuid.uuid4().hex}=="
+        subtype = 'alternative' if html_body else 'mixed'
+        self._domain = self.from_addr.rpartition('@')[2] or 'localhost'  # 避免 make_msgid 查詢主機名稱
+        self._head = (f"From: {formataddr(parseaddr(from_addr))}\r\n"
+                      f"MIME-Version: 1.0\r\n"
+                      f'Content-Type: multipart/{subtype}; boundary="{boundary}"\r\n').encode('ascii')
+        self._text_part = (f"\r\n--{boundary}\r\n" + self._PART_HEADER.format(subtype='plain')).encode('ascii')
+        self._html_part = (f"--{boundary}\r\n" + self._PART_HEADER.format(subtype='html')).encode('ascii')
+        self._tail = f"--{boundary}--\r\n".encode('ascii')
+        # 主旨沒有欄位時只編碼一次
+        self._fixed_subject = None if subject.fields else \
+            f"Subject: {_encode_header(subject.render({}), 'Subject')}\r\n".encode('ascii')
+
+    def render(self, to_addr, values):
+        """產生一位收件人的郵件"""
+        subject = self._fixed_subject or \
+            f"Subject: {_encode_header(self.subject.render(values), 'Subject')}\r\n".encode('ascii')
+        to_header, to_addr = _encode_address(to_addr)
+        # 郵箱含非 ASCII 字元時以 UTF-8 寫入標頭 (RFC 6532), 不在產生郵件時中斷整批
+        # 骨架可能被快取很久, 日期與 Message-ID 每封郵件各自產生
+        stamp = f"Date: {formatdate(localtime=True)}\r\nMessage-ID: {make_msgid(domain=self._domain)}\r\n"
+        parts = [self._head, stamp.encode('ascii'), f"To: {to_header}\r\n".encode('utf-8'), subject,
+                 self._text_part, _base64_body(self.text.render(values))]
+        if self.html:
+            escaped = {key: html.escape(value) for key, value in values.items()}
+            parts += [self._html_part, _base64_body(self.html.render(escaped))]
+        parts.append(self._tail)
+        return PreparedMail(self.from_addr, to_addr, b''.join(parts))
+
+
+def mail_values(kind, email, name='', timestamp='', keywords=(), team=None):
+    """整理範本欄位的值
+
+    team: 分組郵件的 {team, team_count, team_size, teammates} (teammates 為每組共用的名單文字)
+    """
+    values = {'name': name, 'email': email, 'timestamp': timestamp}
+    if kind == 'team':
+        team = team or {}
+        for key in ('team', 'team_count', 'team_size', 'teammates'):
+            values[key] = str(team.get(key, ''))
+    if kind == 'keyword':
+        keywords = list(keywords)
+        values['keywords'] = '\n'.join(f"{i}. {k}" for i, k in enumerate(keywords, 1))
+        values['keyword1'] = keywords[0] if keywords else ''
+        values['keyword2'] = keywords[1] if len(keywords) > 1 else ''
+        values['keyword_count'] = str(len(keywords))
+    return values
+
+
+# ========== 排程揭曉 ==========
+
+class SMTPConnectionPool:
+    """預先建立並保持已登入的 SMTP 連線, 批次傳送時平行使用
+
+    warm() 建立連線後, 背景執行緒定期送出 NOOP 讓連線保持有效 (失效時重新連線);
+    send_batch() 將郵件平均分配到各連線, 每條連線一個執行緒依序傳送。
+    """
+
+    KEEPALIVE_INTERVAL = 30  # 秒
+
+    def __init__(self, connect, size=4):
+        """
+        Args:
+            connect: 建立已登入 SMTP 連線的函式
+            size: 連線數
+        """
+        self._connect = connect
+        self.size = size
+        self.connections = []
+        self._locks = []
+        self._stop = threading.Event()
+        self._keepalive = None
+
+    def warm(self):
+        """建立連線並開始保持連線"""
+        while len(self.connections) < self.size:
+            self.connections.append(self._connect())
+            self._locks.append(threading.Lock())
+        if self._keepalive is None:
+            self._keepalive = threading.Thread(target=self._keepalive_loop, daemon=True)
+            self._keepalive.start()
+
+    def _keepalive_loop(self):
+        while not self._stop.wait(self.KEEPALIVE_INTERVAL):
+            for i in range(len(self.connections)):
+                with self._locks[i]:
+                    self._ensure_alive(i)
+
+    def _ensure_alive(self, i):
+        try:
+            if self.connections[i].noop()[0] == 250:
+                return
+        except (smtplib.SMTPException, OSError):
+            pass
+        try:
+            self.connections[i].close()
+        except Exception:
+            pass
+        self.connections[i] = self._connect()
+
+    def _send_share(self, i, messages, results):
+        with self._locks[i]:
+            for index, msg in messages:
+                try:
+                    try:
+                        msg.send(self.connections[i])
+                    except smtplib.SMTPServerDisconnected:
+                        self.connections[i] = self._connect()
+                        msg.send(self.connections[i])
+                    results[index] = (True, time.perf_counter(), None)
+                except Exception as e:
+                    results[index] = (False, time.perf_counter(), str(e))
+
+    def send_batch(self, messages):
+        """平行傳送所有郵件
+
+        Args:
+            messages: PreparedMail 清單
+
+        Returns:
+            與 messages 對應的 (success, 完成時間 perf_counter, 錯誤訊息) 清單
+        """
+        if not self.connections:
+            self.warm()
+        results = [None] * len(messages)
+        shares = [[] for _ in self.connections]
+        for index, msg in enumerate(messages):
+            shares[index % len(shares)].append((index, msg))
+        threads = [threading.Thread(target=self._send_share, args=(i, share, results))
+                   for i, share in enumerate(shares) if share]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def close(self):
+        self._stop.set()
+        for i, server in enumerate(self.connections):
+            with self._locks[i]:
+                try:
+                    server.quit()
+                except Exception:
+                    pass
+        self.connections, self._locks = [], []
+
+
+class ScheduledReveal:
+    """排程揭曉 - 事先完成抽籤、產生所有郵件並建立 SMTP 連線, 計時到時一次送出
+
+    prepare() 完成所有耗時工作; start() 以計時器在 reveal_at 觸發 flush(),
+    結束後 report 記錄揭曉到最後一封送達的延遲。
+    """
+
+    def __init__(self, lottery, count, avoid_repeat=True, connections=4, **draw_options):
+        self.lottery = lottery
+        self.count = count
+        self.avoid_repeat = avoid_repeat
+        self.draw_options = draw_options
+        self.pool = SMTPConnectionPool(lottery.smtp_connect, connections)
+        self.selected = []
+        self.messages = []
+        self.timestamp = None
+        self.reveal_at = None     # time.time() 時間
+        self.report = None
+        self.done = threading.Event()
+        self._timer = None
+
+    def prepare(self):
+        """抽籤、預先產生郵件並建立連線
+
+        Returns:
+            (success, selected, message)
+        """
+        if not self.lottery.validate_config():
+            return False, [], "郵件設定不完整,請先在設定頁面設定 SMTP"
+        success, selected, message = self.lottery.draw(self.count, self.avoid_repeat,
+                                                       **self.draw_options)
+        if not success:
+            return False, [], message
+
+        self.selected = selected
+        self.timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        batch = self.lottery.mail_batch('draw')
+        self.messages = [batch.render(p['email'], mail_values('draw', p['email'], p['name'], self.timestamp))
+                         for p in selected]
+        try:
+            self.pool.warm()
+        except Exception as e:
+            self.cancel()
+            return False, [], f"建立 SMTP 連線失敗: {e}"
+        return True, selected, f"已準備 {len(self.messages)} 封郵件與 {len(self.pool.connections)} 條連線"
+
+    def start(self, reveal_at):
+        """在 reveal_at (time.time() 時間) 送出所有郵件"""
+        self.reveal_at = reveal_at
+        self._timer = threading.Timer(max(0.0, reveal_at - time.time()), self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self):
+        """立即送出所有預先產生的郵件, 並記錄延遲"""
+        fired = time.perf_counter()
+        timer_lag = (time.time() - self.reveal_at) * 1000 if self.reveal_at else 0.0
+        results = self.pool.send_batch(self.messages)
+        self.pool.close()
+
+        latencies = sorted((done - fired) * 1000 for ok, done, _ in results if ok)
+        failed = [(p['email'], error) for p, (ok, _, error) in zip(self.selected, results) if not ok]
+        self.report = {
+            'sent': len(latencies),
+            'failed': failed,
+            'timer_lag_ms': timer_lag,
+            'first_ms': latencies[0] if latencies else None,
+            'median_ms': latencies[len(latencies) // 2] if latencies else None,
+            'last_ms': latencies[-1] if latencies else None,
+        }
+        self.lottery.save_history(self.selected, self.count, 'email')
+        self.done.set()
+        return self.report
+
+    def cancel(self):
+        """取消排程: 關閉連線並撤回本次抽籤 (依抽中者撤回, 期間的其他抽籤不受影響)"""
+        if self._timer:
+            self._timer.cancel()
+        self.pool.close()
+        if self.selected and self.avoid_repeat:
+            self.lottery.retract_draw(self.selected)
+        self.selected, self.messages = [], []
+
+
+def chi_square_sf(x, dof):
+    """卡方分布的右尾機率 P(X >= x), 以正規化上不完全 Gamma 函數計算"""
+    if x <= 0:
+        return 1.0
+    a, x = dof / 2, x / 2
+    log_prefix = -x + a * math.log(x) - math.lgamma(a)
+    if x < a + 1:
+        # 級數展開求下尾 P, 再取 1 - P
+        term = total = 1 / a
+        n = a
+        for _ in range(10000):
+            n += 1
+            term *= x / n
+            total += term
+            if term < total * 1e-15:
+                break
+        return max(0.0, 1 - total * math.exp(log_prefix))
+    # 連分數 (modified Lentz) 直接求上尾 Q
+    tiny = 1e-300
+    b = x + 1 - a
+    c, d = 1 / tiny, 1 / b
+    h = d
+    for i in range(1, 10000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = 1 / (d if abs(d) > tiny else tiny)
+        c = b + an / c
+        c = c if abs(c) > tiny else tiny
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return min(1.0, h * math.exp(log_prefix))
+
+
+def uniformity_test(counts):
+    """卡方均勻性檢定: 各類別的觀察次數是否符合均勻分布
+
+    Args:
+        counts: 各類別的觀察次數 (包含 0 次的類別)
+
+    Returns:
+        dict (chi2, dof, p_value, expected), 類別少於 2 或沒有觀察值時回傳 None
+    """
+    counts = list(counts)
+    total = sum(counts)
+    if len(counts) < 2 or total == 0:
+        return None
+    expected = total / len(counts)
+    chi2 = sum((c - expected) ** 2 for c in counts) / expected
+    dof = len(counts) - 1
+    return {'chi2': chi2, 'dof': dof, 'p_value': chi_square_sf(chi2, dof), 'expected': expected}
+
+
+class HistoryStats:
+    """歷史記錄的累計統計 - 隨 HistoryStore.append 增量更新
+
+    - 禮物抽籤 (kind='draw'): 每人中獎次數、最近一次中獎時間與記錄編號
+    - 關鍵字抽籤 (kind='keyword'): 每個關鍵字被抽中的次數、每人參與次數、
+      每人每個關鍵字最近一次被分配的記錄編號 (供跨場次避免重複)
+
+    與 HistoryIndex 相同: 第一次使用時載入 .stats 檔並補上之後新增的記錄, 關閉時寫回。
+    """
+
+    _FIELDS = ('count', 'slots', 'wins', 'last_win', 'names', 'picks', 'last_number', 'pairs')
+
+    def __init__(self, store, kind):
+        """
+        Args:
+            store: 要統計的 HistoryStore
+            kind: 'draw' 或 'keyword'
+        """
+        self.store = store
+        self.lock = store.lock
+        self.kind = kind
+        self.path = store.path + '.stats'
+        self._built = False
+        self._dirty = False
+        store.indexes.append(self)
+        self._reset()
+
+    def _reset(self):
+        self.count = 0       # 已統計的記錄數
+        self.slots = 0       # 中獎名額 / 關鍵字總數
+        self.wins = {}       # email -> 中獎次數 (關鍵字抽籤為參與次數)
+        self.last_win = {}   # email -> 最近一次的時間戳記
+        self.names = {}      # email -> 姓名
+        self.picks = {}      # 關鍵字 -> 被抽中次數
+        self.last_number = {}  # email -> 最近一次中獎的記錄編號
+        self.pairs = {}      # email -> {關鍵字: 最近一次分配到的記錄編號}
+
+    @_synchronized('lock')
+    def ensure_built(self):
+        """載入統計檔並補上尚未統計的記錄 (包含其他程式附加的記錄)"""
+        if self._built and self.count <= len(self.store):
+            return self._catch_up()
+        self._built = True
+        self._reset()
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('kind') == self.kind and data.get('count', 0) <= len(self.store) \
+                        and all(key in data for key in self._FIELDS):
+                    for key in self._FIELDS:
+                        setattr(self, key, data[key])
+        except Exception as e:
+            print(f"載入歷史統計失敗: {e}")
+            self._reset()
+        return self._catch_up()
+
+    def _catch_up(self):
+        stop = len(self.store)
+        for start in range(self.count, stop, HistoryStore._CHUNK):
+            for record in self.store.page(start, min(start + HistoryStore._CHUNK, stop)):
+                self._accumulate(record)
+        return self
+
+    def _accumulate(self, record):
+        timestamp = record.get('timestamp', '')
+        number = self.count
+        if self.kind == 'draw':
+            people = record['selected']
+        else:
+            people = list(record['results'].values())
+            for data in people:
+                assigned = self.pairs.setdefault(data['email'], {})
+                for keyword in data['keywords']:
+                    self.picks[keyword] = self.picks.get(keyword, 0) + 1
+                    assigned[keyword] = number
+                    self.slots += 1
+        for p in people:
+            email = p['email']
+            self.wins[email] = self.wins.get(email, 0) + 1
+            self.names[email] = p['name']
+            self.last_number[email] = number
+            if timestamp > self.last_win.get(email, ''):
+                self.last_win[email] = timestamp
+        if self.kind == 'draw':
+            self.slots += len(people)
+        self.count += 1
+        self._dirty = True
+
+    def is_recent(self, number, window):
+        """記錄編號是否落在最近 window 筆記錄內 (沒有記錄時以 -1 表示)"""
+        return number >= max(0, self.count - window)
+
+    def add(self, number, record):
+        """HistoryStore 新增記錄時呼叫"""
+        if not self._built:
+            return  # 尚未載入, 之後載入時會一併補上
+        if number == self.count:
+            self._accumulate(record)
+        elif number > self.count:
+            self._built = False
+
+    def clear(self):
+        self._reset()
+        self._built = True
+        self._dirty = False
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @_synchronized('lock')
+    def save(self):
+        """寫入統計檔 (有變更時)"""
+        if not self._dirty:
+            return
+        try:
+            data = {key: getattr(self, key) for key in self._FIELDS}
+            data['kind'] = self.kind
+            atomic_write_text(self.path, json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+            self._dirty = False
+        except OSError as e:
+            print(f"儲存歷史統計失敗: {e}")
+
+
+# ========== 啟動效能分析 ==========
+
+class StartupProfiler:
+    """啟動階段計時 (--profile-startup)
+
+    各階段以 phase() 包住, 可巢狀; 時間以模組開始載入為原點 (毫秒)。
+    """
+
+    def __init__(self, origin=_MODULE_START):
+        self.origin = origin
+        self.phases = []  # [{name, start_ms, ms, depth}, ...] 依開始順序
+        self.info = {}    # 名冊大小、歷史筆數等附加資訊
+        self._depth = 0
+
+    def add(self, name, start, end, depth=0):
+        """加入已量測的階段 (perf_counter 時間)"""
+        self.phases.append({'name': name, 'start_ms': (start - self.origin) * 1000,
+                            'ms': (end - start) * 1000, 'depth': depth})
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """量測一個階段"""
+        entry = {'name': name, 'depth': self._depth}
+        self.phases.append(entry)
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            self._depth -= 1
+            entry['start_ms'] = (start - self.origin) * 1000
+            entry['ms'] = (end - start) * 1000
+
+    def total_ms(self):
+        """由模組開始載入到最後一個階段結束的時間"""
+        return max((p['start_ms'] + p['ms'] for p in self.phases), default=0.0)
+
+    def report(self):
+        return {'total_ms': self.total_ms(), 'phases': self.phases, 'info': self.info,
+                'python': sys.version.split()[0], 'platform': sys.platform}
+
+    def format(self):
+        """文字報表: 每個階段一行 (依巢狀縮排)"""
+        lines = [f"{'階段':<40}{'開始 ms':>10}{'耗時 ms':>10}"]
+        for p in self.phases:
+            name = '  ' * p['depth'] + p['name']
+            lines.append(f"{name:<40}{p['start_ms']:>10.1f}{p['ms']:>10.1f}")
+        lines.append(f"{'合計':<40}{'':>10}{self.total_ms():>10.1f}")
+        return '\n'.join(lines)
+
+    def write(self, path):
+        atomic_write_text(path, json.dumps(self.report(), ensure_ascii=False, indent=2))
+
+
+# 啟動分析時的 StartupProfiler (一般執行時為 None, profile_phase 不做任何事)
+_startup_profiler = None
+
+
+def profile_phase(name):
+    """啟動分析時量測 name 階段, 否則為空的 context manager"""
+    if _startup_profiler is None:
+        return contextlib.nullcontext()
+    return _startup_profiler.phase(name)
 
 
 class LotterySystem:
     """抽籤系統核心類別"""
 
-    def __init__(self):
+    def __init__(self, compact=False, use_snapshot=True, rng=None, audit=False):
+        """
+        Args:
+            compact: 是否使用緊湊名冊 (CompactRoster) 保存參與者, 適合大量參與者
+            use_snapshot: 是否使用二進位快照 (participants.snapshot) 加速啟動
+            rng: 抽籤亂數來源 - RandomSource 或其名稱 ('seeded' / 'system' / 'numpy')
+            audit: 是否保存每次抽籤的輸入 (候選名單或名冊) 供重播驗證;
+                   每次抽籤都要序列化整份輸入, 大量參與者時明顯變慢, 預設關閉
+        """
+        self.compact = compact
+        self.use_snapshot = use_snapshot
+        self.rng = rng if isinstance(rng, RandomSource) else RandomSource(rng or 'seeded')
+        self.audit_draws = audit
         self.participants = []  # 參與者清單 - 現在每個參與者都有自己的關鍵字: {name, email, keywords: [...]}
         self.drawn_items = []   # 已抽取的參與者
         self.history = []       # 歷史記錄
@@ -31,44 +3340,286 @@ class LotterySystem:
 
         # 檔案路徑
         self.participants_file = 'participants.json'
-        self.history_file = 'lottery_history.json'
+        self.snapshot_file = 'participants.snapshot'
+        self.history_file = 'lottery_history.jsonl'
         self.config_file = 'config.json'
-        self.keyword_history_file = 'keyword_lottery_history.json'
+        # 郵件範本 (與 config.json 放在同一目錄)
+        self.templates_file = os.path.join(os.path.dirname(self.config_file), 'mail_templates.json')
+        self.keyword_history_file = 'keyword_lottery_history.jsonl'
+        self.team_history_file = 'team_history.jsonl'
+        # 舊版 JSON 陣列格式的歷史記錄 (第一次開啟時自動轉換為 JSON Lines)
+        self.legacy_history_file = 'lottery_history.json'
+        self.legacy_keyword_history_file = 'keyword_lottery_history.json'
+
+        # 歷史記錄在記憶體中保留的最近筆數 (分組記錄包含所有人, 只保留少量)
+        self.history_tail_size = 200
+        self.team_history_tail_size = 5
+
+        # 歷史記錄封存: 熱檔超過門檻時, 關閉前將前幾個期間移到壓縮分段
+        self.history_rotate_period = 'month'   # 'month' 或 'year'
+        self.history_archive_codec = 'gzip'    # None / 'gzip' / 'lzma'
+        self.history_rotate_threshold = 1000   # 熱檔筆數門檻 (None 表示不自動封存)
+
+        # 歷史記錄正規化: 記錄只保存參與者版本 ID 與關鍵字 ID, 讀取時再合併
+        self.history_people_file = 'history_people.jsonl'
+        self.history_codec = HistoryCodec(ParticipantSnapshotTable(self.history_people_file))
+
+        # 已抽取狀態日誌: 重新啟動時恢復已抽取清單, 並支援復原上次抽籤
+        self.journal_file = 'draw_journal.jsonl'
+        # 抽籤輸入 (候選名單與權重) 的內容定址儲存, 歷史記錄以雜湊引用, 供重播驗證
+        # (只有 audit_draws 開啟時寫入; 重播時一律可讀取)
+        self.audit = DrawAuditStore('draw_audit')
+        self.checkpoint_file = 'draw_checkpoint.json'
+        self.journal = DrawJournal(self.journal_file, self.checkpoint_file)
+        with profile_phase('journal.recover'):
+            self.drawn_items = self.journal.recover()
+
+        # 跨程序協作: 同一目錄的多個執行個體寫入共用檔案前取得檔案鎖,
+        # 並以檔案戳記偵測其他程式的寫入, 只合併有變更的參與者
+        self.lock_file = 'lottery.lock'
+        self.file_lock = FileLock(self.lock_file)
+        self._participants_stamp = None  # 上次同步時 participants.json 的戳記
+        self._participants_base = None   # 上次同步時的 {郵箱: 指紋}, 三方合併的基準
+        self._roster_changes = set()     # 外部變更過、尚未由介面套用的郵箱
+
+        # 參與者延遲寫入: 連續修改在安靜期後合併為一次原子寫入
+        # 名冊與已抽取狀態共用一把可重入鎖 (GUI、背景寫入與 HTTP API 執行緒)
+        self._participants_lock = threading.RLock()
+        self._snapshot_stale = False
+        self._search_index = None  # 參與者即時搜尋索引, 第一次搜尋時建立
+        self.participants_writer = DebouncedWriter(self.save_participants, delay=0.5)
+        atexit.register(self.close)
 
         # 載入資料
-        self.load_participants()
-        self.load_history()
-        self.load_config()
-        self.load_keyword_history()
+        for load in (self.load_participants, self.load_history, self.load_config,
+                     self.load_templates, self.load_keyword_history, self.load_team_history):
+            with profile_phase(load.__name__):
+                load()
 
     # ========== 參與者管理 ==========
 
     def load_participants(self):
-        """從 JSON 檔案載入參與者資料"""
+        """從 JSON 檔案載入參與者資料
+
+        若二進位快照與 JSON 一致, 直接以 mmap 開啟快照而不解析 JSON;
+        快照為唯讀檢視, 第一次修改參與者時才轉換為可修改的模型。
+        JSON 較新時重新解析並重建快照。
+        """
+        self._close_snapshot()
+        self._search_index = None
+        self._participants_stamp = file_stamp(self.participants_file)
+        self._participants_base = None  # 快照轉換為可修改的模型時才建立
+        if self.use_snapshot and os.path.exists(self.participants_file):
+            snapshot = RosterSnapshot.open_if_fresh(self.snapshot_file, self.participants_file)
+            if snapshot is not None:
+                self.participants = snapshot
+                return
+
         try:
-            if os.path.exists(self.participants_file):
-                with open(self.participants_file, 'r', encoding='utf-8') as f:
-                    self.participants = json.load(f)
-                    # 確保每個參與者都有 keywords 欄位(向後相容)
-                    for p in self.participants:
-                        if 'keywords' not in p:
-                            p['keywords'] = []
-            else:
-                self.participants = []
+            participants = self._read_participants_file()
         except Exception as e:
             print(f"載入參與者失敗: {e}")
-            self.participants = []
+            participants = []
+        self._participants_base = {p['email']: self._fingerprint(p) for p in participants}
+
+        if self.use_snapshot and participants:
+            try:
+                RosterSnapshot.write(self.snapshot_file, participants, self.participants_file)
+            except Exception as e:
+                print(f"建立參與者快照失敗: {e}")
+
+        if self.compact:
+            self.participants = CompactRoster.from_participants(participants)
+        else:
+            self.participants = participants
+
+    def _read_participants_file(self):
+        """讀取 participants.json 為 dict 清單 (檔案不存在時為空清單)"""
+        if not os.path.exists(self.participants_file):
+            return []
+        with open(self.participants_file, 'r', encoding='utf-8') as f:
+            participants = json.load(f)
+        # 確保每個參與者都有 keywords 欄位(向後相容)
+        for p in participants:
+            if 'keywords' not in p:
+                p['keywords'] = []
+        return participants
+
+    @staticmethod
+    def _fingerprint(participant):
+        """參與者內容的指紋 (只在本程序內比較)"""
+        return hash((participant['name'], tuple(participant['keywords'])))
+
+    def _is_snapshot(self):
+        """參與者是否仍為唯讀的快照檢視"""
+        return isinstance(self.participants, RosterSnapshot)
+
+    def _close_snapshot(self):
+        if self._is_snapshot():
+            self.participants.close()
+
+    def _ensure_participants_loaded(self):
+        """將唯讀快照轉換為可修改的參與者模型 (第一次修改時呼叫)"""
+        if not self._is_snapshot():
+            return
+        snapshot = self.participants
+        if self.compact:
+            self.participants = snapshot.to_compact_roster()
+        else:
+            self.participants = snapshot.to_list()
+        snapshot.close()
+        self._participants_base = {p['email']: self._fingerprint(p) for p in self.participants}
+
+    @_synchronized('_participants_lock')
+    def sync_participants(self):
+        """合併其他程式寫入 participants.json 的變更 (檔案未變更時只需一次 stat)
+
+        與上次同步的版本做三方比對, 只套用外部新增、修改、刪除的參與者;
+        本程式尚未寫入的修改保留, 兩邊都改過同一位時以本程式為準 (稍後寫入時覆蓋)。
+
+        Returns:
+            (added, updated, removed) - 套用的外部變更郵箱清單
+        """
+        if file_stamp(self.participants_file) == self._participants_stamp:
+            return [], [], []
+        with self.file_lock:
+            stamp = file_stamp(self.participants_file)
+            if stamp == self._participants_stamp:
+                return [], [], []
+            self._participants_stamp = stamp
+            if stamp is None:
+                return [], [], []  # 檔案被刪除: 保留記憶體中的名冊, 下次寫入時重建
+            try:
+                disk = self._read_participants_file()
+                if not all(isinstance(p, dict) and 'name' in p and 'email' in p for p in disk):
+                    raise ValueError("每位參與者都需要 name 與 email")
+            except Exception as e:
+                print(f"重新載入參與者失敗: {e}")
+                return [], [], []
+        return self._merge_participants(disk)
+
+    @_synchronized('_participants_lock')
+    def take_roster_changes(self):
+        """取出自上次呼叫以來外部變更過的郵箱 (任何執行緒的同步都會累積)
+
+        介面依郵箱目前的狀態更新: 已不存在的刪除, 其餘新增或更新。
+        """
+        changes, self._roster_changes = self._roster_changes, set()
+        return changes
+
+    def _merge_participants(self, disk):
+        """將外部版本中相對於基準有變更的參與者套用到名冊"""
+        self._ensure_participants_loaded()
+        base = self._participants_base
+        theirs = {p['email']: p for p in disk}
+        prints = {email: self._fingerprint(p) for email, p in theirs.items()}
+        if self.compact:
+            roster = self.participants
+
+            def mine(email):
+                row = roster.find(email)
+                return None if row is None else roster[row]
+        else:
+            mine = {p['email']: p for p in self.participants}.get
+
+        added, updated, removed = [], [], []
+        changed = [email for email, fp in prints.items() if base.get(email) != fp]
+        changed.extend(email for email in base if email not in prints)
+        for email in changed:
+            local = mine(email)
+            if (None if local is None else self._fingerprint(local)) != base.get(email):
+                continue  # 本程式也修改過
+            if email not in theirs:
+                removed.append(email)
+            elif local is None:
+                added.append(email)
+            else:
+                updated.append(email)
+
+        if removed:
+            self._drop_participants(set(removed))
+        for email in updated:
+            p = theirs[email]
+            if self.compact:
+                self.participants.update(self.participants.find(email), p)
+            else:
+                local = mine(email)
+                local['name'] = p['name']
+                local['keywords'] = list(p['keywords'])
+            if self._search_index is not None:
+                self._search_index.remove(email)
+                self._search_index.add(p['name'], email)
+        for email in added:
+            p = theirs[email]
+            self.participants.append({'name': p['name'], 'email': email,
+                                      'keywords': list(p['keywords'])})
+            if self._search_index is not None:
+                self._search_index.add(p['name'], email)
+
+        self._participants_base = prints
+        if added or updated or removed:
+            self._snapshot_stale = True
+            self._roster_changes.update(added, updated, removed)
+        return added, updated, removed
 
     def save_participants(self):
-        """儲存參與者資料到 JSON 檔案"""
+        """立即儲存參與者資料到 JSON 檔案 (原子寫入)
+
+        一般修改請使用 mark_participants_dirty(), 由背景延遲寫入合併處理。
+        寫入前先合併其他程式的變更, 取得檔案鎖後再以戳記確認檔案未被改寫 (樂觀檢查),
+        期間又被寫入時重新合併後再寫。
+        """
         try:
-            with open(self.participants_file, 'w', encoding='utf-8') as f:
-                json.dump(self.participants, f, ensure_ascii=False, indent=2)
+            while True:
+                # 持鎖期間只合併與複製資料, 序列化在鎖外進行
+                with self._participants_lock:
+                    self.sync_participants()
+                    self._ensure_participants_loaded()
+                    if self.compact:
+                        data = self.participants.to_list()
+                    else:
+                        data = [dict(p, keywords=list(p['keywords'])) for p in self.participants]
+                    expected = self._participants_stamp
+                text = json.dumps(data, ensure_ascii=False, indent=2)
+                with self.file_lock:
+                    if file_stamp(self.participants_file) != expected:
+                        continue
+                    atomic_write_text(self.participants_file, text)
+                    self._participants_stamp = file_stamp(self.participants_file)
+                    self._participants_base = {p['email']: self._fingerprint(p) for p in data}
+                break
+            self._snapshot_stale = True
             return True
         except Exception as e:
             print(f"儲存參與者失敗: {e}")
             return False
 
+    def mark_participants_dirty(self):
+        """標記參與者已變更, 短暫安靜期後於背景寫入"""
+        self.participants_writer.mark_dirty()
+
+    def flush(self):
+        """立即寫入所有尚未寫入的變更"""
+        return self.participants_writer.flush()
+
+    def close(self):
+        """結束前寫入變更, 並為下次啟動重建參與者快照"""
+        self.flush()
+        self._auto_rotate_history()
+        self.history_index.save()
+        self.keyword_history_index.save()
+        self.history_stats.save()
+        self.keyword_history_stats.save()
+        if self.use_snapshot and self._snapshot_stale:
+            try:
+                with self._participants_lock:
+                    data = self.participants.to_list() if self.compact else list(self.participants)
+                    RosterSnapshot.write(self.snapshot_file, data, self.participants_file)
+                self._snapshot_stale = False
+            except Exception as e:
+                print(f"建立參與者快照失敗: {e}")
+        self._close_snapshot()
+
     def add_participant(self, name, email, keywords=None):
         """新增參與者
 
@@ -80,25 +3631,80 @@ class LotterySystem:
         if not name or not email:
             return False, "姓名和郵箱不能為空"
 
-        # 檢查是否已存在
-        for p in self.participants:
-            if p['email'] == email:
+        with self._participants_lock:
+            self.sync_participants()
+            self._ensure_participants_loaded()
+
+            # 檢查是否已存在
+            if self._find_participant(email) is not None:
                 return False, "該郵箱已存在"
 
-        self.participants.append({
-            'name': name,
-            'email': email,
-            'keywords': keywords if keywords else []
-        })
-        self.save_participants()
+            self.participants.append({
+                'name': name,
+                'email': email,
+                'keywords': keywords if keywords else []
+            })
+            if self._search_index is not None:
+                self._search_index.add(name, email)
+        self.mark_participants_dirty()
         return True, "新增成功"
 
     def remove_participant(self, email):
         """刪除參與者"""
-        self.participants = [p for p in self.participants if p['email'] != email]
+        self.remove_participants({email})
+
+    @_synchronized('_participants_lock')
+    def remove_participants(self, emails):
+        """一次刪除多位參與者 (單次掃描, 只寫入一次)
+
+        Args:
+            emails: 要刪除的郵箱集合
+
+        Returns:
+            int: 實際刪除的人數
+        """
+        emails = set(emails)
+        if not emails:
+            return 0
+        self.sync_participants()
+        removed = self._drop_participants(emails)
         # 同時從已抽取清單中移除
-        self.drawn_items = [p for p in self.drawn_items if p['email'] != email]
-        self.save_participants()
+        forgotten = {p['email'] for p in self.drawn_items if p['email'] in emails}
+        if forgotten:
+            self.drawn_items = [p for p in self.drawn_items if p['email'] not in forgotten]
+            self.journal.record_forget(forgotten)
+        if removed:
+            self.mark_participants_dirty()
+        return removed
+
+    def _drop_participants(self, emails):
+        """從名冊與搜尋索引移除郵箱集合中的參與者, 回傳移除人數"""
+        self._ensure_participants_loaded()
+        if self.compact:
+            removed = self.participants.remove_emails(emails)
+        else:
+            before = len(self.participants)
+            self.participants = [p for p in self.participants if p['email'] not in emails]
+            removed = before - len(self.participants)
+        if removed and self._search_index is not None:
+            for email in emails:
+                self._search_index.remove(email)
+        return removed
+
+    def remove_participants_from_file(self, path):
+        """依郵箱清單檔案 (每行一個) 刪除參與者
+
+        Returns:
+            (success, removed, message)
+        """
+        try:
+            emails = load_email_set(path)
+        except Exception as e:
+            return False, 0, f"讀取郵箱清單失敗: {e}"
+        if not emails:
+            return False, 0, "郵箱清單是空的"
+        removed = self.remove_participants(emails)
+        return True, removed, f"已刪除 {removed} 位參與者 (清單共 {len(emails)} 個郵箱)"
 
     def batch_import_participants(self, text_data):
         """批次匯入參與者
@@ -129,51 +3735,259 @@ class LotterySystem:
 
         return success_count, fail_count
 
+    def _find_participant(self, email):
+        """根據郵箱找到參與者 (緊湊模式下回傳可修改的檢視)"""
+        self._ensure_participants_loaded()
+        if self.compact:
+            row = self.participants.find(email)
+            return None if row is None else self.participants[row]
+        for p in self.participants:
+            if p['email'] == email:
+                return p
+        return None
+
+    def _participant_emails(self):
+        """取得依名冊順序排列的郵箱清單"""
+        if self._is_snapshot():
+            return self.participants.email_list()
+        if self.compact:
+            return self.participants.emails
+        return [p['email'] for p in self.participants]
+
+    def _participant_names(self):
+        """取得依名冊順序排列的姓名清單"""
+        if self._is_snapshot():
+            return self.participants.name_list()
+        if self.compact:
+            return self.participants.names
+        return [p['name'] for p in self.participants]
+
+    def _participant_at(self, row):
+        """取得指定位置的參與者 dict"""
+        if self.compact or self._is_snapshot():
+            return self.participants.get(row)
+        return self.participants[row]
+
+    @_synchronized('_participants_lock')
+    def participant_rows(self):
+        """依名冊順序取得 (姓名, 郵箱) 清單的副本
+
+        GUI 執行緒逐列顯示時使用, 背景寫入執行緒或外部修改的合併不會在迭代途中改變清單。
+        """
+        return list(zip(self._participant_names(), self._participant_emails()))
+
+    @_synchronized('_participants_lock')
+    def get_keyword_count(self):
+        """取得所有參與者的關鍵字總數"""
+        if self._is_snapshot():
+            return self.participants.kwref_count
+        if self.compact:
+            return self.participants.keyword_count()
+        return sum(len(p['keywords']) for p in self.participants)
+
     # ========== 抽籤邏輯 ==========
 
+    @_synchronized('_participants_lock')
+    def get_drawn_emails(self):
+        """取得已抽取參與者的郵箱集合"""
+        return {p['email'] for p in self.drawn_items}
+
+    @_synchronized('_participants_lock')
     def get_available_count(self):
         """取得可抽取人數"""
-        available = [p for p in self.participants if p not in self.drawn_items]
-        return len(available)
+        drawn = self.get_drawn_emails()
+        if not drawn:
+            return len(self.participants)
+        return sum(1 for email in self._participant_emails() if email not in drawn)
+
+    @_synchronized('_participants_lock')
+    def get_draw_counts(self):
+        """取得同一時間點的參與者、可抽取與已抽取人數"""
+        return {
+            'participants': len(self._participant_emails()),
+            'available': self.get_available_count(),
+            'drawn': len(self.drawn_items),
+        }
+
+    @_synchronized('_participants_lock')
+    def get_summary(self):
+        """取得名冊、已抽取與歷史記錄筆數摘要"""
+        return dict(self.get_draw_counts(),
+                    history=len(self.history),
+                    keyword_history=len(self.keyword_history))
 
-    def draw(self, count, avoid_repeat=True):
+    @_synchronized('_participants_lock')
+    def draw(self, count, avoid_repeat=True, recent_window=0, recent_policy='exclude',
+             recent_penalty=0.25, seed=None):
         """執行抽籤
 
         Args:
             count: 抽取數量
             avoid_repeat: 是否避免重複抽取
+            recent_window: 跨場次避免重複: 最近幾次抽籤的中獎者 (0 表示不限制)
+            recent_policy: 'exclude' 排除近期中獎者, 'penalize' 降低其中獎機率
+            recent_penalty: penalize 時近期中獎者的相對權重 (0~1)
+            seed: 指定本次抽籤的種子 (預設由亂數來源產生)
 
         Returns:
-            (success, result, message)
+            (success, result, message) - result 為 DrawResult, rng 屬性記錄亂數來源與種子
         """
+        self.sync_participants()
         if not self.participants:
             return False, [], "參與者清單為空"
 
-        # 確定可抽取的參與者池
+        # 確定可抽取的參與者池 (以列號表示)
+        emails = self._participant_emails()
         if avoid_repeat:
-            available = [p for p in self.participants if p not in self.drawn_items]
+            drawn = self.get_drawn_emails()
+            available = [i for i, email in enumerate(emails) if email not in drawn]
         else:
-            available = self.participants.copy()
+            available = range(len(emails))
+
+        # 近期中獎者: 以統計中的「最近中獎記錄編號」判斷, 每人 O(1)
+        recent = None
+        if recent_window > 0:
+            stats = self.history_stats.ensure_built()
+            recent = [i for i in available
+                      if stats.is_recent(stats.last_number.get(emails[i], -1), recent_window)]
+            if recent_policy == 'exclude' or recent_penalty <= 0:
+                recent_set = set(recent)
+                available = [i for i in available if i not in recent_set]
+                recent = None
 
         if len(available) < count:
             return False, [], f"可抽取人數不足（可抽取: {len(available)}, 需要: {count}）"
 
-        # 隨機抽取
-        selected = random.sample(available, count)
+        # 隨機抽取 (有近期中獎者時依權重抽取)
+        weights = None
+        if recent:
+            recent_set = set(recent)
+            weights = [recent_penalty if i in recent_set else 1.0 for i in available]
+        rng, info = self.rng.generator(seed)
+        rows = _sample_rows(rng, available, count, weights)
+        selected = DrawResult(self._participant_at(i) for i in rows)
+
+        # 可重播的來源: 保存抽籤輸入, 之後可由種子重新推導同一結果;
+        # 未開啟 --audit 時只記錄輸入的雜湊, 重播時由呼叫端提供候選名單
+        if 'seed' in info:
+            doc = {
+                'kind': 'draw',
+                'candidates': [emails[i] for i in available],
+                'weights': weights,
+                'count': count,
+            }
+            info['input'] = self.audit.put(doc) if self.audit_draws else DrawAuditStore.digest(doc)
+        selected.rng = info
 
-        # 更新已抽取清單
+        # 更新已抽取清單 (先寫入日誌)
         if avoid_repeat:
+            self.journal.record_draw(selected)
             self.drawn_items.extend(selected)
 
         return True, selected, "抽籤成功"
 
+    def draw_from_file(self, roster_path, count, exclude_path=None, avoid_repeat=True):
+        """從外部名單檔案串流抽籤 (蓄水池抽樣, 不載入整份名單)
+
+        掃描檔案期間不持有參與者鎖, 只在讀取與寫入已抽取狀態時持有;
+        掃描期間若其他抽籤抽走了本次的中獎者, 以新的排除集合重新掃描。
+
+        Args:
+            roster_path: 名單檔案 (CSV / JSONL)
+            count: 抽取數量
+            exclude_path: 已抽取郵箱檔案 (每行一個), 可選
+            avoid_repeat: 是否排除已抽取者, 並將本次中獎者附加到排除檔案
+
+        Returns:
+            (success, result, message)
+        """
+        file_exclude = load_email_set(exclude_path) if avoid_repeat else set()
+        drawn = self.get_drawn_emails() if avoid_repeat else set()
+        while True:
+            exclude = file_exclude | drawn
+            rng, info = self.rng.generator()
+            success, selected, message = reservoir_draw_file(roster_path, count, exclude, rng)
+            if not success:
+                return False, [], message
+            if not avoid_repeat:
+                break
+            with self._participants_lock:
+                drawn = self.get_drawn_emails()
+                if not any(p['email'] in drawn for p in selected):
+                    self.journal.record_draw(selected)
+                    self.drawn_items.extend(selected)
+                    break
+        selected = DrawResult(selected)
+
+        # 名單不在記憶體中: 保存檔案路徑與內容雜湊, 重播時確認檔案未變更後重新掃描
+        if self.audit_draws and 'seed' in info:
+            info['input'] = self.audit.put({
+                'kind': 'stream',
+                'source': os.path.abspath(roster_path),
+                'source_sha256': RosterSnapshot.hash_file(roster_path).hex(),
+                'exclude': sorted(exclude),
+                'count': count,
+            })
+        selected.rng = info
+
+        if avoid_repeat:
+            if exclude_path:
+                try:
+                    with open(exclude_path, 'a', encoding='utf-8') as f:
+                        for p in selected:
+                            f.write(p['email'] + '\n')
+                except OSError as e:
+                    print(f"寫入排除清單失敗: {e}")
+
+        return True, selected, message
+
+    @_synchronized('_participants_lock')
     def reset_drawn(self):
         """重置已抽取清單"""
+        self.journal.record_reset()
         self.drawn_items = []
 
+    @_synchronized('_participants_lock')
+    def undo_last_draw(self):
+        """復原上次抽籤 (讓上次抽中的人重新可被抽取)
+
+        歷史記錄不會被刪除, 只復原「避免重複」的已抽取狀態。
+
+        Returns:
+            (success, restored, message) - restored 為重新可抽取的參與者
+        """
+        batch = self.journal.record_undo()
+        if batch is None:
+            return False, [], "沒有可復原的抽籤"
+        self._release_batch(batch)
+        return True, batch, f"已復原上次抽籤（{len(batch)} 人重新可被抽取）"
+
+    @_synchronized('_participants_lock')
+    def retract_draw(self, selected):
+        """撤回指定的一次抽籤 (排程揭曉取消時使用)
+
+        與 undo_last_draw 不同, 依抽中者的郵箱找出那一批, 期間若有其他抽籤也不受影響。
+
+        Returns:
+            (success, restored, message)
+        """
+        batch = self.journal.record_retract(p['email'] for p in selected)
+        if batch is None:
+            return False, [], "找不到這次抽籤 (可能已重置或復原)"
+        self._release_batch(batch)
+        return True, batch, f"已撤回抽籤（{len(batch)} 人重新可被抽取）"
+
+    def _release_batch(self, batch):
+        """依郵箱從已抽取清單移除一批, 不假設已抽取清單的最後幾筆就是這一批
+        (合併或重新載入可能改變順序); 仍在其他批次中的人維持已抽取"""
+        still_drawn = {p['email'] for p in self.journal.drawn_items()}
+        restored = {p['email'] for p in batch} - still_drawn
+        if restored:
+            self.drawn_items = [p for p in self.drawn_items if p['email'] not in restored]
+
     def is_drawn(self, participant):
         """檢查參與者是否已被抽取"""
-        return participant in self.drawn_items
+        return participant['email'] in self.get_drawn_emails()
 
     # ========== 历史记录 ==========
 
@@ -185,36 +3999,80 @@ class LotterySystem:
             'count': count,
             'mode': mode
         }
-        self.history.append(record)
+        if getattr(selected, 'rng', None):
+            record['rng'] = selected.rng
 
         try:
-            with open(self.history_file, 'w', encoding='utf-8') as f:
-                json.dump(self.history, f, ensure_ascii=False, indent=2)
+            self.history.append(record)
         except Exception as e:
             print(f"儲存歷史記錄失敗: {e}")
 
     def load_history(self):
-        """從檔案載入歷史記錄"""
-        try:
-            if os.path.exists(self.history_file):
-                with open(self.history_file, 'r', encoding='utf-8') as f:
-                    self.history = json.load(f)
-            else:
-                self.history = []
-        except Exception as e:
-            print(f"載入歷史記錄失敗: {e}")
-            self.history = []
+        """開啟歷史記錄 (延遲載入, 第一次存取時才讀取檔案)"""
+        self.history = HistoryStore(self.history_file, legacy_path=self.legacy_history_file,
+                                    tail_size=self.history_tail_size,
+                                    encode=self.history_codec.encode_draw,
+                                    decode=self.history_codec.decode_draw,
+                                    file_lock=self.file_lock)
+        self.history_index = HistoryIndex(
+            self.history, lambda record: [p['email'] for p in record['selected']])
+        self.history_stats = HistoryStats(self.history, 'draw')
 
     def get_history(self):
-        """取得歷史記錄清單"""
+        """取得歷史記錄 (HistoryStore, 可迭代、倒序迭代與分頁讀取)"""
         return self.history
 
+    def query_history(self, email=None, mode=None, since=None, until=None, limit=200):
+        """以索引查詢禮物抽籤歷史記錄
+
+        Args:
+            email: 完整郵箱或前綴 (例如 "alice@")
+            mode: 'display' 或 'email'
+            since / until: 時間區間, 可只給日期 (例如 "2025-12")
+            limit: 最多回傳筆數
+
+        Returns:
+            (total, records) - 符合總數與最新的 limit 筆記錄 (新到舊)
+        """
+        numbers = self.history_index.search(email, mode, since, until)
+        newest = list(numbers[-limit:])[::-1] if limit else list(numbers)[::-1]
+        return len(numbers), self.history.read_many(newest)
+
+    def last_win(self, email):
+        """取得指定郵箱最近一次中獎的記錄, 沒有時回傳 None"""
+        _, records = self.query_history(email=email, limit=1)
+        return records[0] if records else None
+
+    def _iter_query(self, store, index, email=None, mode=None, since=None, until=None):
+        """依條件由舊到新逐筆產生歷史記錄 (分批讀取, 不一次載入全部)"""
+        if not (email or mode or since or until):
+            yield from store
+            return
+        numbers = index.search(email, mode, since, until)
+        for start in range(0, len(numbers), HistoryStore._CHUNK):
+            yield from store.read_many(list(numbers[start:start + HistoryStore._CHUNK]))
+
+    def iter_history(self, email=None, mode=None, since=None, until=None):
+        """依條件由舊到新逐筆產生禮物抽籤歷史記錄"""
+        return self._iter_query(self.history, self.history_index, email, mode, since, until)
+
+    def export_history(self, path, fmt=None, email=None, mode=None, since=None, until=None):
+        """串流匯出禮物抽籤歷史記錄 (CSV 每位中獎者一列, JSONL 每筆記錄一行)
+
+        Returns:
+            (success, count, message)
+        """
+        try:
+            count = export_records(path, self.iter_history(email, mode, since, until),
+                                   DRAW_HISTORY_FIELDS, draw_history_rows, fmt)
+        except Exception as e:
+            return False, 0, f"匯出歷史記錄失敗: {e}"
+        return True, count, f"已匯出 {count} 筆抽籤記錄到 {path}"
+
     def clear_history(self):
         """清空歷史記錄"""
-        self.history = []
         try:
-            if os.path.exists(self.history_file):
-                os.remove(self.history_file)
+            self.history.clear()
         except Exception as e:
             print(f"清空歷史記錄失敗: {e}")
 
@@ -259,6 +4117,110 @@ class LotterySystem:
 
     # ========== 郵件傳送 ==========
 
+    def smtp_connect(self):
+        """建立已登入的 SMTP 連線 (smtp_starttls 設為 false 時不使用 STARTTLS)"""
+        server = smtplib.SMTP(self.config['smtp_server'], self.config['smtp_port'])
+        if self.config.get('smtp_starttls', True):
+            server.starttls()
+        server.login(self.config['smtp_user'], self.config['smtp_password'])
+        return server
+
+    # ========== 郵件範本 ==========
+
+    def load_templates(self):
+        """載入郵件範本 (缺少的類別使用內建範本)"""
+        self.templates = {kind: dict(template) for kind, template in DEFAULT_MAIL_TEMPLATES.items()}
+        self._mail_batches = {}
+        try:
+            if os.path.exists(self.templates_file):
+                with open(self.templates_file, 'r', encoding='utf-8') as f:
+                    for kind, template in json.load(f).items():
+                        if kind in self.templates:
+                            self.templates[kind].update(template)
+        except Exception as e:
+            print(f"載入郵件範本失敗: {e}")
+
+    @staticmethod
+    def compile_template(kind, template):
+        """編譯一類範本
+
+        Returns:
+            (subject, text, html) 的 MailTemplate, html 沒有內容時為 None
+
+        Raises:
+            ValueError: 範本有誤
+        """
+        fields = MAIL_TEMPLATE_FIELDS[kind]
+        html_source = template.get('html') or ''
+        return (MailTemplate(template['subject'], fields), MailTemplate(template['text'], fields),
+                MailTemplate(html_source, fields) if html_source.strip() else None)
+
+    def save_templates(self, kind, template):
+        """驗證並儲存一類郵件範本
+
+        Returns:
+            (success, message)
+        """
+        try:
+            self.compile_template(kind, template)
+        except ValueError as e:
+            return False, f"範本有誤: {e}"
+        self.templates[kind] = dict(template)
+        self._mail_batches.clear()
+        try:
+            atomic_write_text(self.templates_file,
+                              json.dumps(self.templates, ensure_ascii=False, indent=2))
+        except Exception as e:
+            return False, f"儲存郵件範本失敗: {e}"
+        return True, "郵件範本已儲存"
+
+    def mail_batch(self, kind):
+        """取得一類郵件的共用骨架 (範本只在第一次使用或修改後編譯)"""
+        key = (kind, self.config.get('from_email', ''))
+        batch = self._mail_batches.get(key)
+        if batch is None:
+            batch = MailBatch(key[1], *self.compile_template(kind, self.templates[kind]))
+            self._mail_batches[key] = batch
+        return batch
+
+    def preview_template(self, kind, template=None):
+        """以範例資料套用範本
+
+        Returns:
+            (success, (subject, text, html), message)
+        """
+        try:
+            subject, text, html_body = self.compile_template(kind, template or self.templates[kind])
+        except ValueError as e:
+            return False, ('', '', ''), f"範本有誤: {e}"
+        sample = MAIL_TEMPLATE_SAMPLE
+        values = mail_values(kind, sample['email'], sample['name'], sample['timestamp'], sample['keywords'],
+                             sample['team'])
+        escaped = {key: html.escape(value) for key, value in values.items()}
+        return True, (subject.render(values), text.render(values),
+                      html_body.render(escaped) if html_body else ''), "預覽成功"
+
+    def benchmark_templates(self, kind, count=5000):
+        """測量批次產生郵件的速度
+
+        Returns:
+            (每秒封數, 總耗時 ms)
+        """
+        batch = self.mail_batch(kind)
+        sample = MAIL_TEMPLATE_SAMPLE
+        values = [mail_values(kind, f"user{i}@example.com", f"{sample['name']}{i}",
+                              sample['timestamp'], sample['keywords'], sample['team']) for i in range(count)]
+        start = time.perf_counter()
+        for v in values:
+            batch.render(v['email'], v)
+        elapsed = time.perf_counter() - start
+        return count / elapsed if elapsed else float('inf'), elapsed * 1000
+
+    def build_draw_message(self, to_email, to_name, timestamp):
+        """產生抽籤通知郵件"""
+        return self.mail_batch('draw').render(
+            to_email, mail_values('draw', to_email, to_name, timestamp))
+
     def send_email(self, to_email, to_name, timestamp):
         """傳送郵件通知
 
@@ -275,27 +4237,11 @@ class LotterySystem:
 
         try:
             # 建立郵件
-            msg = MIMEMultipart()
-            msg['From'] = self.config['from_email']
-            msg['To'] = to_email
-            msg['Subject'] = '抽籤通知'
-
-            # 郵件正文
-            body = f"""您好 {to_name},
-
-恭喜您在本次抽籤中被抽中!
-
-抽籤時間: {timestamp}
-
-此郵件由抽籤系統自動傳送。
-"""
-            msg.attach(MIMEText(body, 'plain', 'utf-8'))
+            msg = self.build_draw_message(to_email, to_name, timestamp)
 
             # 連接 SMTP 伺服器並傳送
-            server = smtplib.SMTP(self.config['smtp_server'], self.config['smtp_port'])
-            server.starttls()
-            server.login(self.config['smtp_user'], self.config['smtp_password'])
-            server.send_message(msg)
+            server = self.smtp_connect()
+            msg.send(server)
             server.quit()
 
             return True, "郵件傳送成功"
@@ -309,23 +4255,11 @@ class LotterySystem:
             return False, "郵件設定不完整"
 
         try:
-            msg = MIMEMultipart()
-            msg['From'] = self.config['from_email']
-            msg['To'] = test_email
-            msg['Subject'] = '抽籤系統 - 測試郵件'
-
-            body = """這是一封測試郵件。
+            msg = self.mail_batch('test').render(test_email, mail_values(
+                'test', test_email, timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
 
-如果您收到此郵件,說明 SMTP 設定正確。
-
-此郵件由抽籤系統自動傳送。
-"""
-            msg.attach(MIMEText(body, 'plain', 'utf-8'))
-
-            server = smtplib.SMTP(self.config['smtp_server'], self.config['smtp_port'])
-            server.starttls()
-            server.login(self.config['smtp_user'], self.config['smtp_password'])
-            server.send_message(msg)
+            server = self.smtp_connect()
+            msg.send(server)
             server.quit()
 
             return True, "測試郵件傳送成功"
@@ -348,22 +4282,20 @@ class LotterySystem:
         if not keyword:
             return False, "關鍵字不能為空"
 
-        # 找到參與者
-        participant = None
-        for p in self.participants:
-            if p['email'] == email:
-                participant = p
-                break
+        with self._participants_lock:
+            self.sync_participants()
+            # 找到參與者
+            participant = self._find_participant(email)
 
-        if not participant:
-            return False, "找不到該參與者"
+            if participant is None:
+                return False, "找不到該參與者"
 
-        # 檢查關鍵字是否已存在
-        if keyword in participant['keywords']:
-            return False, "該參與者已有此關鍵字"
+            # 檢查關鍵字是否已存在
+            if keyword in participant['keywords']:
+                return False, "該參與者已有此關鍵字"
 
-        participant['keywords'].append(keyword)
-        self.save_participants()
+            participant['keywords'].append(keyword)
+        self.mark_participants_dirty()
         return True, "新增成功"
 
     def remove_keyword_from_participant(self, email, keyword):
@@ -373,12 +4305,14 @@ class LotterySystem:
             email: 參與者郵箱
             keyword: 關鍵字
         """
-        for p in self.participants:
-            if p['email'] == email:
-                if keyword in p['keywords']:
-                    p['keywords'].remove(keyword)
-                self.save_participants()
-                break
+        with self._participants_lock:
+            self.sync_participants()
+            p = self._find_participant(email)
+            if p is None:
+                return
+            if keyword in p['keywords']:
+                p['keywords'].remove(keyword)
+        self.mark_participants_dirty()
 
     def batch_import_keywords_for_participant(self, email, text_data):
         """為指定參與者批次匯入關鍵字
@@ -408,6 +4342,31 @@ class LotterySystem:
 
         return success_count, fail_count
 
+    def search_participants(self, query, limit=20):
+        """依姓名或郵箱即時搜尋參與者 (前綴 / 子字串)
+
+        Returns:
+            [(郵箱, 姓名), ...] 最多 limit 筆
+        """
+        with self._participants_lock:
+            if self._search_index is None:
+                names = self.participants.names if self.compact and not self._is_snapshot() else \
+                    [self._participant_at(row)['name'] for row in range(len(self._participant_emails()))]
+                self._search_index = ParticipantSearchIndex(zip(names, self._participant_emails()))
+            return self._search_index.search(query, limit)
+
+    @_synchronized('_participants_lock')
+    def get_participants(self, offset=0, limit=None):
+        """依名冊順序取得一頁參與者
+
+        Returns:
+            (total, participants) - 名冊總人數與 offset 起最多 limit 位參與者
+        """
+        total = len(self._participant_emails())
+        stop = total if limit is None else min(total, offset + limit)
+        return total, [self._participant_at(row) for row in range(max(0, offset), stop)]
+
+    @_synchronized('_participants_lock')
     def get_participant_by_email(self, email):
         """根據郵箱取得參與者
 
@@ -417,28 +4376,37 @@ class LotterySystem:
         Returns:
             participant dict or None
         """
-        for p in self.participants:
-            if p['email'] == email:
-                return p
-        return None
+        if self.compact or self._is_snapshot():
+            row = self.participants.find(email)
+            return None if row is None else self.participants.get(row)
+        return self._find_participant(email)
 
     # ========== 關鍵字抽籤邏輯 ==========
 
-    def draw_keywords(self, participant_count):
+    @_synchronized('_participants_lock')
+    def draw_keywords(self, participant_count, recent_window=0, recent_policy='exclude',
+                      recent_penalty=0.25, seed=None):
         """執行關鍵字抽籤 - 每人抽取2個關鍵字（分兩輪進行）
 
         新規則:
         - 每位參與者從其他所有參與者的關鍵字中抽取
         - 不會抽到自己的關鍵字
         - 兩輪抽籤中都不會出現重複的關鍵字（第一輪抽過的關鍵字，第二輪不會再出現）
+        - 可選: 避免再分配到最近幾次抽籤中分配過給同一人的關鍵字
 
         Args:
             participant_count: 參與人數
+            recent_window: 回看最近幾次關鍵字抽籤 (0 表示不限制)
+            recent_policy: 'exclude' 排除近期分配過的關鍵字, 'penalize' 降低其機率
+            recent_penalty: penalize 時近期關鍵字的相對權重 (0~1)
+            seed: 指定本次抽籤的種子 (預設由亂數來源產生)
 
         Returns:
             (success, result_dict, message)
             result_dict 格式: {email: {name, email, keywords: [kw1, kw2]}, ...}
+            (KeywordDrawResult, rng 屬性記錄亂數來源與種子)
         """
+        self.sync_participants()
         if not self.participants:
             return False, {}, "參與者清單為空"
 
@@ -446,71 +4414,170 @@ class LotterySystem:
         if participant_count > len(self.participants):
             return False, {}, f"參與人數超過總參與者數（總數: {len(self.participants)}）"
 
-        # 隨機選擇參與者
-        selected_participants = random.sample(self.participants, participant_count)
+        roster = self._keyword_roster()
 
-        # 建立全域關鍵字池 (所有參與者的關鍵字)
-        all_keywords = []
-        for p in self.participants:
-            all_keywords.extend(p['keywords'])
-
-        if len(all_keywords) < participant_count * 2:
-            return False, {}, f"關鍵字總數不足（總數: {len(all_keywords)}, 需要: {participant_count * 2}）"
-
-        # 初始化結果字典
-        result_dict = {}
-        for participant in selected_participants:
-            result_dict[participant['email']] = {
-                'name': participant['name'],
-                'email': participant['email'],
-                'keywords': []
+        # 隨機選擇參與者 (以列號表示)
+        rng, info = self.rng.generator(seed)
+        selected_rows = rng.sample(range(len(roster)), participant_count)
+
+        # 全域關鍵字池 (所有參與者的關鍵字) 即 CSR 的 kw_ids
+        if len(roster.kw_ids) < participant_count * 2:
+            return False, {}, f"關鍵字總數不足（總數: {len(roster.kw_ids)}, 需要: {participant_count * 2}）"
+
+        banned = self._recent_keyword_bans(roster, selected_rows, recent_window)
+        banned_weight = recent_penalty if recent_policy == 'penalize' else 0.0
+
+        # 兩輪抽籤: 每輪每人抽 1 個關鍵字, 排除自己的關鍵字與兩輪中已使用的關鍵字
+        assignments, failure = _draw_keyword_ids(
+            roster.kw_offsets, roster.kw_ids, len(roster.keyword_strings),
+            selected_rows, rng, banned=banned, banned_weight=banned_weight
+        )
+        if failure:
+            round_no, index, available = failure
+            round_text = '第一輪' if round_no == 1 else '第二輪'
+            name = roster.names[selected_rows[index]]
+            return False, {}, f"{round_text}: 參與者 {name} 的可用關鍵字不足（可用: {available}, 需要: 1）"
+
+        # 在邊界轉回 dict 形狀的結果
+        result_dict = KeywordDrawResult()
+        strings = roster.keyword_strings
+        for row, ids in zip(selected_rows, assignments):
+            email = roster.emails[row]
+            result_dict[email] = {
+                'name': roster.names[row],
+                'email': email,
+                'keywords': [strings[k] for k in ids]
             }
 
-        # 全域已使用關鍵字（兩輪共用，確保完全不重複）
-        used_keywords_global = []
-
-        # 第一輪抽籤 - 每人抽 1 個關鍵字
-        for participant in selected_participants:
-            # 建立當前參與者可用的關鍵字池:
-            # 1. 排除自己的關鍵字
-            # 2. 排除全域已使用的關鍵字
-            available_for_this_participant = []
-            for p in self.participants:
-                if p['email'] != participant['email']:  # 不抽自己的關鍵字
-                    for keyword in p['keywords']:
-                        if keyword not in used_keywords_global:  # 避免重複
-                            available_for_this_participant.append(keyword)
-
-            if len(available_for_this_participant) < 1:
-                return False, {}, f"第一輪: 參與者 {participant['name']} 的可用關鍵字不足（可用: {len(available_for_this_participant)}, 需要: 1）"
-
-            # 為當前參與者抽取 1 個關鍵字
-            keyword = random.choice(available_for_this_participant)
-            result_dict[participant['email']]['keywords'].append(keyword)
-            used_keywords_global.append(keyword)
-
-        # 第二輪抽籤 - 每人再抽 1 個關鍵字
-        for participant in selected_participants:
-            # 建立當前參與者可用的關鍵字池:
-            # 1. 排除自己的關鍵字
-            # 2. 排除全域已使用的關鍵字（包含第一輪）
-            available_for_this_participant = []
-            for p in self.participants:
-                if p['email'] != participant['email']:  # 不抽自己的關鍵字
-                    for keyword in p['keywords']:
-                        if keyword not in used_keywords_global:  # 避免重複
-                            available_for_this_participant.append(keyword)
-
-            if len(available_for_this_participant) < 1:
-                return False, {}, f"第二輪: 參與者 {participant['name']} 的可用關鍵字不足（可用: {len(available_for_this_participant)}, 需要: 1）"
-
-            # 為當前參與者抽取 1 個關鍵字
-            keyword = random.choice(available_for_this_participant)
-            result_dict[participant['email']]['keywords'].append(keyword)
-            used_keywords_global.append(keyword)
+        if self.audit_draws and 'seed' in info:
+            offsets, kw_ids = roster.kw_offsets, roster.kw_ids
+            info['input'] = self.audit.put({
+                'kind': 'keyword',
+                'roster': [[roster.emails[row], [strings[k] for k in kw_ids[offsets[row]:offsets[row + 1]]]]
+                           for row in range(len(roster))],
+                'count': participant_count,
+                'banned': None if banned is None else {
+                    roster.emails[row]: sorted(strings[k] for k in ids)
+                    for row, ids in zip(selected_rows, banned) if ids},
+                'banned_weight': banned_weight,
+            })
+        result_dict.rng = info
 
         return True, result_dict, "抽籤成功"
 
+    def _keyword_roster(self):
+        """建立 (或直接使用) 以整數關鍵字 ID 表示的緊湊名冊"""
+        if self._is_snapshot():
+            roster = self.participants.to_compact_roster()
+        elif self.compact:
+            roster = self.participants
+        else:
+            roster = CompactRoster.from_participants(self.participants)
+        roster.compact()
+        return roster
+
+    def _recent_keyword_bans(self, roster, rows, recent_window):
+        """近期分配過的 (參與者, 關鍵字) 組合, 轉為與 rows 對應的關鍵字 ID 集合 (不限制時為 None)"""
+        if recent_window <= 0:
+            return None
+        stats = self.keyword_history_stats.ensure_built()
+        banned = []
+        with stats.lock:
+            for row in rows:
+                assigned = stats.pairs.get(roster.emails[row], {})
+                banned.append({roster.keyword_ids[k] for k, number in assigned.items()
+                               if k in roster.keyword_ids and stats.is_recent(number, recent_window)})
+        return banned
+
+    def draw_keywords_sharded(self, groups, recent_window=0, recent_policy='exclude',
+                              recent_penalty=0.25, seed=None, workers=None):
+        """分群關鍵字抽籤 - 依群組 (例如樓層、部門) 各自進行關鍵字交換, 並行執行後合併成一筆結果
+
+        群組內所有人參加, 每人從同群組其他人的關鍵字中抽取 2 個, 規則與 draw_keywords 相同。
+        各群組的種子由本次種子衍生, 在行程池中並行抽籤, 總耗時約為最大群組的耗時。
+
+        Args:
+            groups: {郵箱: 群組}; 沒有列出的參與者不參加
+            recent_window / recent_policy / recent_penalty: 同 draw_keywords
+            seed: 指定本次抽籤的種子 (預設由亂數來源產生)
+            workers: 工作行程數 (預設為 CPU 數, 1 表示在目前行程中依序執行)
+
+        Returns:
+            (success, result_dict, message) - result_dict 為 KeywordDrawResult,
+            依群組順序排列, groups 屬性為 [[群組, 人數], ...]
+        """
+        self.sync_participants()
+        if not self.participants:
+            return False, {}, "參與者清單為空"
+
+        roster = self._keyword_roster()
+        members = {}
+        for row, email in enumerate(roster.emails):
+            group = groups.get(email)
+            if group is not None:
+                members.setdefault(str(group), []).append(row)
+        if not members:
+            return False, {}, "沒有參與者屬於任何群組"
+        skipped = len(roster) - sum(len(rows) for rows in members.values())
+        shards = sorted(members.items())
+
+        offsets = roster.kw_offsets
+        for group, rows in shards:
+            available = sum(offsets[row + 1] - offsets[row] for row in rows)
+            if available < len(rows) * 2:
+                return False, {}, f"群組 {group} 的關鍵字總數不足（總數: {available}, 需要: {len(rows) * 2}）"
+
+        banned = None
+        if recent_window > 0:
+            rows = [row for _, group_rows in shards for row in group_rows]
+            banned = dict(zip(rows, self._recent_keyword_bans(roster, rows, recent_window)))
+        banned_weight = recent_penalty if recent_policy == 'penalize' else 0.0
+
+        rng, info = self.rng.generator(seed)
+        tasks = keyword_shard_tasks(roster, shards, info, banned, banned_weight)
+        try:
+            results = run_keyword_shards(tasks, workers)
+        except Exception as e:
+            return False, {}, f"分群抽籤失敗: {e}"
+
+        result_dict = KeywordDrawResult()
+        strings = roster.keyword_strings
+        for (group, rows), (order, assignments, failure) in zip(shards, results):
+            if failure:
+                round_no, index, available = failure
+                round_text = '第一輪' if round_no == 1 else '第二輪'
+                name = roster.names[rows[order[index]]]
+                return False, {}, (f"群組 {group} {round_text}: 參與者 {name} 的可用關鍵字不足"
+                                   f"（可用: {available}, 需要: 1）")
+            for i, ids in zip(order, assignments):
+                row = rows[i]
+                email = roster.emails[row]
+                result_dict[email] = {
+                    'name': roster.names[row],
+                    'email': email,
+                    'keywords': [strings[k] for k in ids]
+                }
+        result_dict.groups = [[group, len(rows)] for group, rows in shards]
+
+        if self.audit_draws and 'seed' in info:
+            kw_ids = roster.kw_ids
+            info['input'] = self.audit.put({
+                'kind': 'keyword',
+                'roster': [[roster.emails[row], [strings[k] for k in kw_ids[offsets[row]:offsets[row + 1]]]]
+                           for row in range(len(roster))],
+                'groups': [[group, [roster.emails[row] for row in rows]] for group, rows in shards],
+                'banned': None if banned is None else {
+                    roster.emails[row]: sorted(strings[k] for k in ids)
+                    for row, ids in banned.items() if ids},
+                'banned_weight': banned_weight,
+            })
+        result_dict.rng = info
+
+        message = f"已完成 {len(shards)} 個群組、{len(result_dict)} 人的關鍵字抽籤"
+        if skipped:
+            message += f"（{skipped} 人不屬於任何群組, 未參加）"
+        return True, result_dict, message
+
     # ========== 關鍵字抽籤歷史記錄 ==========
 
     def save_keyword_history(self, result_dict, participant_count, mode, display_mode):
@@ -522,88 +4589,1282 @@ class LotterySystem:
             'display_mode': display_mode,  # 'with_name', 'anonymous'
             'results': result_dict
         }
-        self.keyword_history.append(record)
+        if getattr(result_dict, 'rng', None):
+            record['rng'] = result_dict.rng
+        if getattr(result_dict, 'groups', None):
+            record['groups'] = result_dict.groups
 
         try:
-            with open(self.keyword_history_file, 'w', encoding='utf-8') as f:
-                json.dump(self.keyword_history, f, ensure_ascii=False, indent=2)
+            self.keyword_history.append(record)
         except Exception as e:
             print(f"儲存關鍵字抽籤歷史記錄失敗: {e}")
 
     def load_keyword_history(self):
-        """從檔案載入關鍵字抽籤歷史記錄"""
-        try:
-            if os.path.exists(self.keyword_history_file):
-                with open(self.keyword_history_file, 'r', encoding='utf-8') as f:
-                    self.keyword_history = json.load(f)
-            else:
-                self.keyword_history = []
-        except Exception as e:
-            print(f"載入關鍵字抽籤歷史記錄失敗: {e}")
-            self.keyword_history = []
+        """開啟關鍵字抽籤歷史記錄 (延遲載入, 第一次存取時才讀取檔案)"""
+        self.keyword_history = HistoryStore(self.keyword_history_file,
+                                            legacy_path=self.legacy_keyword_history_file,
+                                            tail_size=self.history_tail_size,
+                                            encode=self.history_codec.encode_keyword,
+                                            decode=self.history_codec.decode_keyword,
+                                            file_lock=self.file_lock)
+        self.keyword_history_index = HistoryIndex(
+            self.keyword_history, lambda record: list(record['results']))
+        self.keyword_history_stats = HistoryStats(self.keyword_history, 'keyword')
 
     def get_keyword_history(self):
-        """取得關鍵字抽籤歷史記錄清單"""
+        """取得關鍵字抽籤歷史記錄 (HistoryStore)"""
         return self.keyword_history
 
+    def query_keyword_history(self, email=None, mode=None, since=None, until=None, limit=200):
+        """以索引查詢關鍵字抽籤歷史記錄
+
+        Returns:
+            (total, records) - 符合總數與最新的 limit 筆記錄 (新到舊)
+        """
+        numbers = self.keyword_history_index.search(email, mode, since, until)
+        newest = list(numbers[-limit:])[::-1] if limit else list(numbers)[::-1]
+        return len(numbers), self.keyword_history.read_many(newest)
+
+    def iter_keyword_history(self, email=None, mode=None, since=None, until=None):
+        """依條件由舊到新逐筆產生關鍵字抽籤歷史記錄"""
+        return self._iter_query(self.keyword_history, self.keyword_history_index,
+                                email, mode, since, until)
+
+    def export_keyword_history(self, path, fmt=None, email=None, mode=None, since=None, until=None):
+        """串流匯出關鍵字抽籤歷史記錄 (CSV 每位參與者一列, JSONL 每筆記錄一行)
+
+        Returns:
+            (success, count, message)
+        """
+        try:
+            count = export_records(path, self.iter_keyword_history(email, mode, since, until),
+                                   KEYWORD_HISTORY_FIELDS, keyword_history_rows, fmt)
+        except Exception as e:
+            return False, 0, f"匯出關鍵字抽籤記錄失敗: {e}"
+        return True, count, f"已匯出 {count} 筆關鍵字抽籤記錄到 {path}"
+
+    def iter_participants(self):
+        """依名冊順序逐筆產生參與者 dict"""
+        with self._participants_lock:
+            for row in range(len(self._participant_emails())):
+                yield self._participant_at(row)
+
+    def export_participants(self, path, fmt=None):
+        """串流匯出參與者名冊 (含關鍵字)
+
+        Returns:
+            (success, count, message)
+        """
+        try:
+            count = export_records(path, self.iter_participants(), ROSTER_FIELDS, roster_rows, fmt)
+        except Exception as e:
+            return False, 0, f"匯出參與者失敗: {e}"
+        return True, count, f"已匯出 {count} 位參與者到 {path}"
+
     def clear_keyword_history(self):
         """清空關鍵字抽籤歷史記錄"""
-        self.keyword_history = []
         try:
-            if os.path.exists(self.keyword_history_file):
-                os.remove(self.keyword_history_file)
+            self.keyword_history.clear()
         except Exception as e:
             print(f"清空關鍵字抽籤歷史記錄失敗: {e}")
 
-    # ========== 關鍵字抽籤郵件傳送 ==========
+    # ========== 分組 ==========
+
+    @_synchronized('_participants_lock')
+    def partition_teams(self, team_count, attributes=None, separate=None, seed=None):
+        """將所有參與者隨機分成 team_count 組 (洗牌後依序發牌)
+
+        Args:
+            team_count: 組數
+            attributes: {郵箱: 屬性} (例如部門), 每種屬性平均分到各組; 沒有列出的人視為同一種屬性
+            separate: 必須分到不同組的郵箱清單的清單
+            seed: 指定本次分組的種子 (預設由亂數來源產生)
+
+        Returns:
+            (success, result, message) - result 為 TeamResult:
+            [{team, members: [{name, email}, ...]}, ...], rng 屬性記錄亂數來源與種子
+        """
+        self.sync_participants()
+        emails = self._participant_emails()
+        if team_count < 1:
+            return False, [], "組數至少為 1"
+        if len(emails) < team_count:
+            return False, [], f"參與人數少於組數（參與者: {len(emails)}, 組數: {team_count}）"
+
+        strata = None
+        if attributes:
+            strata_ids = {}
+            strata = [strata_ids.setdefault(attributes.get(email), len(strata_ids)) for email in emails]
+
+        rows_of = None
+        groups = []
+        unknown = 0
+        if separate:
+            rows_of = {email: row for row, email in enumerate(emails)}
+            for group in separate:
+                rows = list(dict.fromkeys(rows_of[e] for e in group if e in rows_of))
+                unknown += sum(1 for e in group if e not in rows_of)
+                if len(rows) > 1:
+                    groups.append(rows)
+
+        rng, info = self.rng.generator(seed)
+        try:
+            team_of, relaxed = partition_rows(len(emails), team_count, rng, strata, groups)
+        except ValueError as e:
+            return False, [], f"分組失敗: {e}"
+
+        members = [[] for _ in range(team_count)]
+        for name, email, team in zip(self._participant_names(), emails, team_of):
+            members[team].append({'name': name, 'email': email})
+        result = TeamResult({'team': number, 'members': team_members}
+                            for number, team_members in enumerate(members, 1))
+        result.rng = info
+
+        message = f"已將 {len(emails)} 人分成 {team_count} 組"
+        if relaxed:
+            message += f"（{relaxed} 次交換無法維持屬性平衡）"
+        if unknown:
+            message += f"（{unknown} 個必須分開的郵箱不在名冊中）"
+        return True, result, message
+
+    def save_team_history(self, result, mode, balance=None):
+        """保存分組歷史記錄
+
+        Args:
+            balance: 平衡的屬性說明 (例如 "部門"), 沒有平衡時為 None
+        """
+        record = {
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'team_count': len(result),
+            'participant_count': sum(len(team['members']) for team in result),
+            'mode': mode,
+            'balance': balance,
+            'teams': result
+        }
+        if getattr(result, 'rng', None):
+            record['rng'] = result.rng
+
+        try:
+            self.team_history.append(record)
+        except Exception as e:
+            print(f"儲存分組歷史記錄失敗: {e}")
+
+    def load_team_history(self):
+        """開啟分組歷史記錄 (延遲載入, 第一次存取時才讀取檔案)"""
+        self.team_history = HistoryStore(self.team_history_file,
+                                         tail_size=self.team_history_tail_size,
+                                         encode=self.history_codec.encode_teams,
+                                         decode=self.history_codec.decode_teams,
+                                         file_lock=self.file_lock)
+
+    def get_team_history(self):
+        """取得分組歷史記錄 (HistoryStore)"""
+        return self.team_history
+
+    def clear_team_history(self):
+        """清空分組歷史記錄"""
+        try:
+            self.team_history.clear()
+        except Exception as e:
+            print(f"清空分組歷史記錄失敗: {e}")
+
+    def send_team_emails(self, result, timestamp, connections=4):
+        """以共用的郵件骨架與 SMTP 連線池通知每位參與者的組別
+
+        Returns:
+            (success, failed, message) - failed 為 [(郵箱, 錯誤訊息), ...]
+        """
+        if not self.validate_config():
+            return False, [], "郵件設定不完整,請先在設定頁面設定 SMTP"
+
+        batch = self.mail_batch('team')
+        messages, recipients = [], []
+        for team in result:
+            # 同組共用的欄位只產生一次
+            shared = {'team': team['team'], 'team_count': len(result), 'team_size': len(team['members']),
+                      'teammates': '\n'.join(p['name'] for p in team['members'])}
+            for p in team['members']:
+                messages.append(batch.render(p['email'], mail_values('team', p['email'], p['name'],
+                                                                     timestamp, team=shared)))
+                recipients.append(p['email'])
+
+        pool = SMTPConnectionPool(self.smtp_connect, min(connections, max(1, len(messages))))
+        try:
+            results = pool.send_batch(messages)
+        except Exception as e:
+            return False, [], f"郵件傳送失敗: {e}"
+        finally:
+            pool.close()
+        failed = [(email, error) for email, (ok, _, error) in zip(recipients, results) if not ok]
+        sent = len(messages) - len(failed)
+        return not failed, failed, f"已傳送 {sent} 封分組通知" + (f"，{len(failed)} 封失敗" if failed else "")
+
+    # ========== 重播驗證 ==========
+
+    def replay_draw(self, number=-1, kind='draw', candidates=None):
+        """以記錄的種子與抽籤輸入重新推導結果, 驗證歷史記錄未被竄改
+
+        Args:
+            number: 記錄編號 (負數表示由最新往回數)
+            kind: 'draw' 禮物抽籤或 'keyword' 關鍵字抽籤
+            candidates: 禮物抽籤當時的候選郵箱 (依名冊順序, 已排除已抽取者);
+                        未以 --audit 保存抽籤輸入時, 以記錄中的雜湊確認後重播
+
+        Returns:
+            (match, record, message)
+        """
+        store = self.history if kind == 'draw' else self.keyword_history
+        total = len(store)
+        requested = number
+        if number < 0:
+            number += total
+        if not 0 <= number < total:
+            return False, None, f"沒有記錄 #{requested}（共 {total} 筆）"
+        record = store.read_many([number])[0]
+        info = record.get('rng')
+        if not info or 'input' not in info:
+            return False, record, f"記錄 #{number} 沒有可重播的種子與抽籤輸入（抽籤時需以 --audit 保存抽籤輸入）"
+
+        try:
+            rng = RandomSource.replay(info)
+            if candidates is not None and kind == 'draw':
+                doc = {'kind': 'draw', 'candidates': list(candidates), 'weights': None,
+                       'count': len(record['selected'])}
+                if DrawAuditStore.digest(doc) != info['input']:
+                    return False, record, f"記錄 #{number} 的抽籤輸入與提供的候選名單不符"
+            elif not os.path.exists(self.audit._path(info['input'])):
+                return False, record, (f"記錄 #{number} 未保存抽籤輸入（抽籤時需以 --audit 保存, "
+                                       f"或以 --roster 提供當時的候選名單）")
+            else:
+                doc = self.audit.get(info['input'])
+            if kind == 'draw':
+                if doc.get('kind') == 'stream':
+                    expected = replay_stream_input(doc, rng)
+                else:
+                    expected = replay_draw_input(doc, rng)
+                actual = [p['email'] for p in record['selected']]
+            else:
+                if 'groups' in doc:
+                    expected = replay_sharded_keyword_input(doc, info)
+                else:
+                    expected = replay_keyword_input(doc, rng)
+                actual = {email: data['keywords'] for email, data in record['results'].items()}
+        except (OSError, ValueError, KeyError) as e:
+            return False, record, f"重播失敗: {e}"
+
+        if expected != actual:
+            return False, record, f"記錄 #{number} 與重播結果不符"
+        return True, record, f"記錄 #{number} 重播一致（{info['backend']}, 種子 {info['seed']}）"
+
+    # ========== 統計 ==========
+
+    def get_win_stats(self, now=None):
+        """目前參與者的中獎統計與均勻性檢定
+
+        Returns:
+            (rows, test) - rows 依中獎次數由多到少:
+            [{name, email, wins, last_win, days_since}, ...];
+            test 為 uniformity_test 的結果 (以目前名冊為類別)
+        """
+        stats = self.history_stats.ensure_built()
+        now = now or datetime.now()
+        rows = []
+        for p in self.iter_participants():
+            email = p['email']
+            last = stats.last_win.get(email)
+            days = None
+            if last:
+                try:
+                    days = (now - datetime.strptime(last, '%Y-%m-%d %H:%M:%S')).days
+                except ValueError:
+                    pass
+            rows.append({'name': p['name'], 'email': email, 'wins': stats.wins.get(email, 0),
+                         'last_win': last, 'days_since': days})
+        rows.sort(key=lambda row: (-row['wins'], row['last_win'] or ''))
+        return rows, uniformity_test(row['wins'] for row in rows)
+
+    def get_keyword_stats(self):
+        """關鍵字被抽中次數與均勻性檢定
+
+        Returns:
+            (rows, test) - rows 依次數由多到少: [(關鍵字, 次數), ...];
+            test 以目前所有參與者的關鍵字 (及曾被抽中的關鍵字) 為類別
+        """
+        stats = self.keyword_history_stats.ensure_built()
+        with stats.lock:
+            picks = dict(stats.picks)
+        pool = set(picks)
+        for p in self.iter_participants():
+            pool.update(p['keywords'])
+        rows = sorted(((k, picks.get(k, 0)) for k in pool), key=lambda row: (-row[1], row[0]))
+        return rows, uniformity_test(count for _, count in rows)
+
+    # ========== 歷史記錄封存 ==========
+
+    def rotate_history(self, period=None, codec=None, current=None):
+        """將兩種歷史記錄中目前期間之前的記錄移到壓縮封存分段
+
+        Returns:
+            (success, moved, message) - moved 為 (禮物抽籤筆數, 關鍵字抽籤筆數)
+        """
+        period = period or self.history_rotate_period
+        codec = self.history_archive_codec if codec is None else codec
+        try:
+            moved = (self.history.rotate(period, codec, current),
+                     self.keyword_history.rotate(period, codec, current))
+        except Exception as e:
+            return False, (0, 0), f"封存歷史記錄失敗: {e}"
+        return True, moved, f"已封存 {moved[0]} 筆抽籤記錄、{moved[1]} 筆關鍵字抽籤記錄"
+
+    def compact_history_archive(self, codec=None):
+        """合併封存分段並改用指定壓縮方式
+
+        Returns:
+            (success, rewritten, message)
+        """
+        codec = self.history_archive_codec if codec is None else codec
+        try:
+            rewritten = self.history.compact_archive(codec) + self.keyword_history.compact_archive(codec)
+        except Exception as e:
+            return False, 0, f"整理歷史封存失敗: {e}"
+        return True, rewritten, f"已重新寫入 {rewritten} 個封存分段"
+
+    def _auto_rotate_history(self):
+        """熱檔筆數超過門檻時自動封存 (只處理本次執行中開啟過的歷史記錄)"""
+        if self.history_rotate_threshold is None:
+            return
+        for store in (self.history, self.keyword_history):
+            if store.is_open and store.hot_count > self.history_rotate_threshold:
+                try:
+                    store.rotate(self.history_rotate_period, self.history_archive_codec)
+                except Exception as e:
+                    print(f"封存歷史記錄失敗: {e}")
+
+    # ========== 關鍵字抽籤郵件傳送 ==========
+
+    def send_keyword_email(self, to_email, to_name, keywords, timestamp):
+        """傳送關鍵字抽籤郵件通知
+
+        Args:
+            to_email: 收件人郵箱
+            to_name: 收件人姓名
+            keywords: 抽到的關鍵字列表 [keyword1, keyword2]
+            timestamp: 抽籤時間
+
+        Returns:
+            (success, message)
+        """
+        if not self.validate_config():
+            return False, "郵件設定不完整,請先在設定頁面設定 SMTP"
+
+        try:
+            # 建立郵件
+            msg = self.mail_batch('keyword').render(
+                to_email, mail_values('keyword', to_email, to_name, timestamp, keywords))
+
+            # 連接 SMTP 伺服器並傳送
+            server = self.smtp_connect()
+            msg.send(server)
+            server.quit()
+
+            return True, "郵件傳送成功"
+
+        except Exception as e:
+            return False, f"郵件傳送失敗: {str(e)}"
+
+
+# ========== HTTP JSON API ==========
+
+class LotteryAPIHandler(BaseHTTPRequestHandler):
+    """HTTP JSON API 請求處理 (ThreadingHTTPServer 每條連線一個執行緒)
+
+    回應格式: {"success": bool, "message": str, "data": ...}
+    名冊、抽籤與歷史記錄的並行安全由 LotterySystem / HistoryStore 的鎖負責。
+    """
+
+    server_version = 'LotteryAPI/1.0'
+    protocol_version = 'HTTP/1.1'  # keep-alive, 同一條連線可連續送出請求
+    disable_nagle_algorithm = True  # 標頭與內容分兩次寫出, 避免與延遲 ACK 互相等待
+
+    ROUTES = {
+        ('GET', '/api/status'): 'get_status',
+        ('GET', '/api/participants'): 'get_participants',
+        ('POST', '/api/participants'): 'add_participants',
+        ('POST', '/api/participants/remove'): 'remove_participants',
+        ('POST', '/api/draw'): 'draw',
+        ('POST', '/api/keyword-draw'): 'keyword_draw',
+        ('POST', '/api/teams'): 'teams',
+        ('GET', '/api/history'): 'get_history',
+        ('GET', '/api/keyword-history'): 'get_keyword_history',
+    }
+    MAX_LIMIT = 500
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _dispatch(self, method):
+        url = urlparse(self.path)
+        name = self.ROUTES.get((method, url.path.rstrip('/')))
+        try:
+            body = self._read_json() if method == 'POST' else {}
+            if name is None:
+                return self._send(404, False, f"找不到 API: {method} {url.path}")
+            if self.server.token and \
+                    self.headers.get('Authorization') != f'Bearer {self.server.token}':
+                return self._send(401, False, "未授權")
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            success, message, data = getattr(self, 'api_' + name)(self.server.lottery, query, body)
+        except (ValueError, TypeError, KeyError) as e:
+            return self._send(400, False, f"請求格式錯誤: {e}")
+        except Exception as e:
+            return self._send(500, False, f"伺服器錯誤: {e}")
+        self._send(200 if success else 409, success, message, data)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        data = json.loads(self.rfile.read(length))
+        if not isinstance(data, dict):
+            raise ValueError("請求內容必須是 JSON 物件")
+        return data
+
+    def _send(self, status, success, message, data=None):
+        payload = json.dumps({'success': success, 'message': message, 'data': data},
+                             ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _limit(self, query, default):
+        return max(0, min(int(query.get('limit', default)), self.MAX_LIMIT))
+
+    # ========== 端點 ==========
+
+    def api_get_status(self, lottery, query, body):
+        return True, "ok", lottery.get_summary()
+
+    def api_get_participants(self, lottery, query, body):
+        """?q= 即時搜尋; 否則依 offset / limit 分頁"""
+        limit = self._limit(query, 100)
+        if query.get('q'):
+            matches = lottery.search_participants(query['q'], limit)
+            return True, f"找到 {len(matches)} 位", [
+                {'name': name, 'email': email} for email, name in matches]
+        total, rows = lottery.get_participants(int(query.get('offset', 0)), limit)
+        return True, f"共 {total} 位", {'total': total, 'participants': rows}
+
+    def api_add_participants(self, lottery, query, body):
+        """{"name", "email", "keywords"} 或 {"participants": [...]}"""
+        items = body['participants'] if 'participants' in body else [body]
+        added, failed = 0, []
+        for item in items:
+            success, message = lottery.add_participant(
+                item.get('name', '').strip(), item.get('email', '').strip(), item.get('keywords'))
+            if success:
+                added += 1
+            else:
+                failed.append({'email': item.get('email'), 'message': message})
+        return not failed, f"新增 {added} 位, 失敗 {len(failed)} 位", \
+            {'added': added, 'failed': failed}
+
+    def api_remove_participants(self, lottery, query, body):
+        """{"emails": [...]}"""
+        removed = lottery.remove_participants(body['emails'])
+        return True, f"已刪除 {removed} 位參與者", {'removed': removed}
+
+    def api_draw(self, lottery, query, body):
+        """{"count", "avoid_repeat", "recent_window", "recent_policy", "recent_penalty",
+        "seed", "mode", "record"}; record 為 true (預設) 時寫入歷史記錄"""
+        count = int(body.get('count', 1))
+        success, selected, message = lottery.draw(
+            count, avoid_repeat=bool(body.get('avoid_repeat', True)),
+            recent_window=int(body.get('recent_window', 0)),
+            recent_policy=body.get('recent_policy', 'exclude'),
+            recent_penalty=float(body.get('recent_penalty', 0.25)),
+            seed=body.get('seed'))
+        if success and body.get('record', True):
+            lottery.save_history(selected, count, body.get('mode', 'display'))
+        return success, message, selected
+
+    def api_keyword_draw(self, lottery, query, body):
+        """{"participant_count", "recent_window", "recent_policy", "recent_penalty",
+        "seed", "mode", "display_mode", "record"}
+
+        指定 "groups": {郵箱: 群組} 時改為分群抽籤 (群組內所有人參加, 忽略 participant_count)
+        """
+        options = dict(recent_window=int(body.get('recent_window', 0)),
+                       recent_policy=body.get('recent_policy', 'exclude'),
+                       recent_penalty=float(body.get('recent_penalty', 0.25)),
+                       seed=body.get('seed'))
+        if body.get('groups'):
+            success, result, message = lottery.draw_keywords_sharded(body['groups'], **options)
+            participant_count = len(result)
+        else:
+            participant_count = int(body['participant_count'])
+            success, result, message = lottery.draw_keywords(participant_count, **options)
+        if success and body.get('record', True):
+            lottery.save_keyword_history(result, participant_count, body.get('mode', 'display'),
+                                         body.get('display_mode', 'with_name'))
+        return success, message, result
+
+    def _history(self, search, query):
+        total, records = search(email=query.get('email'), mode=query.get('mode'),
+                                since=query.get('since'), until=query.get('until'),
+                                limit=self._limit(query, 50))
+        return True, f"符合 {total} 筆", {'total': total, 'records': records}
+
+    def api_get_history(self, lottery, query, body):
+        """?email= &mode= &since= &until= &limit= (新到舊)"""
+        return self._history(lottery.query_history, query)
+
+    def api_teams(self, lottery, query, body):
+        """{"teams", "attributes": {郵箱: 屬性}, "separate": [[郵箱...]...], "seed", "mode", "record"}"""
+        success, result, message = lottery.partition_teams(
+            int(body['teams']), attributes=body.get('attributes'), separate=body.get('separate'),
+            seed=body.get('seed'))
+        if success and body.get('record', True):
+            lottery.save_team_history(result, body.get('mode', 'display'),
+                                      'attributes' if body.get('attributes') else None)
+        return success, message, result
+
+    def api_get_keyword_history(self, lottery, query, body):
+        return self._history(lottery.query_keyword_history, query)
+
+
+class LotteryAPIServer(ThreadingHTTPServer):
+    """提供 LotterySystem 的 HTTP JSON API (預設只接受本機連線)"""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, lottery, host='127.0.0.1', port=8765, token=None, verbose=False):
+        """
+        Args:
+            lottery: 共用的 LotterySystem
+            host / port: 監聽位址 (port 為 0 時由系統指定)
+            token: 設定時要求 "Authorization: Bearer <token>"
+            verbose: 是否輸出每個請求的記錄
+        """
+        self.lottery = lottery
+        self.token = token
+        self.verbose = verbose
+        super().__init__((host, port), LotteryAPIHandler)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """在背景執行緒中開始服務"""
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class LotteryAPIClient:
+    """HTTP JSON API 用戶端 (單一 keep-alive 連線, 非執行緒安全)"""
 
-    def send_keyword_email(self, to_email, to_name, keywords, timestamp):
-        """傳送關鍵字抽籤郵件通知
+    def __init__(self, url, token=None, timeout=30):
+        parts = urlparse(url)
+        self.conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+        self.headers = {'Content-Type': 'application/json'}
+        if token:
+            self.headers['Authorization'] = f'Bearer {token}'
 
-        Args:
-            to_email: 收件人郵箱
-            to_name: 收件人姓名
-            keywords: 抽到的關鍵字列表 [keyword1, keyword2]
-            timestamp: 抽籤時間
+    def call(self, method, path, body=None):
+        """送出請求
 
         Returns:
-            (success, message)
+            (status, payload) - payload 為 {"success", "message", "data"}
         """
-        if not self.validate_config():
-            return False, "郵件設定不完整,請先在設定頁面設定 SMTP"
+        data = None if body is None else json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.conn.request(method, path, body=data, headers=self.headers)
+        response = self.conn.getresponse()
+        return response.status, json.loads(response.read())
 
-        try:
-            # 建立郵件
-            msg = MIMEMultipart()
-            msg['From'] = self.config['from_email']
-            msg['To'] = to_email
-            msg['Subject'] = '關鍵字抽籤通知'
+    def close(self):
+        self.conn.close()
 
-            # 郵件正文
-            body = f"""您好 {to_name},
 
-恭喜您在本次關鍵字抽籤中抽到以下關鍵字:
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
 
-1. {keywords[0]}
-2. {keywords[1]}
 
-抽籤時間: {timestamp}
+def run_api_load_test(url, threads=8, requests=250, token=None, draw_every=5):
+    """對 HTTP API 進行並行壓力測試, 並檢查是否有遺失的更新
 
-此郵件由抽籤系統自動傳送。
-"""
-            msg.attach(MIMEText(body, 'plain', 'utf-8'))
+    每個執行緒以一條 keep-alive 連線送出 requests 個請求: 新增唯一的參與者,
+    每 draw_every 個請求改為抽 1 人 (避免重複並寫入歷史記錄)。
+    結束後比對伺服器狀態的變化量與成功的操作數 (測試期間不應有其他用戶端寫入)。
 
-            # 連接 SMTP 伺服器並傳送
-            server = smtplib.SMTP(self.config['smtp_server'], self.config['smtp_port'])
-            server.starttls()
-            server.login(self.config['smtp_user'], self.config['smtp_password'])
-            server.send_message(msg)
-            server.quit()
+    Returns:
+        dict: requests, seconds, rps, p50_ms, p95_ms, p99_ms, errors, added, drawn,
+        delta (伺服器狀態變化量), lost_updates (是否有遺失的更新)
+    """
+    run = uuid.uuid4().hex[:8]
+    client = LotteryAPIClient(url, token)
+    before = client.call('GET', '/api/status')[1]['data']
+    results = [None] * threads
+
+    def worker(t):
+        conn = LotteryAPIClient(url, token)
+        latencies, added, drawn, errors = [], 0, 0, 0
+        try:
+            for i in range(requests):
+                started = time.perf_counter()
+                try:
+                    if draw_every and i % draw_every == draw_every - 1:
+                        status, payload = conn.call('POST', '/api/draw', {'count': 1})
+                        drawn += payload['success']
+                    else:
+                        status, payload = conn.call('POST', '/api/participants', {
+                            'name': f'壓測 {t}-{i}', 'email': f'load-{run}-{t}-{i}@example.com'})
+                        added += payload['success']
+                    errors += status >= 500 or status in (400, 401)
+                except (OSError, http.client.HTTPException, ValueError):
+                    errors += 1
+                    conn.close()
+                    conn = LotteryAPIClient(url, token)
+                latencies.append(time.perf_counter() - started)
+        finally:
+            conn.close()
+        results[t] = (latencies, added, drawn, errors)
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    after = client.call('GET', '/api/status')[1]['data']
+    client.close()
+
+    latencies = sorted(value for result in results for value in result[0])
+    added = sum(result[1] for result in results)
+    drawn = sum(result[2] for result in results)
+    delta = {key: after[key] - before[key] for key in ('participants', 'drawn', 'history')}
+    return {
+        'requests': len(latencies),
+        'threads': threads,
+        'seconds': seconds,
+        'rps': len(latencies) / seconds if seconds else 0.0,
+        'p50_ms': _percentile(latencies, 0.50) * 1000,
+        'p95_ms': _percentile(latencies, 0.95) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'errors': sum(result[3] for result in results),
+        'added': added,
+        'drawn': drawn,
+        'delta': delta,
+        'lost_updates': delta != {'participants': added, 'drawn': drawn, 'history': drawn},
+    }
+
+
+# ========== 情境演練 ==========
+
+class _SMTPStandInHandler(socketserver.StreamRequestHandler):
+    """本機 SMTP 替身的連線處理: 接受任何帳號密碼, 郵件只計數不投遞"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost lottery SMTP stand-in')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line[:4].upper()
+            if verb == b'EHLO':
+                self.wfile.write(b'250-localhost\r\n250-AUTH PLAIN LOGIN\r\n250 8BITMIME\r\n')
+            elif verb == b'AUTH':
+                self.reply('235 Authentication successful')
+            elif verb == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                size = 0
+                for data in self.rfile:
+                    if data == b'.\r\n':
+                        break
+                    size += len(data)
+                if self.server.delay:
+                    time.sleep(self.server.delay)
+                self.server.record(size)
+                self.reply('250 OK')
+            elif verb == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:  # HELO / MAIL / RCPT / RSET / NOOP
+                self.reply('250 OK')
+
+
+class LocalSMTPServer(socketserver.ThreadingTCPServer):
+    """本機 SMTP 替身 - 情境演練時取代真正的郵件伺服器
+
+    每條連線一個執行緒, 接受任何帳號密碼; 郵件只計算封數與大小。
+    delay 為每封郵件的模擬傳送延遲 (秒)。
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0):
+        super().__init__((host, port), _SMTPStandInHandler)
+        self.delay = delay
+        self.messages = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+
+    def record(self, size):
+        with self._lock:
+            self.messages += 1
+            self.bytes += size
+
+    def lottery_config(self):
+        """指向本替身的 SMTP 設定 (LotterySystem.config 格式)"""
+        host, port = self.server_address[:2]
+        return {'smtp_server': host, 'smtp_port': port, 'smtp_user': 'scenario',
+                'smtp_password': 'scenario', 'from_email': 'lottery@example.com',
+                'smtp_starttls': False}
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+
+class LatencyStats:
+    """一種操作的延遲統計 - 次數、總和、最大值與固定大小的蓄水池 (長時間執行時記憶體固定)"""
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.samples = []
+        self._rng = random.Random(0)
+
+    def add(self, ms):
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        if len(self.samples) < self.size:
+            self.samples.append(ms)
+        else:
+            j = self._rng.randrange(self.count)
+            if j < self.size:
+                self.samples[j] = ms
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        return {'count': self.count,
+                'mean_ms': self.total_ms / self.count if self.count else 0.0,
+                'p50_ms': _percentile(ordered, 0.5), 'p95_ms': _percentile(ordered, 0.95),
+                'p99_ms': _percentile(ordered, 0.99), 'max_ms': self.max_ms}
+
+
+def _rss_bytes():
+    """目前程序的常駐記憶體 (bytes); 無法取得時為 None"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
 
-            return True, "郵件傳送成功"
 
+def _data_sizes(directory='.'):
+    """資料夾中每個檔案與子資料夾的大小 (bytes)"""
+    sizes = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file():
+                sizes[entry.name] = entry.stat().st_size
+            elif entry.is_dir():
+                sizes[entry.name + '/'] = sum(
+                    os.path.getsize(os.path.join(root, name))
+                    for root, _, files in os.walk(entry.path) for name in files)
+    return sizes
+
+
+def synthetic_participants(count, keywords=3, start=0):
+    """產生合成的參與者 (啟動預算檢查與情境演練用)"""
+    return [{'name': f'參與者{i}', 'email': f'user{i}@example.com',
+             'keywords': [f'關鍵字{i}-{k}' for k in range(keywords)]}
+            for i in range(start, start + count)]
+
+
+def load_scenario(path):
+    """讀取情境腳本 (.yaml / .yml 需要 PyYAML, 其他視為 JSON)
+
+    Raises:
+        ValueError: 腳本格式有誤
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("YAML 情境腳本需要安裝 PyYAML (pip install pyyaml), 或改用 JSON")
+            script = yaml.safe_load(f)
+        else:
+            script = json.load(f)
+    if not isinstance(script, dict) or not isinstance(script.get('steps'), list):
+        raise ValueError("情境腳本需要 steps 清單")
+    for step in script['steps']:
+        if not isinstance(step, dict) or len(step) != 1:
+            raise ValueError(f"每個步驟需為 {{操作: 參數}}: {step!r}")
+        (op, params), = step.items()
+        if op not in ScenarioRunner.OPS:
+            raise ValueError(f"不支援的操作: {op} (可用: {', '.join(ScenarioRunner.OPS)})")
+        if params is not None and not isinstance(params, dict):
+            raise ValueError(f"{op} 的參數需為物件: {params!r}")
+    return script
+
+
+class ScenarioRunner:
+    """依情境腳本驅動 LotterySystem, 量測每種操作的延遲、記憶體與檔案成長
+
+    腳本格式 (JSON 或 YAML):
+        roster: {participants, keywords}   初始合成名冊 (由呼叫端寫入 participants.json)
+        repeat: 10                         steps 重複次數 (有 duration 時重複到時間結束)
+        duration: 3600                     執行秒數
+        report_every: 60                   每隔幾秒記錄一次快照
+        limits: {max_exponent, max_slowdown, max_rss_growth_mb}
+        steps: [{操作: {參數..., repeat}}, ...]
+
+    操作: import / add_keywords / draw / keyword_draw / reset / remove / history / stats / sleep
+    """
+
+    OPS = ('import', 'add_keywords', 'draw', 'keyword_draw', 'reset', 'remove',
+           'history', 'stats', 'sleep')
+    MAX_ERRORS = 20  # 報表保留的錯誤訊息數
+
+    def __init__(self, lottery, script, smtp=None, log=print):
+        self.lottery = lottery
+        self.script = script
+        self.smtp = smtp
+        self.log = log
+        self.rng = random.Random(script.get('seed', 0))
+        self.latency = {}        # 操作 -> LatencyStats (整個執行期間)
+        self.window = {}         # 操作 -> 本次快照期間的延遲清單
+        self.first_window = {}   # 操作 -> 第一個有足夠樣本的期間的快照序號
+        self.series = []
+        self.errors = []
+        self.error_count = 0
+        self.failures = 0        # 操作回傳失敗 (例如可抽取人數不足)
+        self.ops = 0
+        self._next_id = script.get('roster', {}).get('participants', 0)
+
+    # ========== 計時 ==========
+
+    def timed(self, op, func, *args, **kwargs):
+        """執行並記錄一次操作; 例外視為錯誤並回傳 None"""
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
         except Exception as e:
-            return False, f"郵件傳送失敗: {str(e)}"
+            self.error_count += 1
+            if len(self.errors) < self.MAX_ERRORS:
+                self.errors.append(f"{op}: {e}")
+            return None
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            self.ops += 1
+            self.latency.setdefault(op, LatencyStats()).add(ms)
+            self.window.setdefault(op, []).append(ms)
+
+    def check(self, op, result):
+        """(success, ..., message) 形式的回傳值: 失敗時計數, 回傳是否成功"""
+        if result is None:
+            return False
+        if not result[0]:
+            self.failures += 1
+            return False
+        return True
+
+    # ========== 操作 ==========
+
+    def _emails(self):
+        return list(self.lottery._participant_emails())
+
+    def op_import(self, participants=10, keywords=3):
+        for p in synthetic_participants(participants, keywords, self._next_id):
+            self.check('import', self.timed('import', self.lottery.add_participant,
+                                            p['name'], p['email'], p['keywords']))
+        self._next_id += participants
+
+    def op_add_keywords(self, count=10):
+        emails = self._emails()
+        for _ in range(count if emails else 0):
+            self._next_id += 1
+            self.check('add_keywords', self.timed(
+                'add_keywords', self.lottery.add_keyword_to_participant,
+                self.rng.choice(emails), f'演練關鍵字{self._next_id}'))
+
+    def op_draw(self, count=1, avoid_repeat=True, recent_window=0, recent_policy='exclude', email=False):
+        def draw():
+            result = self.lottery.draw(count, avoid_repeat, recent_window, recent_policy)
+            if not result[0] and avoid_repeat:
+                self.lottery.reset_drawn()  # 全部抽完時重新開始
+                result = self.lottery.draw(count, avoid_repeat, recent_window, recent_policy)
+            return result
+        result = self.timed('draw', draw)
+        if not self.check('draw', result):
+            return
+        selected = result[1]
+        self.timed('save_history', self.lottery.save_history,
+                   selected, count, 'email' if email else 'display')
+        if email:
+            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            for p in selected:
+                self._send(self.timed('email', self.lottery.send_email, p['email'], p['name'], timestamp))
+
+    def op_keyword_draw(self, participants=10, recent_window=0, recent_policy='exclude', email=False):
+        participants = min(participants, len(self.lottery.participants))
+        result = self.timed('keyword_draw', self.lottery.draw_keywords,
+                            participants, recent_window, recent_policy)
+        if not self.check('keyword_draw', result):
+            return
+        results = result[1]
+        self.timed('save_keyword_history', self.lottery.save_keyword_history,
+                   results, participants, 'email' if email else 'display', 'with_name')
+        if email:
+            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            for data in results.values():
+                self._send(self.timed('email', self.lottery.send_keyword_email,
+                                      data['email'], data['name'], data['keywords'], timestamp))
+
+    def _send(self, result):
+        if result is not None and not result[0]:
+            self.error_count += 1
+            if len(self.errors) < self.MAX_ERRORS:
+                self.errors.append(f"email: {result[1]}")
+
+    def op_reset(self):
+        self.timed('reset', self.lottery.reset_drawn)
+
+    def op_remove(self, count=1):
+        emails = self._emails()
+        victims = self.rng.sample(emails, min(count, len(emails)))
+        self.timed('remove', self.lottery.remove_participants, victims)
+
+    def op_history(self, limit=50):
+        self.timed('history', self.lottery.query_history, limit=limit)
+        self.timed('keyword_history', self.lottery.query_keyword_history, limit=limit)
+
+    def op_stats(self):
+        self.timed('stats', self.lottery.get_win_stats)
+        self.timed('keyword_stats', self.lottery.get_keyword_stats)
+
+    def op_sleep(self, seconds=1.0):
+        time.sleep(seconds)
+
+    # ========== 執行與報表 ==========
+
+    def snapshot(self, elapsed, interval_ops, interval_s):
+        """記錄一次快照: 期間吞吐量、各操作延遲、記憶體與檔案大小"""
+        ops = {}
+        for op, values in self.window.items():
+            values.sort()
+            ops[op] = {'count': len(values), 'p50_ms': _percentile(values, 0.5),
+                       'p95_ms': _percentile(values, 0.95)}
+            if op not in self.first_window and len(values) >= 5:
+                self.first_window[op] = len(self.series)
+        self.window = {}
+        files = _data_sizes()
+        rss = _rss_bytes()
+        point = {
+            'elapsed_s': round(elapsed, 1),
+            'ops': self.ops,
+            'ops_per_s': interval_ops / interval_s if interval_s else 0.0,
+            'latency': ops,
+            'rss_mb': rss / 1048576 if rss is not None else None,
+            'participants': len(self.lottery.participants),
+            'history': len(self.lottery.history),
+            'keyword_history': len(self.lottery.keyword_history),
+            'data_mb': sum(files.values()) / 1048576,
+            'files': files,
+        }
+        point['size'] = point['participants'] + point['history'] + point['keyword_history']
+        self.series.append(point)
+        slowest = max(ops.items(), key=lambda item: item[1]['p95_ms'], default=None)
+        self.log(f"[{elapsed:8.1f}s] {point['ops_per_s']:8.1f} ops/s  "
+                 f"記憶體 {point['rss_mb'] or 0:7.1f} MB  資料 {point['data_mb']:7.2f} MB  "
+                 f"參與者 {point['participants']}  歷史 {point['history']}/{point['keyword_history']}"
+                 + (f"  最慢 {slowest[0]} p95 {slowest[1]['p95_ms']:.1f} ms" if slowest else ""))
+        return point
+
+    def run(self, duration=None):
+        """執行情境
+
+        Args:
+            duration: 執行秒數 (None 時依腳本的 duration, 沒有時重複 repeat 次)
+
+        Returns:
+            dict 報表 (passed 表示沒有錯誤且未超過 limits)
+        """
+        script = self.script
+        duration = duration if duration is not None else script.get('duration')
+        repeat = script.get('repeat', 1)
+        report_every = script.get('report_every', 60)
+        start = last_report = time.perf_counter()
+        deadline = start + duration if duration else None
+        last_ops = 0
+        self.snapshot(0.0, 0, 0)
+
+        iteration = 0
+        while (deadline is None and iteration < repeat) or \
+                (deadline is not None and time.perf_counter() < deadline):
+            iteration += 1
+            for step in script['steps']:
+                (op, params), = step.items()
+                params = dict(params or {})
+                for _ in range(params.pop('repeat', 1)):
+                    getattr(self, 'op_' + op)(**params)
+                    now = time.perf_counter()
+                    if now - last_report >= report_every:
+                        self.snapshot(now - start, self.ops - last_ops, now - last_report)
+                        last_report, last_ops = now, self.ops
+                    if deadline is not None and now >= deadline:
+                        break
+                if deadline is not None and time.perf_counter() >= deadline:
+                    break
+
+        now = time.perf_counter()
+        if self.ops > last_ops:
+            self.snapshot(now - start, self.ops - last_ops, now - last_report)
+        return self.report(now - start)
+
+    def report(self, elapsed):
+        limits = self.script.get('limits', {})
+        max_exponent = limits.get('max_exponent', 1.5)
+        max_slowdown = limits.get('max_slowdown')
+        max_growth = limits.get('max_rss_growth_mb')
+
+        # 增長比: 最後一個期間與第一個期間的中位數延遲比;
+        # 增長指數: 延遲比對資料量比 (參與者 + 歷史筆數) 的對數斜率, 大於 1 表示超線性變慢
+        slowdown, exponent = {}, {}
+        last = self.series[-1] if self.series else None
+        for op, index in self.first_window.items():
+            first = self.series[index]
+            if index == len(self.series) - 1 or last['latency'].get(op, {}).get('count', 0) < 5:
+                continue
+            before, after = first['latency'][op]['p50_ms'], last['latency'][op]['p50_ms']
+            if before <= 0 or after <= 0:
+                continue
+            slowdown[op] = after / before
+            size_ratio = last['size'] / first['size'] if first['size'] else 0
+            if size_ratio >= 1.5:
+                exponent[op] = math.log(slowdown[op]) / math.log(size_ratio)
+        rss = [p['rss_mb'] for p in self.series if p['rss_mb'] is not None]
+        growth = rss[-1] - rss[0] if rss else None
+
+        problems = [f"{op} 隨資料量超線性變慢 (指數 {value:.2f})" for op, value in exponent.items()
+                    if value > max_exponent]
+        if max_slowdown is not None:
+            problems += [f"{op} 變慢 {ratio:.1f} 倍" for op, ratio in slowdown.items()
+                         if ratio > max_slowdown]
+        if max_growth is not None and growth is not None and growth > max_growth:
+            problems.append(f"記憶體成長 {growth:.1f} MB")
+        if self.error_count:
+            problems.append(f"{self.error_count} 個錯誤")
+        return {
+            'elapsed_s': elapsed,
+            'ops': self.ops,
+            'ops_per_s': self.ops / elapsed if elapsed else 0.0,
+            'latency': {op: stats.summary() for op, stats in self.latency.items()},
+            'slowdown': slowdown,
+            'exponent': exponent,
+            'rss_growth_mb': growth,
+            # 執行不到一分鐘時不換算每小時成長 (啟動時的一次性配置會被放大)
+            'rss_growth_mb_per_hour': growth * 3600 / elapsed if growth is not None and elapsed >= 60 else None,
+            'failures': self.failures,
+            'error_count': self.error_count,
+            'errors': self.errors,
+            'smtp': {'messages': self.smtp.messages, 'bytes': self.smtp.bytes} if self.smtp else None,
+            'series': self.series,
+            'problems': problems,
+            'passed': not problems,
+        }
+
+
+# ========== 事件迴圈延遲監測 ==========
+
+def _stall_stack(frame, owner_class, limit=8):
+    """由主執行緒的堆疊找出造成卡頓的介面回呼與目前所在位置
+
+    Returns:
+        (callback, stack) - callback 為最外層的 owner_class 方法名稱;
+        stack 為本檔案內由外到內的 "函式:行號" 清單 (最多 limit 個)
+    """
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    here = __file__
+    callback = None
+    stack = []
+    prefix = owner_class + '.'
+    for f in frames:
+        code = f.f_code
+        if code.co_filename != here:
+            continue
+        name = getattr(code, 'co_qualname', code.co_name)
+        if callback is None and name.startswith(prefix):
+            callback = name[len(prefix):]
+        stack.append(f"{name}:{f.f_lineno}")
+    if callback is None and stack:
+        callback = stack[0].rsplit(':', 1)[0]
+    return callback or '(Tk)', stack[-limit:]
+
+
+class EventLoopMonitor:
+    """Tk 事件迴圈延遲監測 (選用)
+
+    以 root.after 排程固定間隔的心跳, 心跳實際執行時間與預定時間的差即為排程延遲;
+    背景執行緒發現心跳逾期超過 stall_ms 時, 擷取主執行緒的堆疊, 把卡頓歸屬到
+    當時正在執行的回呼 (例如 animate_snow、refresh_history、send_emails)。
+    卡頓結束後以 JSON Lines 附加到 log_path, 並可在視窗右上角顯示延遲資訊。
+    """
+
+    HUD_REFRESH_MS = 500  # 覆蓋層更新間隔
+    WORST_COUNT = 3       # 覆蓋層列出的最慢卡頓數
+
+    def __init__(self, root, owner_class='LotteryGUI', log_path='ui_stalls.jsonl',
+                 interval_ms=16, stall_ms=100, window_s=5.0):
+        self.root = root
+        self.owner_class = owner_class
+        self.log_path = log_path
+        self.interval_ms = interval_ms
+        self.stall_ms = stall_ms
+        self.frames = deque(maxlen=max(1, int(window_s * 1000 / interval_ms)))  # 心跳間隔 (ms)
+        self.stalls = []      # 本次監測的卡頓事件 (新到舊最多保留 100 筆)
+        self.hud = None
+        self._job = None
+        self._due = 0.0       # 下次心跳的預定時間 (perf_counter)
+        self._last = 0.0
+        self._sample = None   # 背景執行緒擷取的 (callback, stack)
+        self._sample_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watchdog = None
+        self._hud_at = 0.0
+        self._main_ident = threading.get_ident()
+
+    @property
+    def running(self):
+        return self._job is not None
+
+    def start(self, hud=True):
+        """開始監測 (須在 Tk 主執行緒呼叫)"""
+        if self.running:
+            return
+        self._main_ident = threading.get_ident()
+        # 每個監看執行緒使用自己的停止事件, 舊執行緒不會因 clear() 而繼續執行
+        self._stop = threading.Event()
+        if hud:
+            self.hud = tk.Label(self.root, justify='left', anchor='nw',
+                                font=('Courier', 9), bg='#000000', fg='#7CFC00')
+            self.hud.place(relx=1.0, rely=0.0, x=-8, y=8, anchor='ne')
+        self._last = self._due = time.perf_counter() + self.interval_ms / 1000
+        self._job = self.root.after(self.interval_ms, self._heartbeat)
+        self._watchdog = threading.Thread(target=self._watch, args=(self._stop,), daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        """停止監測並移除覆蓋層"""
+        self._stop.set()
+        if self._watchdog is not None:
+            self._watchdog.join()  # 最多等一個輪詢間隔 (stall_ms / 4)
+            self._watchdog = None
+        if self._job is not None:
+            self.root.after_cancel(self._job)
+            self._job = None
+        if self.hud is not None:
+            self.hud.destroy()
+            self.hud = None
+
+    def _heartbeat(self):
+        now = time.perf_counter()
+        self.frames.append((now - self._last) * 1000)
+        self._last = now
+        late_ms = (now - self._due) * 1000
+        if late_ms >= self.stall_ms:
+            with self._sample_lock:
+                sample, self._sample = self._sample, None
+            self._record_stall(late_ms, sample)
+        if self.hud is not None and now - self._hud_at >= self.HUD_REFRESH_MS / 1000:
+            self._hud_at = now
+            self.hud.config(text=self.hud_text())
+        self._due = now + self.interval_ms / 1000
+        self._job = self.root.after(self.interval_ms, self._heartbeat)
+
+    def _watch(self, stop):
+        """背景執行緒: 心跳逾期時擷取主執行緒目前的堆疊 (每次卡頓一次)"""
+        poll = max(self.stall_ms / 4000, 0.005)
+        sampled_due = None
+        while not stop.wait(poll):
+            due = self._due
+            if due == sampled_due or (time.perf_counter() - due) * 1000 < self.stall_ms:
+                continue
+            frame = sys._current_frames().get(self._main_ident)
+            if frame is None:
+                continue
+            sample = _stall_stack(frame, self.owner_class)
+            del frame
+            with self._sample_lock:
+                self._sample = sample
+            sampled_due = due
+
+    def _record_stall(self, late_ms, sample):
+        callback, stack = sample if sample else ('(未取樣)', [])
+        event = {
+            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'stall_ms': round(late_ms, 1),
+            'callback': callback,
+            'stack': stack,
+        }
+        self.stalls.insert(0, event)
+        del self.stalls[100:]
+        if self.log_path:
+            try:
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(event, ensure_ascii=False) + '\n')
+            except OSError as e:
+                print(f"寫入卡頓記錄失敗: {e}")
+
+    def summary(self):
+        """最近 window_s 秒的心跳間隔統計 (毫秒) 與卡頓數"""
+        frames = sorted(self.frames)
+        if not frames:
+            return {'frames': 0, 'p50_ms': None, 'p95_ms': None, 'max_ms': None,
+                    'stalls': len(self.stalls)}
+        return {'frames': len(frames), 'p50_ms': _percentile(frames, 0.5),
+                'p95_ms': _percentile(frames, 0.95), 'max_ms': frames[-1],
+                'stalls': len(self.stalls)}
+
+    def hud_text(self):
+        """覆蓋層文字: 心跳間隔與最慢的幾次卡頓"""
+        s = self.summary()
+        if not s['frames']:
+            return "⏱ 監測中..."
+        lines = [f"⏱ 幀 {s['p50_ms']:.0f} ms  p95 {s['p95_ms']:.0f}  最大 {s['max_ms']:.0f}",
+                 f"   目標 {self.interval_ms} ms  卡頓 {s['stalls']} 次"]
+        worst = sorted(self.stalls, key=lambda e: e['stall_ms'], reverse=True)[:self.WORST_COUNT]
+        for event in worst:
+            lines.append(f"   {event['stall_ms']:>6.0f} ms  {event['callback']}")
+        return '\n'.join(lines)
 
 
 class Snowflake:
@@ -747,43 +6008,105 @@ class ChristmasTheme:
 class LotteryGUI:
     """聖誕交換禮物抽籤系統 GUI 介面"""
 
-    def __init__(self, root):
+    # 歷史記錄頁面每次載入的筆數
+    HISTORY_PAGE_SIZE = 50
+    # 關鍵字管理頁面搜尋結果的最多筆數
+    PARTICIPANT_MATCH_LIMIT = 20
+    # 統計頁面列出的前幾名
+    STATS_TOP_COUNT = 20
+    # 分組結果每組最多顯示的人數
+    TEAM_DISPLAY_LIMIT = 50
+
+    ROSTER_POLL_MIN_MS = 500   # participants.json 外部修改的輪詢間隔 (剛有變更時)
+    ROSTER_POLL_MAX_MS = 8000  # 沒有變更時逐步加倍到此間隔
+
+    def __init__(self, root, lottery=None):
         self.root = root
         self.root.title("🎄 聖誕交換禮物抽籤系統 🎁")
         self.root.geometry("1000x750")
         self.root.configure(bg=ChristmasTheme.BG_COLOR)
 
         # 配置主題樣式
-        ChristmasTheme.configure_style()
+        with profile_phase('ChristmasTheme.configure_style'):
+            ChristmasTheme.configure_style()
 
         # 建立抽籤系統實例
-        self.lottery = LotterySystem()
+        self.lottery = lottery if lottery is not None else LotterySystem()
 
         # 雪花列表
         self.snowflakes = []
 
         # 創建雪花畫布背景(先創建畫布)
-        self.create_snow_canvas()
+        with profile_phase('create_snow_canvas'):
+            self.create_snow_canvas()
 
         # 創建頂部裝飾區域
-        self.create_header()
+        with profile_phase('create_header'):
+            self.create_header()
 
         # 建立標籤頁
         self.notebook = ttk.Notebook(root)
         self.notebook.pack(fill='both', expand=True, padx=15, pady=(0, 15))
 
+        # 延後到頁面第一次顯示時才載入的內容: {頁面路徑: 重新整理函式}
+        self._deferred_refresh = {}
+        self.notebook.bind('<<NotebookTabChanged>>', self.on_tab_changed)
+
         # 建立各個頁面
-        self.create_draw_page()
-        self.create_participant_page()
-        self.create_history_page()
-        self.create_keyword_draw_page()
-        self.create_keyword_manage_page()
-        self.create_keyword_history_page()
-        self.create_settings_page()
+        for create_page in (self.create_draw_page, self.create_participant_page,
+                            self.create_history_page, self.create_keyword_draw_page,
+                            self.create_keyword_manage_page, self.create_keyword_history_page,
+                            self.create_team_page, self.create_stats_page, self.create_settings_page,
+                            self.create_template_page):
+            with profile_phase(create_page.__name__):
+                create_page()
+
+        # 關閉視窗前寫入尚未儲存的變更
+        self.root.protocol('WM_DELETE_WINDOW', self.on_close)
+
+        # 監看 participants.json 的外部修改 (手動編輯或由腳本重新產生)
+        self.roster_poll_ms = self.ROSTER_POLL_MIN_MS
+        self.roster_watch_job = self.root.after(self.roster_poll_ms, self.watch_participants_file)
+
+        # 事件迴圈延遲監測 (F12 開關, 或以 --latency-monitor 啟動)
+        self.latency_monitor = EventLoopMonitor(self.root)
+        self.root.bind('<F12>', self.toggle_latency_monitor)
 
         # 啟動雪花動畫
         self.animate_snow()
 
+    def on_close(self):
+        """關閉視窗: 先寫入尚未儲存的變更再結束"""
+        self.cancel_reveal()
+        self.root.after_cancel(self.roster_watch_job)
+        self.latency_monitor.stop()
+        self.lottery.close()
+        self.root.destroy()
+
+    def toggle_latency_monitor(self, event=None):
+        """開關事件迴圈延遲監測與右上角的覆蓋層"""
+        if self.latency_monitor.running:
+            self.latency_monitor.stop()
+        else:
+            self.latency_monitor.start()
+
+    def defer_refresh(self, frame, refresh, once=True):
+        """頁面顯示時才執行 refresh (避免啟動時讀取歷史記錄)
+
+        Args:
+            once: True 只在第一次顯示時執行, False 每次切換到該頁面都執行
+        """
+        self._deferred_refresh[str(frame)] = (refresh, once)
+
+    def on_tab_changed(self, event=None):
+        """切換頁面時執行該頁面延後的載入"""
+        page = self.notebook.select()
+        refresh, once = self._deferred_refresh.get(page, (None, True))
+        if refresh:
+            if once:
+                del self._deferred_refresh[page]
+            refresh()
+
     def create_header(self):
         """創建頂部聖誕裝飾"""
         header = tk.Frame(self.root, bg=ChristmasTheme.BG_COLOR, height=80)
@@ -867,6 +6190,10 @@ class LotteryGUI:
         ttk.Checkbutton(settings_frame, text="🔒 避免重複抽取",
                        variable=self.avoid_repeat).pack(anchor='w', pady=3)
 
+        # 跨場次避免重複
+        self.draw_recent_window, self.draw_recent_penalize = self.create_recent_options(
+            settings_frame, "次抽籤的中獎者")
+
         # 狀態資訊
         status_frame = ttk.Frame(settings_frame)
         status_frame.pack(fill='x', pady=5)
@@ -882,6 +6209,47 @@ class LotteryGUI:
                   command=self.do_draw).pack(side='left', padx=5)
         ttk.Button(button_frame, text="🔄 重置已抽取清單", style='Green.TButton',
                   command=self.reset_drawn).pack(side='left', padx=5)
+        ttk.Button(button_frame, text="↩️ 復原上次抽籤", style='Gold.TButton',
+                  command=self.undo_last_draw).pack(side='left', padx=5)
+
+        # 排程揭曉: 事先抽籤並準備好郵件與連線, 倒數結束時一次寄出
+        reveal_frame = ttk.LabelFrame(frame, text="⏰ 排程揭曉 (郵件通知)", padding=10)
+        reveal_frame.pack(fill='x', padx=10, pady=(0, 10))
+        ttk.Label(reveal_frame, text="倒數秒數:").pack(side='left')
+        self.reveal_delay = tk.IntVar(value=60)
+        ttk.Spinbox(reveal_frame, from_=1, to=86400, textvariable=self.reveal_delay,
+                    width=8).pack(side='left', padx=5)
+        ttk.Button(reveal_frame, text="⏰ 準備並開始倒數", style='Red.TButton',
+                   command=self.schedule_reveal).pack(side='left', padx=5)
+        ttk.Button(reveal_frame, text="✖ 取消",
+                   command=self.cancel_reveal).pack(side='left', padx=5)
+        self.reveal_label = ttk.Label(reveal_frame, text="", font=('Arial', 10, 'bold'))
+        self.reveal_label.pack(side='left', padx=10)
+        self.scheduled_reveal = None
+
+        # 串流抽籤 (直接從大型名單檔案抽取, 不載入整份名單)
+        stream_frame = ttk.LabelFrame(frame, text="📂 從名單檔案串流抽籤 (CSV / JSONL)", padding=10)
+        stream_frame.pack(fill='x', padx=10, pady=(0, 10))
+
+        roster_frame = ttk.Frame(stream_frame)
+        roster_frame.pack(fill='x', pady=2)
+        ttk.Label(roster_frame, text="名單檔案:", width=12).pack(side='left')
+        self.stream_roster_path = tk.StringVar()
+        ttk.Entry(roster_frame, textvariable=self.stream_roster_path, width=50).pack(side='left', padx=5)
+        ttk.Button(roster_frame, text="瀏覽...",
+                  command=self.browse_stream_roster).pack(side='left')
+
+        exclude_frame = ttk.Frame(stream_frame)
+        exclude_frame.pack(fill='x', pady=2)
+        ttk.Label(exclude_frame, text="已抽取清單:", width=12).pack(side='left')
+        self.stream_exclude_path = tk.StringVar()
+        ttk.Entry(exclude_frame, textvariable=self.stream_exclude_path, width=50).pack(side='left', padx=5)
+        ttk.Button(exclude_frame, text="瀏覽...",
+                  command=self.browse_stream_exclude).pack(side='left')
+
+        ttk.Button(stream_frame, text="📂 串流抽籤", style='Gold.TButton',
+                  command=self.do_stream_draw).pack(anchor='w', pady=5)
+        self.stream_draw = None
 
         # 結果顯示區域
         result_frame = ttk.LabelFrame(frame, text="🎄 抽籤結果", padding=10)
@@ -898,11 +6266,10 @@ class LotteryGUI:
 
     def update_status(self):
         """更新狀態資訊"""
-        total = len(self.lottery.participants)
-        available = self.lottery.get_available_count()
-        drawn = len(self.lottery.drawn_items)
+        counts = self.lottery.get_draw_counts()
         self.status_label.config(
-            text=f"👥 總參與者: {total} | 🎯 可抽取: {available} | ✅ 已抽取: {drawn}",
+            text=f"👥 總參與者: {counts['participants']} | 🎯 可抽取: {counts['available']} | "
+                 f"✅ 已抽取: {counts['drawn']}",
             foreground=ChristmasTheme.ACCENT_GOLD
         )
 
@@ -913,12 +6280,44 @@ class LotteryGUI:
         mode = self.draw_mode.get()
 
         # 執行抽籤
-        success, selected, message = self.lottery.draw(count, avoid_repeat)
+        success, selected, message = self.lottery.draw(
+            count, avoid_repeat, **self.read_recent_options(self.draw_recent_window,
+                                                            self.draw_recent_penalize))
 
         if not success:
             messagebox.showerror("❌ 錯誤", message)
             return
 
+        self.present_draw_result(selected, count, mode)
+
+    def create_recent_options(self, parent, target_text):
+        """建立「避開最近 N 次」設定列
+
+        Returns:
+            (回看次數 IntVar, 降低機率 BooleanVar)
+        """
+        row = ttk.Frame(parent)
+        row.pack(fill='x', pady=3)
+        window = tk.IntVar(value=0)
+        penalize = tk.BooleanVar(value=False)
+        ttk.Label(row, text="🕘 避開最近").pack(side='left')
+        ttk.Spinbox(row, from_=0, to=100, textvariable=window, width=5).pack(side='left', padx=5)
+        ttk.Label(row, text=f"{target_text} (0 = 不限制)").pack(side='left')
+        ttk.Checkbutton(row, text="只降低機率, 不完全排除",
+                        variable=penalize).pack(side='left', padx=10)
+        return window, penalize
+
+    @staticmethod
+    def read_recent_options(window, penalize):
+        try:
+            recent_window = max(0, window.get())
+        except tk.TclError:
+            recent_window = 0
+        return {'recent_window': recent_window,
+                'recent_policy': 'penalize' if penalize.get() else 'exclude'}
+
+    def present_draw_result(self, selected, count, mode):
+        """顯示或寄送抽籤結果, 並儲存歷史記錄"""
         # 記錄時間
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
@@ -962,6 +6361,147 @@ class LotteryGUI:
         # 更新狀態
         self.update_status()
 
+    def schedule_reveal(self):
+        """排程揭曉: 先完成抽籤、郵件與連線, 倒數結束時寄出"""
+        if self.scheduled_reveal is not None:
+            messagebox.showwarning("⚠️ 警告", "已有排程中的揭曉")
+            return
+        try:
+            delay = self.reveal_delay.get()
+        except tk.TclError:
+            messagebox.showerror("❌ 錯誤", "請輸入倒數秒數")
+            return
+
+        reveal = ScheduledReveal(
+            self.lottery, self.draw_count.get(), self.avoid_repeat.get(),
+            **self.read_recent_options(self.draw_recent_window, self.draw_recent_penalize))
+        self.reveal_label.config(text="準備中...")
+        self.root.update_idletasks()
+        success, _, message = reveal.prepare()
+        if not success:
+            self.reveal_label.config(text="")
+            messagebox.showerror("❌ 錯誤", message)
+            return
+
+        self.scheduled_reveal = reveal
+        reveal.start(time.time() + delay)
+        self.update_status()
+        self.poll_reveal()
+
+    def poll_reveal(self):
+        """更新倒數, 揭曉完成後顯示延遲報告"""
+        reveal = self.scheduled_reveal
+        if reveal is None:
+            return
+        if not reveal.done.is_set():
+            remaining = max(0, reveal.reveal_at - time.time())
+            self.reveal_label.config(text=f"⏳ {remaining:.0f} 秒後揭曉 ({len(reveal.messages)} 封郵件已就緒)")
+            self.root.after(200, self.poll_reveal)
+            return
+
+        self.scheduled_reveal = None
+        report = reveal.report
+        self.reveal_label.config(text="")
+        self.update_status()
+        summary = f"揭曉完成\n✅ 成功: {report['sent']} | ❌ 失敗: {len(report['failed'])}"
+        if report['last_ms'] is not None:
+            summary += (f"\n⏱️ 揭曉到最後一封送達: {report['last_ms']:.0f} ms"
+                        f" (第一封 {report['first_ms']:.0f} ms, 中位數 {report['median_ms']:.0f} ms,"
+                        f" 計時誤差 {report['timer_lag_ms']:.0f} ms)")
+        self.result_text.insert('1.0', f"\n⏰ {reveal.timestamp}\n{summary}\n")
+        if report['failed']:
+            messagebox.showwarning("⚠️ 部分失敗", summary)
+        else:
+            messagebox.showinfo("✅ 成功", summary)
+
+    def cancel_reveal(self):
+        """取消排程揭曉並復原本次抽籤"""
+        if self.scheduled_reveal is None or self.scheduled_reveal.done.is_set():
+            return
+        self.scheduled_reveal.cancel()
+        self.scheduled_reveal = None
+        self.reveal_label.config(text="已取消")
+        self.update_status()
+
+    def browse_stream_roster(self):
+        """選擇串流抽籤的名單檔案"""
+        path = filedialog.askopenfilename(
+            title="選擇名單檔案",
+            filetypes=[("名單檔案", "*.csv *.jsonl *.ndjson"), ("所有檔案", "*.*")]
+        )
+        if path:
+            self.stream_roster_path.set(path)
+
+    def browse_stream_exclude(self):
+        """選擇串流抽籤的已抽取郵箱檔案"""
+        path = filedialog.asksaveasfilename(
+            title="選擇已抽取郵箱檔案",
+            filetypes=[("文字檔", "*.txt"), ("所有檔案", "*.*")],
+            confirmoverwrite=False
+        )
+        if path:
+            self.stream_exclude_path.set(path)
+
+    def do_stream_draw(self):
+        """直接從名單檔案串流抽籤"""
+        roster_path = self.stream_roster_path.get().strip()
+        if not roster_path:
+            messagebox.showwarning("⚠️ 警告", "請先選擇名單檔案")
+            return
+
+        if self.stream_draw is not None:
+            messagebox.showwarning("⚠️ 警告", "串流抽籤進行中")
+            return
+
+        count = self.draw_count.get()
+        mode = self.draw_mode.get()
+        exclude_path = self.stream_exclude_path.get().strip() or None
+        avoid_repeat = self.avoid_repeat.get()
+
+        # 掃描大型檔案可能很久, 在背景執行緒進行, 主執行緒輪詢結果
+        job = {'done': threading.Event(), 'result': None, 'count': count, 'mode': mode}
+
+        def scan():
+            try:
+                job['result'] = self.lottery.draw_from_file(roster_path, count, exclude_path, avoid_repeat)
+            except Exception as e:
+                job['result'] = (False, [], f"串流抽籤失敗: {e}")
+            job['done'].set()
+
+        self.stream_draw = job
+        self.root.config(cursor='watch')
+        threading.Thread(target=scan, daemon=True).start()
+        self.poll_stream_draw()
+
+    def poll_stream_draw(self):
+        """串流抽籤完成後顯示結果"""
+        job = self.stream_draw
+        if not job['done'].is_set():
+            self.root.after(100, self.poll_stream_draw)
+            return
+
+        self.stream_draw = None
+        self.root.config(cursor='')
+        success, selected, message = job['result']
+        if not success:
+            messagebox.showerror("❌ 錯誤", message)
+            return
+
+        self.present_draw_result(selected, job['count'], job['mode'])
+
+    def undo_last_draw(self):
+        """復原上次抽籤"""
+        success, restored, message = self.lottery.undo_last_draw()
+        if not success:
+            messagebox.showwarning("⚠️ 警告", message)
+            return
+
+        self.update_status()
+        names = "\n".join(f"  {p['name']} ({p['email']})" for p in restored[:20])
+        if len(restored) > 20:
+            names += f"\n  ... 共 {len(restored)} 人"
+        messagebox.showinfo("↩️ 已復原", f"{message}\n\n{names}")
+
     def reset_drawn(self):
         """重置已抽取清單"""
         if messagebox.askyesno("🔄 確認", "確定要重置已抽取清單嗎?"):
@@ -975,6 +6515,7 @@ class LotteryGUI:
         """建立參與者管理頁面"""
         frame = ttk.Frame(self.notebook)
         self.notebook.add(frame, text="👥 參與者管理")
+        self.participant_page = frame
 
         # 單個新增區域
         add_frame = ttk.LabelFrame(frame, text="➕ 新增參與者", padding=10)
@@ -1045,11 +6586,15 @@ class LotteryGUI:
 
         ttk.Button(button_frame, text="🗑️ 刪除選中", style='Red.TButton',
                   command=self.remove_participant).pack(side='left', padx=5)
+        ttk.Button(button_frame, text="📂 依郵箱清單刪除", style='Red.TButton',
+                  command=self.remove_participants_from_file).pack(side='left', padx=5)
         ttk.Button(button_frame, text="🔄 重新整理清單", style='Green.TButton',
                   command=self.refresh_participant_list).pack(side='left', padx=5)
+        ttk.Button(button_frame, text="💾 匯出名冊",
+                  command=self.export_participants).pack(side='left', padx=5)
 
-        # 初始載入清單
-        self.refresh_participant_list()
+        # 第一次顯示時才載入清單 (大量參與者時逐列插入 Treeview 很慢, 不在啟動時進行)
+        self.defer_refresh(frame, self.refresh_participant_list)
 
     def add_participant(self):
         """新增參與者"""
@@ -1064,7 +6609,7 @@ class LotteryGUI:
             self.refresh_participant_list()
             self.update_status()
             # 更新關鍵字管理頁面的下拉選單
-            self.refresh_participant_combobox()
+            self.refresh_participant_search()
             messagebox.showinfo("成功", message)
         else:
             messagebox.showerror("錯誤", message)
@@ -1083,7 +6628,7 @@ class LotteryGUI:
         self.refresh_participant_list()
         self.update_status()
         # 更新關鍵字管理頁面的下拉選單
-        self.refresh_participant_combobox()
+        self.refresh_participant_search()
 
         messagebox.showinfo("完成", f"匯入完成\n成功: {success_count} | 失敗: {fail_count}")
 
@@ -1097,27 +6642,91 @@ class LotteryGUI:
         if not messagebox.askyesno("確認", "確定要刪除選中的參與者嗎?"):
             return
 
-        for item in selected:
-            values = self.participant_tree.item(item)['values']
-            email = values[1]
-            self.lottery.remove_participant(email)
+        emails = {str(self.participant_tree.item(item)['values'][1]) for item in selected}
+        removed = self.lottery.remove_participants(emails)
 
-        self.refresh_participant_list()
+        # 只移除選中的列, 不重建整個清單
+        self.participant_tree.delete(*selected)
         self.update_status()
         # 更新關鍵字管理頁面的下拉選單
-        self.refresh_participant_combobox()
-        messagebox.showinfo("成功", "刪除成功")
+        self.refresh_participant_search()
+        messagebox.showinfo("成功", f"已刪除 {removed} 位參與者")
+
+    def remove_participants_from_file(self):
+        """依郵箱清單檔案刪除參與者"""
+        path = filedialog.askopenfilename(
+            title="選擇要刪除的郵箱清單 (每行一個)",
+            filetypes=[("文字檔", "*.txt"), ("所有檔案", "*.*")]
+        )
+        if not path:
+            return
+        emails = load_email_set(path)
+        if not messagebox.askyesno("確認", f"確定要刪除清單中的 {len(emails)} 個郵箱嗎?"):
+            return
+
+        success, _, message = self.lottery.remove_participants_from_file(path)
+        if not success:
+            messagebox.showerror("錯誤", message)
+            return
+        self.refresh_participant_list()
+        self.update_status()
+        self.refresh_participant_search()
+        messagebox.showinfo("成功", message)
 
     def refresh_participant_list(self):
         """重新整理參與者清單"""
+        # 已載入完整清單, 切換到頁面時不必再載入
+        self._deferred_refresh.pop(str(self.participant_page), None)
+
         # 清空現有清單
         for item in self.participant_tree.get_children():
             self.participant_tree.delete(item)
 
-        # 重新載入
-        for p in self.lottery.participants:
-            status = "已抽取" if self.lottery.is_drawn(p) else "未抽取"
-            self.participant_tree.insert('', 'end', values=(p['name'], p['email'], status))
+        # 重新載入 (以郵箱作為列 ID, 外部修改時只更新變更的列)
+        # 取得名冊副本後再逐列插入, 背景合併不會在迭代途中改變清單
+        drawn = self.lottery.get_drawn_emails()
+        for name, email in self.lottery.participant_rows():
+            status = "已抽取" if email in drawn else "未抽取"
+            self.participant_tree.insert('', 'end', iid=email, values=(name, email, status))
+
+    def watch_participants_file(self):
+        """輪詢 participants.json 的外部修改 (每次一個 stat, 沒有變更時間隔逐步加倍)"""
+        try:
+            self.lottery.sync_participants()
+            changed = self.lottery.take_roster_changes()
+            if changed:
+                self.apply_roster_changes(changed)
+                self.roster_poll_ms = self.ROSTER_POLL_MIN_MS
+            else:
+                self.roster_poll_ms = min(self.roster_poll_ms * 2, self.ROSTER_POLL_MAX_MS)
+        except Exception as e:
+            print(f"同步參與者失敗: {e}")
+        self.roster_watch_job = self.root.after(self.roster_poll_ms, self.watch_participants_file)
+
+    def apply_roster_changes(self, emails):
+        """只將變更的參與者套用到參與者清單、關鍵字管理的搜尋清單與狀態列"""
+        drawn = self.lottery.get_drawn_emails()
+        tree = self.participant_tree
+        # 清單尚未載入 (頁面還沒顯示過) 時不必更新, 第一次顯示時會載入完整清單
+        loaded = str(self.participant_page) not in self._deferred_refresh
+        for email in emails if loaded else ():
+            p = self.lottery.get_participant_by_email(email)
+            if p is None:
+                if tree.exists(email):
+                    tree.delete(email)
+                continue
+            values = (p['name'], email, "已抽取" if email in drawn else "未抽取")
+            if tree.exists(email):
+                tree.item(email, values=values)
+            else:
+                tree.insert('', 'end', iid=email, values=values)
+
+        self.update_status()
+        self.update_keyword_status()
+        self.refresh_participant_search()
+        current = self.selected_participant_email.get()
+        if current in emails and self.lottery.get_participant_by_email(current) is not None:
+            self.select_participant(current)
 
     # ========== 歷史記錄頁面 ==========
 
@@ -1134,6 +6743,14 @@ class LotteryGUI:
                   command=self.refresh_history).pack(side='left', padx=5)
         ttk.Button(button_frame, text="🗑️ 清空歷史", style='Red.TButton',
                   command=self.clear_history).pack(side='left', padx=5)
+        self.history_more_button = ttk.Button(button_frame, text="⬆️ 載入更早的記錄",
+                                              command=self.load_more_history)
+        self.history_more_button.pack(side='left', padx=5)
+
+        # 搜尋列
+        self.history_filter = self.create_history_filter_bar(
+            frame, ('', 'display', 'email'), self.search_history, self.reset_history_filter,
+            self.export_history)
 
         # 顯示區域
         display_frame = ttk.LabelFrame(frame, text="📜 歷史記錄", padding=10)
@@ -1148,30 +6765,131 @@ class LotteryGUI:
         )
         self.history_text.pack(fill='both', expand=True)
 
-        # 初始載入
+        # 初始載入 (延後到頁面第一次顯示)
+        self.defer_refresh(frame, self.refresh_history)
+
+    def create_history_filter_bar(self, parent, modes, on_search, on_reset, on_export):
+        """建立歷史記錄搜尋列 (郵箱、模式、時間區間) 與匯出按鈕
+
+        Returns:
+            dict: email / mode / since / until 的 StringVar
+        """
+        bar = ttk.Frame(parent)
+        bar.pack(fill='x', padx=10)
+
+        filters = {key: tk.StringVar() for key in ('email', 'mode', 'since', 'until')}
+        ttk.Label(bar, text="🔍 郵箱:").pack(side='left')
+        email_entry = ttk.Entry(bar, textvariable=filters['email'], width=22)
+        email_entry.pack(side='left', padx=(2, 8))
+        email_entry.bind('<Return>', lambda event: on_search())
+        ttk.Label(bar, text="模式:").pack(side='left')
+        ttk.Combobox(bar, textvariable=filters['mode'], values=modes,
+                     state='readonly', width=8).pack(side='left', padx=(2, 8))
+        ttk.Label(bar, text="從:").pack(side='left')
+        ttk.Entry(bar, textvariable=filters['since'], width=11).pack(side='left', padx=(2, 4))
+        ttk.Label(bar, text="到:").pack(side='left')
+        ttk.Entry(bar, textvariable=filters['until'], width=11).pack(side='left', padx=(2, 8))
+        ttk.Button(bar, text="搜尋", command=on_search).pack(side='left', padx=2)
+        ttk.Button(bar, text="清除", command=on_reset).pack(side='left', padx=2)
+        ttk.Button(bar, text="💾 匯出", command=on_export).pack(side='left', padx=2)
+        return filters
+
+    @staticmethod
+    def ask_export_path(title):
+        """選擇匯出檔案 (CSV / JSONL), 取消時回傳空字串"""
+        return filedialog.asksaveasfilename(
+            title=title, defaultextension='.csv',
+            filetypes=[("CSV 檔案", "*.csv"), ("JSON Lines", "*.jsonl"), ("所有檔案", "*.*")])
+
+    def show_export_result(self, result):
+        success, _, message = result
+        if success:
+            messagebox.showinfo("成功", message)
+        else:
+            messagebox.showerror("錯誤", message)
+
+    def export_history(self):
+        """依目前搜尋條件匯出禮物抽籤歷史記錄"""
+        path = self.ask_export_path("匯出抽籤記錄")
+        if path:
+            self.show_export_result(
+                self.lottery.export_history(path, **self.read_history_filter(self.history_filter)))
+
+    def export_keyword_history(self):
+        """依目前搜尋條件匯出關鍵字抽籤歷史記錄"""
+        path = self.ask_export_path("匯出關鍵字抽籤記錄")
+        if path:
+            self.show_export_result(self.lottery.export_keyword_history(
+                path, **self.read_history_filter(self.keyword_history_filter)))
+
+    def export_participants(self):
+        """匯出參與者名冊"""
+        path = self.ask_export_path("匯出參與者")
+        if path:
+            self.show_export_result(self.lottery.export_participants(path))
+
+    @staticmethod
+    def read_history_filter(filters):
+        """讀取搜尋列條件 (空白欄位為 None)"""
+        return {key: var.get().strip() or None for key, var in filters.items()}
+
+    def search_history(self):
+        """以索引搜尋禮物抽籤歷史記錄"""
+        start = time.perf_counter()
+        total, records = self.lottery.query_history(**self.read_history_filter(self.history_filter))
+        elapsed = (time.perf_counter() - start) * 1000
+
+        self.history_text.delete('1.0', 'end')
+        self.history_text.insert('end', f"找到 {total} 筆 (顯示最新 {len(records)} 筆, 耗時 {elapsed:.1f} ms)\n\n")
+        for record in records:
+            self.history_text.insert('end', self.format_history_record(record))
+        self.history_more_button.state(['disabled'])
+
+    def reset_history_filter(self):
+        """清除搜尋條件並回到一般瀏覽"""
+        for var in self.history_filter.values():
+            var.set('')
         self.refresh_history()
 
     def refresh_history(self):
-        """重新整理歷史記錄"""
+        """重新整理歷史記錄 (只顯示最近一頁, 較舊的按需載入)"""
         self.history_text.delete('1.0', 'end')
 
         history = self.lottery.get_history()
+        self._history_shown_from = len(history)
 
         if not history:
             self.history_text.insert('1.0', "暫無歷史記錄")
+            self.history_more_button.state(['disabled'])
             return
 
+        self.load_more_history()
+
+    def load_more_history(self):
+        """往前載入一頁較舊的歷史記錄"""
+        history = self.lottery.get_history()
+        stop = self._history_shown_from
+        start = max(0, stop - self.HISTORY_PAGE_SIZE)
+
         # 倒序顯示（最新的在前）
-        for record in reversed(history):
-            text = f"時間: {record['timestamp']}\n"
-            text += f"抽取數量: {record['count']}\n"
-            text += f"模式: {'顯示模式' if record['mode'] == 'display' else '郵件模式'}\n"
-            text += f"抽中名單:\n"
-            for i, p in enumerate(record['selected'], 1):
-                text += f"  {i}. {p['name']} ({p['email']})\n"
-            text += "-" * 60 + "\n\n"
+        for record in reversed(history.page(start, stop)):
+            self.history_text.insert('end', self.format_history_record(record))
+
+        self._history_shown_from = start
+        self.history_more_button.state(['disabled'] if start == 0 else ['!disabled'])
 
-            self.history_text.insert('end', text)
+    @staticmethod
+    def format_history_record(record):
+        """格式化單筆抽籤歷史記錄"""
+        text = f"時間: {record['timestamp']}\n"
+        text += f"抽取數量: {record['count']}\n"
+        text += f"模式: {'顯示模式' if record['mode'] == 'display' else '郵件模式'}\n"
+        text += format_rng_info(record.get('rng'))
+        text += f"抽中名單:\n"
+        for i, p in enumerate(record['selected'], 1):
+            text += f"  {i}. {p['name']} ({p['email']})\n"
+        text += "-" * 60 + "\n\n"
+        return text
 
     def clear_history(self):
         """清空歷史記錄"""
@@ -1182,6 +6900,179 @@ class LotteryGUI:
 
     # ========== 設定頁面 ==========
 
+    # ========== 分組頁面 ==========
+
+    def create_team_page(self):
+        """建立分組頁面 - 將所有參與者隨機分成 N 組"""
+        frame = ttk.Frame(self.notebook)
+        self.notebook.add(frame, text="🧩 分組")
+
+        settings_frame = ttk.LabelFrame(frame, text="⚙️ 分組設定", padding=10)
+        settings_frame.pack(fill='x', padx=10, pady=10)
+
+        count_frame = ttk.Frame(settings_frame)
+        count_frame.pack(fill='x', pady=2)
+        ttk.Label(count_frame, text="組數:", width=12).pack(side='left')
+        self.team_count = tk.IntVar(value=4)
+        ttk.Spinbox(count_frame, from_=2, to=1000, textvariable=self.team_count,
+                    width=10, font=('Arial', 10)).pack(side='left', padx=5)
+
+        self.team_balance_path = tk.StringVar()
+        self.team_separate_path = tk.StringVar()
+        for label, variable, title in (("平衡屬性:", self.team_balance_path, "選擇屬性檔案 (郵箱,屬性)"),
+                                       ("必須分開:", self.team_separate_path, "選擇必須分開的名單")):
+            row = ttk.Frame(settings_frame)
+            row.pack(fill='x', pady=2)
+            ttk.Label(row, text=label, width=12).pack(side='left')
+            ttk.Entry(row, textvariable=variable, width=50).pack(side='left', padx=5)
+            ttk.Button(row, text="瀏覽...",
+                       command=lambda v=variable, t=title: self.browse_text_file(v, t)).pack(side='left')
+        ttk.Label(settings_frame, text="💡 屬性檔案每行「郵箱,屬性」(例如部門); 必須分開的檔案每行以逗號分隔的郵箱",
+                  foreground=ChristmasTheme.ACCENT_GOLD).pack(anchor='w', pady=2)
+
+        mode_frame = ttk.Frame(settings_frame)
+        mode_frame.pack(fill='x', pady=2)
+        self.team_mode = tk.StringVar(value='display')
+        ttk.Radiobutton(mode_frame, text="📺 顯示在畫面上", variable=self.team_mode,
+                        value='display').pack(side='left', padx=5)
+        ttk.Radiobutton(mode_frame, text="📧 顯示並傳送郵件通知", variable=self.team_mode,
+                        value='email').pack(side='left', padx=5)
+
+        ttk.Button(frame, text="🧩 開始分組", style='Red.TButton',
+                   command=self.do_partition).pack(pady=5)
+
+        result_frame = ttk.LabelFrame(frame, text="🧩 分組結果", padding=10)
+        result_frame.pack(fill='both', expand=True, padx=10, pady=10)
+        self.team_result_text = scrolledtext.ScrolledText(
+            result_frame, height=15,
+            bg=ChristmasTheme.SNOW_BG,
+            fg=ChristmasTheme.TEXT_WHITE,
+            font=('Courier New', 11),
+            insertbackground=ChristmasTheme.TEXT_WHITE
+        )
+        self.team_result_text.pack(fill='both', expand=True)
+
+    def browse_text_file(self, variable, title):
+        path = filedialog.askopenfilename(
+            title=title, filetypes=[("文字檔案", "*.csv *.txt"), ("所有檔案", "*.*")])
+        if path:
+            variable.set(path)
+
+    def do_partition(self):
+        """執行分組, 保存歷史記錄並依模式傳送郵件"""
+        try:
+            team_count = self.team_count.get()
+            balance_path = self.team_balance_path.get().strip()
+            separate_path = self.team_separate_path.get().strip()
+            attributes = load_attribute_map(balance_path) if balance_path else None
+            separate = load_separate_groups(separate_path) if separate_path else None
+        except (tk.TclError, OSError) as e:
+            messagebox.showerror("❌ 錯誤", f"讀取分組設定失敗: {e}")
+            return
+
+        mode = self.team_mode.get()
+        if mode == 'email' and not self.lottery.validate_config():
+            messagebox.showerror("❌ 錯誤", "郵件設定不完整,請先在設定頁面設定 SMTP")
+            return
+
+        success, result, message = self.lottery.partition_teams(team_count, attributes, separate)
+        if not success:
+            messagebox.showerror("❌ 錯誤", message)
+            return
+        self.lottery.save_team_history(result, mode, os.path.basename(balance_path) if balance_path else None)
+
+        text = f"{message}\n{format_rng_info(result.rng)}\n"
+        for team in result:
+            members = team['members']
+            text += f"第 {team['team']} 組 ({len(members)} 人)\n"
+            for p in members[:self.TEAM_DISPLAY_LIMIT]:
+                text += f"  {p['name']} ({p['email']})\n"
+            if len(members) > self.TEAM_DISPLAY_LIMIT:
+                text += f"  ... 等 {len(members)} 人\n"
+            text += "\n"
+        self.team_result_text.delete('1.0', 'end')
+        self.team_result_text.insert('1.0', text)
+
+        if mode == 'email':
+            self.root.config(cursor='watch')
+            self.root.update_idletasks()
+            try:
+                success, failed, message = self.lottery.send_team_emails(
+                    result, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            finally:
+                self.root.config(cursor='')
+            if success:
+                messagebox.showinfo("✅ 完成", message)
+            else:
+                details = '\n'.join(f"{email}: {error}" for email, error in failed[:10])
+                messagebox.showwarning("⚠️ 部分失敗", f"{message}\n{details}")
+
+    # ========== 統計頁面 ==========
+
+    def create_stats_page(self):
+        """建立統計頁面 - 中獎次數、關鍵字頻率與均勻性檢定"""
+        frame = ttk.Frame(self.notebook)
+        self.notebook.add(frame, text="📊 統計")
+
+        button_frame = ttk.Frame(frame)
+        button_frame.pack(fill='x', padx=10, pady=10)
+        ttk.Button(button_frame, text="🔄 重新整理", style='Green.TButton',
+                  command=self.refresh_stats).pack(side='left', padx=5)
+
+        display_frame = ttk.LabelFrame(frame, text="📊 公平性統計", padding=10)
+        display_frame.pack(fill='both', expand=True, padx=10, pady=10)
+
+        self.stats_text = scrolledtext.ScrolledText(
+            display_frame, height=25,
+            bg=ChristmasTheme.SNOW_BG,
+            fg=ChristmasTheme.TEXT_WHITE,
+            font=('Courier New', 10),
+            insertbackground=ChristmasTheme.TEXT_WHITE
+        )
+        self.stats_text.pack(fill='both', expand=True)
+
+        # 每次切換到此頁面時更新 (統計為增量維護, 不需重新掃描歷史)
+        self.defer_refresh(frame, self.refresh_stats, once=False)
+
+    @staticmethod
+    def format_uniformity(test):
+        if test is None:
+            return "均勻性檢定: 資料不足\n"
+        verdict = "⚠️ 分布可能不均 (p < 0.05)" if test['p_value'] < 0.05 else "✅ 與均勻分布無顯著差異"
+        return (f"均勻性檢定: χ² = {test['chi2']:.2f}, 自由度 = {test['dof']}, "
+                f"p = {test['p_value']:.4f}  {verdict}\n")
+
+    def refresh_stats(self):
+        """重新整理統計頁面"""
+        limit = self.STATS_TOP_COUNT
+        win_rows, win_test = self.lottery.get_win_stats()
+        keyword_rows, keyword_test = self.lottery.get_keyword_stats()
+        stats = self.lottery.history_stats
+
+        self.stats_text.delete('1.0', 'end')
+        text = self.stats_text
+        text.insert('end', f"{'=' * 60}\n🎁 禮物抽籤中獎統計\n{'=' * 60}\n")
+        text.insert('end', f"抽籤次數: {stats.count} | 中獎名額: {stats.slots} | "
+                           f"目前參與者: {len(win_rows)} | "
+                           f"從未中獎: {sum(1 for row in win_rows if not row['wins'])}\n")
+        text.insert('end', self.format_uniformity(win_test))
+        text.insert('end', f"\n中獎次數最多的前 {limit} 位:\n")
+        for row in win_rows[:limit]:
+            since = f"{row['days_since']} 天前" if row['days_since'] is not None else "—"
+            text.insert('end', f"  {row['wins']:>4} 次  {row['name']} ({row['email']})  最近: {since}\n")
+
+        text.insert('end', f"\n{'=' * 60}\n🔤 關鍵字抽中頻率\n{'=' * 60}\n")
+        text.insert('end', f"關鍵字抽籤次數: {self.lottery.keyword_history_stats.count} | "
+                           f"關鍵字種類: {len(keyword_rows)}\n")
+        text.insert('end', self.format_uniformity(keyword_test))
+        text.insert('end', f"\n最常被抽中的前 {limit} 個:\n")
+        for keyword, count in keyword_rows[:limit]:
+            text.insert('end', f"  {count:>4} 次  {keyword}\n")
+        if len(keyword_rows) > limit:
+            text.insert('end', f"\n最少被抽中的 {limit} 個:\n")
+            for keyword, count in keyword_rows[-limit:][::-1]:
+                text.insert('end', f"  {count:>4} 次  {keyword}\n")
+
     def create_settings_page(self):
         """建立設定頁面"""
         frame = ttk.Frame(self.notebook)
@@ -1256,6 +7147,7 @@ class LotteryGUI:
     def save_config(self):
         """儲存設定"""
         config = {
+            **self.lottery.config,
             'smtp_server': self.smtp_server.get(),
             'smtp_port': self.smtp_port.get(),
             'smtp_user': self.smtp_user.get(),
@@ -1283,6 +7175,109 @@ class LotteryGUI:
         else:
             messagebox.showerror("錯誤", message)
 
+    # ========== 郵件範本頁面 ==========
+
+    def create_template_page(self):
+        """建立郵件範本頁面 - 編輯主旨、純文字與 HTML 範本"""
+        frame = ttk.Frame(self.notebook)
+        self.notebook.add(frame, text="✉️ 郵件範本")
+
+        top_frame = ttk.Frame(frame)
+        top_frame.pack(fill='x', padx=10, pady=10)
+        ttk.Label(top_frame, text="範本類別:").pack(side='left')
+        self.template_kind = tk.StringVar(value='draw')
+        for kind, label in (('draw', '🎁 禮物抽籤'), ('keyword', '🔤 關鍵字抽籤'), ('team', '🧩 分組'),
+                            ('test', '🧪 測試郵件')):
+            ttk.Radiobutton(top_frame, text=label, variable=self.template_kind, value=kind,
+                            command=self.load_template_editor).pack(side='left', padx=5)
+
+        self.template_fields_label = ttk.Label(frame, text="", foreground=ChristmasTheme.ACCENT_GOLD)
+        self.template_fields_label.pack(anchor='w', padx=10)
+
+        subject_frame = ttk.Frame(frame)
+        subject_frame.pack(fill='x', padx=10, pady=5)
+        ttk.Label(subject_frame, text="主旨:", width=10).pack(side='left')
+        self.template_subject = tk.StringVar()
+        ttk.Entry(subject_frame, textvariable=self.template_subject, width=60).pack(side='left', padx=5)
+
+        editors = {}
+        for key, title, height in (('text', "📝 純文字內容", 10), ('html', "🌐 HTML 內容 (可留空)", 6)):
+            editor_frame = ttk.LabelFrame(frame, text=title, padding=5)
+            editor_frame.pack(fill='both', expand=True, padx=10, pady=5)
+            editors[key] = scrolledtext.ScrolledText(
+                editor_frame, height=height,
+                bg=ChristmasTheme.SNOW_BG,
+                fg=ChristmasTheme.TEXT_WHITE,
+                font=('Courier New', 10),
+                insertbackground=ChristmasTheme.TEXT_WHITE
+            )
+            editors[key].pack(fill='both', expand=True)
+        self.template_text, self.template_html = editors['text'], editors['html']
+
+        button_frame = ttk.Frame(frame)
+        button_frame.pack(fill='x', padx=10, pady=10)
+        ttk.Button(button_frame, text="💾 儲存範本", style='Green.TButton',
+                   command=self.save_template).pack(side='left', padx=5)
+        ttk.Button(button_frame, text="👁️ 預覽", command=self.preview_template).pack(side='left', padx=5)
+        ttk.Button(button_frame, text="⏱️ 測試產生速度",
+                   command=self.benchmark_template).pack(side='left', padx=5)
+        ttk.Button(button_frame, text="↩️ 還原預設",
+                   command=self.reset_template).pack(side='left', padx=5)
+
+        self.load_template_editor()
+
+    def read_template_editor(self):
+        return {
+            'subject': self.template_subject.get(),
+            'text': self.template_text.get('1.0', 'end-1c'),
+            'html': self.template_html.get('1.0', 'end-1c'),
+        }
+
+    def fill_template_editor(self, template):
+        self.template_subject.set(template['subject'])
+        for editor, key in ((self.template_text, 'text'), (self.template_html, 'html')):
+            editor.delete('1.0', 'end')
+            editor.insert('1.0', template.get(key) or '')
+
+    def load_template_editor(self):
+        """載入目前類別的範本到編輯區"""
+        kind = self.template_kind.get()
+        fields = ' '.join(f"${name}" for name in MAIL_TEMPLATE_FIELDS[kind])
+        self.template_fields_label.config(text=f"💡 可用欄位: {fields}")
+        self.fill_template_editor(self.lottery.templates[kind])
+
+    def save_template(self):
+        success, message = self.lottery.save_templates(self.template_kind.get(), self.read_template_editor())
+        if success:
+            messagebox.showinfo("成功", message)
+        else:
+            messagebox.showerror("錯誤", message)
+
+    def reset_template(self):
+        self.fill_template_editor(DEFAULT_MAIL_TEMPLATES[self.template_kind.get()])
+
+    def preview_template(self):
+        """以範例資料預覽編輯中的範本"""
+        success, (subject, text, html_body), message = self.lottery.preview_template(
+            self.template_kind.get(), self.read_template_editor())
+        if not success:
+            messagebox.showerror("錯誤", message)
+            return
+        preview = f"主旨: {subject}\n\n{text}"
+        if html_body:
+            preview += f"\n--- HTML ---\n{html_body}"
+        messagebox.showinfo("👁️ 預覽", preview)
+
+    def benchmark_template(self):
+        """測量目前已儲存範本的批次產生速度"""
+        try:
+            per_second, elapsed = self.lottery.benchmark_templates(self.template_kind.get())
+        except ValueError as e:
+            messagebox.showerror("錯誤", f"範本有誤: {e}")
+            return
+        messagebox.showinfo("⏱️ 產生速度",
+                            f"產生 5000 封郵件耗時 {elapsed:.0f} ms\n約每秒 {per_second:,.0f} 封")
+
     # ========== 關鍵字抽籤頁面 ==========
 
     def create_keyword_draw_page(self):
@@ -1324,9 +7319,24 @@ class LotteryGUI:
         ttk.Spinbox(count_frame, from_=1, to=100, textvariable=self.keyword_participant_count,
                    width=10, font=('Arial', 10)).pack(side='left', padx=10)
 
+        # 跨場次避免重複分配相同關鍵字
+        self.keyword_recent_window, self.keyword_recent_penalize = self.create_recent_options(
+            settings_frame, "次抽籤中分配給同一人的關鍵字")
+
+        # 分群抽籤 (每個群組各自交換關鍵字, 群組內所有人參加)
+        group_frame = ttk.Frame(settings_frame)
+        group_frame.pack(fill='x', pady=5)
+        ttk.Label(group_frame, text="🏢 分群檔案:").pack(side='left')
+        self.keyword_group_path = tk.StringVar()
+        ttk.Entry(group_frame, textvariable=self.keyword_group_path, width=40).pack(side='left', padx=10)
+        ttk.Button(group_frame, text="瀏覽...",
+                   command=lambda: self.browse_text_file(self.keyword_group_path,
+                                                         "選擇分群檔案 (郵箱,群組)")).pack(side='left')
+
         # 說明標籤
         info_label = ttk.Label(settings_frame,
-                               text="💡 每位參與者會抽取2個來自其他參與者的關鍵字(不會抽到自己的關鍵字)",
+                               text="💡 每位參與者會抽取2個來自其他參與者的關鍵字(不會抽到自己的關鍵字)\n"
+                                    "💡 指定分群檔案(每行「郵箱,群組」)時, 各群組內所有人各自交換關鍵字, 忽略參與人數",
                                foreground=ChristmasTheme.ACCENT_GOLD,
                                wraplength=550)
         info_label.pack(anchor='w', pady=5)
@@ -1356,7 +7366,7 @@ class LotteryGUI:
         """更新關鍵字抽籤狀態資訊"""
         total_participants = len(self.lottery.participants)
         # 計算總關鍵字數
-        total_keywords = sum(len(p['keywords']) for p in self.lottery.participants)
+        total_keywords = self.lottery.get_keyword_count()
 
         self.keyword_status_label.config(
             text=f"👥 總參與者: {total_participants} | 🔤 總關鍵字數: {total_keywords}",
@@ -1368,9 +7378,20 @@ class LotteryGUI:
         participant_count = self.keyword_participant_count.get()
         mode = self.keyword_mode.get()
         display_mode = self.keyword_display_mode.get()
+        recent_options = self.read_recent_options(self.keyword_recent_window, self.keyword_recent_penalize)
+        group_path = self.keyword_group_path.get().strip()
 
         # 執行抽籤(新版本不需要 avoid_repeat 參數,總是避免重複和自己)
-        success, result_dict, message = self.lottery.draw_keywords(participant_count)
+        if group_path:
+            try:
+                groups = load_attribute_map(group_path)
+            except (OSError, UnicodeDecodeError) as e:
+                messagebox.showerror("❌ 錯誤", f"讀取分群檔案失敗: {e}")
+                return
+            success, result_dict, message = self.lottery.draw_keywords_sharded(groups, **recent_options)
+            participant_count = len(result_dict)
+        else:
+            success, result_dict, message = self.lottery.draw_keywords(participant_count, **recent_options)
 
         if not success:
             messagebox.showerror("❌ 錯誤", message)
@@ -1386,14 +7407,21 @@ class LotteryGUI:
             result += f"參與人數: {participant_count}\n"
             result += f"抽籤結果:\n"
 
-            if display_mode == "with_name":
-                # 顯示人名與關鍵字
-                for i, (email, data) in enumerate(result_dict.items(), 1):
+            # 分群抽籤的結果依群組排列, 在每個群組開始處加上標題
+            headers = {}
+            position = 0
+            for group, count in result_dict.groups or ():
+                headers[position] = f"  【{group}】{count} 人\n"
+                position += count
+
+            for i, (email, data) in enumerate(result_dict.items(), 1):
+                result += headers.get(i - 1, "")
+                if display_mode == "with_name":
+                    # 顯示人名與關鍵字
                     result += f"  {i}. {data['name']} ({data['email']})\n"
                     result += f"     關鍵字: {data['keywords'][0]}, {data['keywords'][1]}\n"
-            else:
-                # 僅顯示關鍵字組合(匿名)
-                for i, (email, data) in enumerate(result_dict.items(), 1):
+                else:
+                    # 僅顯示關鍵字組合(匿名)
                     result += f"  {i}. 關鍵字組合: {data['keywords'][0]}, {data['keywords'][1]}\n"
 
             result += f"{'='*50}\n"
@@ -1445,19 +7473,25 @@ class LotteryGUI:
         select_frame = ttk.LabelFrame(frame, text="👤 選擇參與者", padding=10)
         select_frame.pack(fill='x', padx=10, pady=10)
 
-        # 參與者下拉選單
+        # 參與者即時搜尋: 輸入姓名或郵箱, 清單顯示最符合的參與者
         participant_frame = ttk.Frame(select_frame)
         participant_frame.pack(fill='x', pady=5)
-        ttk.Label(participant_frame, text="參與者:", width=10).pack(side='left')
+        ttk.Label(participant_frame, text="🔍 搜尋:", width=10).pack(side='left')
 
         self.selected_participant_email = tk.StringVar()
-        self.participant_combobox = ttk.Combobox(participant_frame,
-                                                 textvariable=self.selected_participant_email,
-                                                 state='readonly',
-                                                 width=40,
-                                                 font=('Arial', 10))
-        self.participant_combobox.pack(side='left', padx=5)
-        self.participant_combobox.bind('<<ComboboxSelected>>', self.on_participant_selected)
+        self.participant_query = tk.StringVar()
+        self.participant_matches = []  # 清單中每一列對應的郵箱
+        query_entry = ttk.Entry(participant_frame, textvariable=self.participant_query,
+                                width=40, font=('Arial', 10))
+        query_entry.pack(side='left', padx=5)
+        query_entry.bind('<KeyRelease>', lambda event: self.refresh_participant_search())
+        self.selected_participant_label = ttk.Label(participant_frame, text="")
+        self.selected_participant_label.pack(side='left', padx=5)
+
+        self.participant_listbox = tk.Listbox(select_frame, height=6, exportselection=False,
+                                              font=('Arial', 10))
+        self.participant_listbox.pack(fill='x', pady=5)
+        self.participant_listbox.bind('<<ListboxSelect>>', self.on_participant_selected)
 
         # 新增關鍵字區域
         add_frame = ttk.LabelFrame(frame, text="➕ 為選中參與者新增關鍵字", padding=10)
@@ -1519,40 +7553,42 @@ class LotteryGUI:
                   command=self.refresh_keyword_list).pack(side='left', padx=5)
 
         # 初始載入
-        self.refresh_participant_combobox()
+        self.refresh_participant_search()
         self.refresh_keyword_list()
 
-    def refresh_participant_combobox(self):
-        """更新參與者下拉選單"""
-        participants = self.lottery.participants
-        if participants:
-            values = [f"{p['name']} ({p['email']})" for p in participants]
-            self.participant_combobox['values'] = values
-
-            # 檢查當前選中的參與者是否還存在
-            current_email = self.selected_participant_email.get()
-            participant_exists = any(p['email'] == current_email for p in participants)
-
-            if not current_email or not participant_exists:
-                # 如果沒有選中或選中的參與者已被刪除,選擇第一個
-                self.participant_combobox.current(0)
-                self.selected_participant_email.set(participants[0]['email'])
-                self.refresh_keyword_list()
+    def refresh_participant_search(self):
+        """依搜尋字串更新參與者搜尋結果清單"""
+        matches = self.lottery.search_participants(self.participant_query.get(),
+                                                   limit=self.PARTICIPANT_MATCH_LIMIT)
+        self.participant_matches = [email for email, _ in matches]
+        self.participant_listbox.delete(0, 'end')
+        for email, name in matches:
+            self.participant_listbox.insert('end', f"{name} ({email})")
+
+        current_email = self.selected_participant_email.get()
+        if current_email in self.participant_matches:
+            self.participant_listbox.selection_set(self.participant_matches.index(current_email))
+        elif not current_email or self.lottery.get_participant_by_email(current_email) is None:
+            # 如果沒有選中或選中的參與者已被刪除, 選擇第一個結果
+            self.select_participant(self.participant_matches[0] if matches else '')
+
+    def select_participant(self, email):
+        """設定關鍵字管理頁面目前的參與者"""
+        self.selected_participant_email.set(email)
+        if email in self.participant_matches:
+            row = self.participant_matches.index(email)
+            self.participant_listbox.selection_clear(0, 'end')
+            self.participant_listbox.selection_set(row)
+            self.selected_participant_label.config(text=f"目前: {self.participant_listbox.get(row)}")
         else:
-            self.participant_combobox['values'] = []
-            self.selected_participant_email.set('')
+            self.selected_participant_label.config(text="")
+        self.refresh_keyword_list()
 
     def on_participant_selected(self, event=None):
-        """當選擇參與者時觸發"""
-        selection = self.participant_combobox.get()
+        """當選擇參與者時觸發 (清單列直接對應郵箱)"""
+        selection = self.participant_listbox.curselection()
         if selection:
-            # 從 "姓名 (email)" 格式中提取 email
-            import re
-            match = re.search(r'\((.+?)\)', selection)
-            if match:
-                email = match.group(1)
-                self.selected_participant_email.set(email)
-                self.refresh_keyword_list()
+            self.select_participant(self.participant_matches[selection[0]])
 
     def add_keyword_to_participant(self):
         """為選中的參與者新增關鍵字"""
@@ -1646,6 +7682,14 @@ class LotteryGUI:
                   command=self.refresh_keyword_history).pack(side='left', padx=5)
         ttk.Button(button_frame, text="清空歷史",
                   command=self.clear_keyword_history).pack(side='left', padx=5)
+        self.keyword_history_more_button = ttk.Button(button_frame, text="⬆️ 載入更早的記錄",
+                                                      command=self.load_more_keyword_history)
+        self.keyword_history_more_button.pack(side='left', padx=5)
+
+        # 搜尋列
+        self.keyword_history_filter = self.create_history_filter_bar(
+            frame, ('', 'display', 'email', 'both'), self.search_keyword_history,
+            self.reset_keyword_history_filter, self.export_keyword_history)
 
         # 顯示區域
         display_frame = ttk.LabelFrame(frame, text="關鍵字抽籤歷史記錄", padding=10)
@@ -1654,48 +7698,88 @@ class LotteryGUI:
         self.keyword_history_text = scrolledtext.ScrolledText(display_frame, height=25)
         self.keyword_history_text.pack(fill='both', expand=True)
 
-        # 初始載入
+        # 初始載入 (延後到頁面第一次顯示)
+        self.defer_refresh(frame, self.refresh_keyword_history)
+
+    def search_keyword_history(self):
+        """以索引搜尋關鍵字抽籤歷史記錄"""
+        start = time.perf_counter()
+        total, records = self.lottery.query_keyword_history(
+            **self.read_history_filter(self.keyword_history_filter))
+        elapsed = (time.perf_counter() - start) * 1000
+
+        self.keyword_history_text.delete('1.0', 'end')
+        self.keyword_history_text.insert(
+            'end', f"找到 {total} 筆 (顯示最新 {len(records)} 筆, 耗時 {elapsed:.1f} ms)\n\n")
+        for record in records:
+            self.keyword_history_text.insert('end', self.format_keyword_history_record(record))
+        self.keyword_history_more_button.state(['disabled'])
+
+    def reset_keyword_history_filter(self):
+        """清除搜尋條件並回到一般瀏覽"""
+        for var in self.keyword_history_filter.values():
+            var.set('')
         self.refresh_keyword_history()
 
     def refresh_keyword_history(self):
-        """重新整理關鍵字抽籤歷史記錄"""
+        """重新整理關鍵字抽籤歷史記錄 (只顯示最近一頁, 較舊的按需載入)"""
         self.keyword_history_text.delete('1.0', 'end')
 
         history = self.lottery.get_keyword_history()
+        self._keyword_history_shown_from = len(history)
 
         if not history:
             self.keyword_history_text.insert('1.0', "暫無關鍵字抽籤歷史記錄")
+            self.keyword_history_more_button.state(['disabled'])
             return
 
+        self.load_more_keyword_history()
+
+    def load_more_keyword_history(self):
+        """往前載入一頁較舊的關鍵字抽籤歷史記錄"""
+        history = self.lottery.get_keyword_history()
+        stop = self._keyword_history_shown_from
+        start = max(0, stop - self.HISTORY_PAGE_SIZE)
+
         # 倒序顯示(最新的在前)
-        for record in reversed(history):
-            text = f"時間: {record['timestamp']}\n"
-            text += f"參與人數: {record['participant_count']}\n"
-
-            mode_text = {
-                'display': '顯示模式',
-                'email': '郵件模式',
-                'both': '顯示+郵件模式'
-            }.get(record['mode'], record['mode'])
-            text += f"通知模式: {mode_text}\n"
-
-            display_mode_text = {
-                'with_name': '顯示人名',
-                'anonymous': '匿名'
-            }.get(record['display_mode'], record['display_mode'])
-            text += f"顯示模式: {display_mode_text}\n"
-            text += f"抽籤結果:\n"
-
-            for i, (email, data) in enumerate(record['results'].items(), 1):
-                if record['display_mode'] == 'with_name':
-                    text += f"  {i}. {data['name']} ({data['email']})\n"
-                    text += f"     關鍵字: {data['keywords'][0]}, {data['keywords'][1]}\n"
-                else:
-                    text += f"  {i}. 關鍵字組合: {data['keywords'][0]}, {data['keywords'][1]}\n"
+        for record in reversed(history.page(start, stop)):
+            self.keyword_history_text.insert('end', self.format_keyword_history_record(record))
+
+        self._keyword_history_shown_from = start
+        self.keyword_history_more_button.state(['disabled'] if start == 0 else ['!disabled'])
 
-            text += "-" * 60 + "\n\n"
+    @staticmethod
+    def format_keyword_history_record(record):
+        """格式化單筆關鍵字抽籤歷史記錄"""
+        text = f"時間: {record['timestamp']}\n"
+        text += f"參與人數: {record['participant_count']}\n"
+        if record.get('groups'):
+            text += f"分群: {'、'.join(f'{group} ({count})' for group, count in record['groups'])}\n"
+        text += format_rng_info(record.get('rng'))
+
+        mode_text = {
+            'display': '顯示模式',
+            'email': '郵件模式',
+            'both': '顯示+郵件模式'
+        }.get(record['mode'], record['mode'])
+        text += f"通知模式: {mode_text}\n"
+
+        display_mode_text = {
+            'with_name': '顯示人名',
+            'anonymous': '匿名'
+        }.get(record['display_mode'], record['display_mode'])
+        text += f"顯示模式: {display_mode_text}\n"
+        text += f"抽籤結果:\n"
+
+        for i, (email, data) in enumerate(record['results'].items(), 1):
+            if record['display_mode'] == 'with_name':
+                text += f"  {i}. {data['name']} ({data['email']})\n"
+                text += f"     關鍵字: {data['keywords'][0]}, {data['keywords'][1]}\n"
+            else:
+                text += f"  {i}. 關鍵字組合: {data['keywords'][0]}, {data['keywords'][1]}\n"
 
-            self.keyword_history_text.insert('end', text)
+        text += "-" * 60 + "\n\n"
+        return text
 
     def clear_keyword_history(self):
         """清空關鍵字抽籤歷史記錄"""
@@ -1707,12 +7791,507 @@ class LotteryGUI:
     # ========== 設定頁面 ==========
 
 
+def run_stream_draw(args):
+    """命令列: 直接從名單檔案串流抽籤"""
+    exclude = load_email_set(args.exclude)
+    rng, info = args.random_source.generator()
+    success, selected, message = reservoir_draw_file(args.roster, args.count, exclude, rng)
+    if not success:
+        print(message, file=sys.stderr)
+        return 1
+
+    for p in selected:
+        print(f"{p['name']},{p['email']}")
+    print(message, file=sys.stderr)
+    print(format_rng_info(info), end='', file=sys.stderr)
+
+    if args.exclude and not args.no_record:
+        with open(args.exclude, 'a', encoding='utf-8') as f:
+            for p in selected:
+                f.write(p['email'] + '\n')
+    return 0
+
+
+def run_history_maintenance(args):
+    """命令列: 歷史記錄封存、整理與狀態"""
+    lottery = LotterySystem()
+    codec = None if args.codec == 'none' else args.codec
+    try:
+        if args.action == 'rotate':
+            success, _, message = lottery.rotate_history(args.period, codec)
+        elif args.action == 'compact':
+            success, _, message = lottery.compact_history_archive(codec)
+        else:
+            for title, store in (('抽籤記錄', lottery.history), ('關鍵字抽籤記錄', lottery.keyword_history)):
+                info = store.archive_info()
+                print(f"{title}: 封存 {info['archived']} 筆 / {len(info['segments'])} 個分段, "
+                      f"熱檔 {info['hot']} 筆 ({info['hot_size']} bytes)")
+                for seg in info['segments']:
+                    print(f"  {seg['period']}  #{seg['start']}+{seg['count']}  "
+                          f"{seg['codec'] or 'plain'}  {seg['size']} bytes  {seg['file']}")
+            success, message = True, None
+    finally:
+        lottery.close()
+    if message:
+        print(message, file=sys.stdout if success else sys.stderr)
+    return 0 if success else 1
+
+
+def run_api_server(args):
+    """命令列: 啟動 HTTP JSON API 服務"""
+    lottery = LotterySystem(compact=args.compact, rng=args.random_source, audit=args.audit)
+    server = LotteryAPIServer(lottery, args.host, args.port, token=args.token, verbose=args.verbose)
+    print(f"HTTP API 已啟動: {server.url}/api/status (Ctrl+C 結束)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        lottery.close()
+    return 0
+
+
+def run_replay(args):
+    """命令列: 以記錄的種子重播抽籤, 驗證歷史記錄"""
+    lottery = LotterySystem(compact=args.compact)
+    try:
+        candidates = None
+        if args.roster:
+            try:
+                candidates = [p['email'] for p in iter_roster_file(args.roster)]
+            except OSError as e:
+                print(f"讀取候選名單失敗: {e}", file=sys.stderr)
+                return 1
+        start = time.perf_counter()
+        match, record, message = lottery.replay_draw(args.number, 'keyword' if args.keyword else 'draw',
+                                                     candidates)
+        elapsed = (time.perf_counter() - start) * 1000
+    finally:
+        lottery.close()
+    print(message, file=sys.stdout if match else sys.stderr)
+    if record is not None:
+        print(f"記錄時間: {record['timestamp']}, 重播耗時 {elapsed:.1f} ms")
+    return 0 if match else 1
+
+
+def run_startup_profile(args, main_start):
+    """命令列: 分析啟動各階段耗時並寫入報表 (--profile-startup)
+
+    Returns:
+        0; 設定 --budget-ms 且啟動時間超過預算時回傳 1
+    """
+    global _startup_profiler
+    profiler = _startup_profiler = StartupProfiler()
+    profiler.add('imports', _MODULE_START, _IMPORTS_DONE)
+    profiler.add('module', _IMPORTS_DONE, main_start)
+    profiler.add('argparse', main_start, time.perf_counter())
+
+    root = app = None
+    if args.headless:
+        with profile_phase('LotterySystem.__init__'):
+            lottery = LotterySystem(compact=args.compact, rng=args.random_source, audit=args.audit)
+        with profile_phase('first_screen'):
+            lottery.get_summary()
+    else:
+        with profile_phase('tk.Tk'):
+            root = tk.Tk()
+        with profile_phase('LotterySystem.__init__'):
+            lottery = LotterySystem(compact=args.compact, rng=args.random_source, audit=args.audit)
+        with profile_phase('LotteryGUI.__init__'):
+            app = LotteryGUI(root, lottery)
+        with profile_phase('first_paint'):
+            root.update()
+
+    profiler.info.update({
+        'mode': 'headless' if args.headless else 'gui',
+        'compact': args.compact,
+        'participants': len(lottery.participants),
+        'history': len(lottery.history),
+        'keyword_history': len(lottery.keyword_history),
+    })
+    _startup_profiler = None
+    try:
+        profiler.write(args.profile_startup)
+    except OSError as e:
+        print(f"寫入啟動分析報表失敗: {e}", file=sys.stderr)
+    print(profiler.format(), file=sys.stderr)
+    print(f"啟動分析報表: {args.profile_startup}", file=sys.stderr)
+
+    over_budget = args.budget_ms is not None and profiler.total_ms() > args.budget_ms
+    if over_budget:
+        print(f"啟動時間 {profiler.total_ms():.1f} ms 超過預算 {args.budget_ms:.0f} ms", file=sys.stderr)
+
+    if app is None:
+        lottery.close()
+    elif args.exit_after_startup:
+        app.on_close()
+    else:
+        root.mainloop()
+    return 1 if over_budget else 0
+
+
+def build_startup_dataset(directory, participants, history, keywords=3, compact=False):
+    """在 directory 建立合成的名冊與歷史記錄 (啟動預算檢查用)"""
+    roster = synthetic_participants(participants, keywords)
+    atomic_write_text(os.path.join(directory, 'participants.json'),
+                      json.dumps(roster, ensure_ascii=False, indent=2))
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        lottery = LotterySystem(compact=compact)
+        rng = random.Random(0)
+        for _ in range(history):
+            lottery.save_history([roster[i] for i in rng.sample(range(participants), min(3, participants))],
+                                 3, 'display')
+        lottery.close()
+        atexit.unregister(lottery.close)
+    finally:
+        os.chdir(cwd)
+
+
+def run_startup_check(args):
+    """命令列: 以合成資料量測冷啟動 (每次一個新程序), 中位數超過預算時失敗"""
+    script = os.path.abspath(__file__)
+    reports = []
+    with tempfile.TemporaryDirectory() as workdir:
+        build_startup_dataset(workdir, args.participants, args.history, compact=args.compact)
+        for run in range(args.runs):
+            path = os.path.join(workdir, f'startup_profile_{run}.json')
+            command = [sys.executable, script, '--profile-startup', path, '--exit-after-startup']
+            if args.headless:
+                command.append('--headless')
+            if args.compact:
+                command.append('--compact')
+            result = subprocess.run(command, cwd=workdir, capture_output=True, text=True)
+            if result.returncode != 0 or not os.path.exists(path):
+                print(result.stderr, file=sys.stderr)
+                print("啟動失敗", file=sys.stderr)
+                return 1
+            with open(path, 'r', encoding='utf-8') as f:
+                reports.append(json.load(f))
+
+    totals = sorted(r['total_ms'] for r in reports)
+    median = totals[len(totals) // 2]
+    phase_ms = {}
+    for r in reports:
+        for p in r['phases']:
+            phase_ms.setdefault(('  ' * p['depth'] + p['name']), []).append(p['ms'])
+    print(f"名冊 {args.participants} 人, 歷史記錄 {args.history} 筆, "
+          f"{'無視窗' if args.headless else 'GUI'}, {args.runs} 次冷啟動")
+    for name, values in phase_ms.items():
+        values.sort()
+        print(f"  {name:<38}{values[len(values) // 2]:>10.1f} ms")
+    passed = median <= args.budget_ms
+    print(f"冷啟動中位數 {median:.1f} ms (最慢 {totals[-1]:.1f} ms), 預算 {args.budget_ms:.0f} ms: "
+          f"{'通過' if passed else '超出預算'}")
+
+    if args.report:
+        summary = {'participants': args.participants, 'history': args.history,
+                   'headless': args.headless, 'compact': args.compact,
+                   'budget_ms': args.budget_ms, 'median_ms': median, 'passed': passed,
+                   'runs': reports}
+        atomic_write_text(args.report, json.dumps(summary, ensure_ascii=False, indent=2))
+    return 0 if passed else 1
+
+
+def run_scenario(args):
+    """命令列: 以情境腳本進行無視窗的端對端演練與長時間測試"""
+    try:
+        script = load_scenario(args.script)
+    except (OSError, ValueError) as e:
+        print(f"讀取情境腳本失敗: {e}", file=sys.stderr)
+        return 1
+    if args.report_every is not None:
+        script['report_every'] = args.report_every
+
+    cwd = os.getcwd()
+    with contextlib.ExitStack() as stack:
+        workdir = args.workdir or stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(workdir, exist_ok=True)
+        roster = script.get('roster')
+        if roster and not os.path.exists(os.path.join(workdir, 'participants.json')):
+            atomic_write_text(os.path.join(workdir, 'participants.json'), json.dumps(
+                synthetic_participants(roster.get('participants', 100), roster.get('keywords', 3)),
+                ensure_ascii=False, indent=2))
+
+        smtp = LocalSMTPServer(delay=script.get('smtp', {}).get('delay_ms', 0) / 1000)
+        smtp.start()
+        os.chdir(workdir)
+        try:
+            lottery = LotterySystem(compact=args.compact, rng=args.random_source, audit=args.audit)
+            lottery.config = smtp.lottery_config()
+            print(f"情境: {args.script}, 工作目錄: {workdir}, SMTP 替身: {smtp.server_address[1]}")
+            runner = ScenarioRunner(lottery, script, smtp,
+                                    log=lambda line: print(line, flush=True))
+            try:
+                report = runner.run(args.duration)
+            except KeyboardInterrupt:
+                print("已中斷, 產生目前的報表", file=sys.stderr)
+                report = runner.report(runner.series[-1]['elapsed_s'] if runner.series else 0.0)
+            finally:
+                lottery.close()
+                atexit.unregister(lottery.close)
+        finally:
+            os.chdir(cwd)
+            smtp.shutdown()
+            smtp.server_close()
+
+    print(f"共 {report['ops']} 個操作, {report['elapsed_s']:.1f} 秒, {report['ops_per_s']:.1f} ops/s, "
+          f"失敗 {report['failures']}, 錯誤 {report['error_count']}, "
+          f"郵件 {report['smtp']['messages']} 封")
+    print(f"{'操作':<22}{'次數':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'最大 ms':>10}"
+          f"{'增長比':>8}{'指數':>8}")
+    for op, stats in report['latency'].items():
+        ratio, exponent = report['slowdown'].get(op), report['exponent'].get(op)
+        print(f"{op:<22}{stats['count']:>8}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}"
+              f"{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}"
+              f"{(f'{ratio:.2f}' if ratio is not None else '-'):>8}"
+              f"{(f'{exponent:.2f}' if exponent is not None else '-'):>8}")
+    if report['rss_growth_mb'] is not None:
+        rate = report['rss_growth_mb_per_hour']
+        print(f"記憶體成長 {report['rss_growth_mb']:.1f} MB" + (f" ({rate:.1f} MB/小時)" if rate is not None else ""))
+    for error in report['errors']:
+        print(f"  錯誤: {error}", file=sys.stderr)
+    if args.report:
+        atomic_write_text(args.report, json.dumps(report, ensure_ascii=False, indent=2))
+    if report['problems']:
+        print("未通過: " + ", ".join(report['problems']), file=sys.stderr)
+        return 1
+    print("通過")
+    return 0
+
+
+def run_teams(args):
+    """命令列: 將所有參與者隨機分組, 輸出 CSV (組別,姓名,郵箱)"""
+    try:
+        attributes = load_attribute_map(args.balance) if args.balance else None
+        separate = load_separate_groups(args.separate) if args.separate else None
+    except OSError as e:
+        print(f"讀取分組設定失敗: {e}", file=sys.stderr)
+        return 1
+
+    lottery = LotterySystem(compact=args.compact, rng=args.random_source, audit=args.audit)
+    try:
+        success, result, message = lottery.partition_teams(args.teams, attributes, separate)
+        if not success:
+            print(message, file=sys.stderr)
+            return 1
+        if not args.no_record:
+            lottery.save_team_history(result, 'email' if args.email else 'display',
+                                      os.path.basename(args.balance) if args.balance else None)
+        with open(args.output, 'w', encoding='utf-8-sig', newline='') if args.output \
+                else contextlib.nullcontext(sys.stdout) as f:
+            writer = csv.writer(f)
+            writer.writerow(['team', 'name', 'email'])
+            for team in result:
+                writer.writerows([team['team'], p['name'], p['email']] for p in team['members'])
+        print(message, file=sys.stderr)
+        print(format_rng_info(result.rng), end='', file=sys.stderr)
+        if args.email:
+            success, failed, message = lottery.send_team_emails(
+                result, datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+            print(message, file=sys.stderr)
+            for email, error in failed:
+                print(f"  {email}: {error}", file=sys.stderr)
+        return 0 if success else 1
+    finally:
+        lottery.close()
+
+
+def run_group_keyword_draw(args):
+    """命令列: 分群關鍵字抽籤, 輸出 CSV (群組,姓名,郵箱,關鍵字1,關鍵字2)"""
+    try:
+        groups = load_attribute_map(args.groups)
+    except OSError as e:
+        print(f"讀取分群檔案失敗: {e}", file=sys.stderr)
+        return 1
+
+    lottery = LotterySystem(compact=args.compact, rng=args.random_source, audit=args.audit)
+    try:
+        success, result, message = lottery.draw_keywords_sharded(
+            groups, recent_window=args.recent_window, workers=args.workers)
+        if not success:
+            print(message, file=sys.stderr)
+            return 1
+        if not args.no_record:
+            lottery.save_keyword_history(result, len(result), 'email' if args.email else 'display', 'with_name')
+        with open(args.output, 'w', encoding='utf-8-sig', newline='') if args.output \
+                else contextlib.nullcontext(sys.stdout) as f:
+            writer = csv.writer(f)
+            writer.writerow(['group', 'name', 'email', 'keyword1', 'keyword2'])
+            for data in result.values():
+                writer.writerow([groups[data['email']], data['name'], data['email'], *data['keywords']])
+        print(message, file=sys.stderr)
+        print(format_rng_info(result.rng), end='', file=sys.stderr)
+        if args.email:
+            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            failed = 0
+            for data in result.values():
+                ok, msg = lottery.send_keyword_email(data['email'], data['name'], data['keywords'], timestamp)
+                if not ok:
+                    failed += 1
+                    print(f"  {data['email']}: {msg}", file=sys.stderr)
+            print(f"郵件傳送完成: 成功 {len(result) - failed} | 失敗 {failed}", file=sys.stderr)
+            return 1 if failed else 0
+        return 0
+    finally:
+        lottery.close()
+
+
+def run_api_benchmark(args):
+    """命令列: HTTP API 並行壓力測試 (未指定 --url 時在暫存目錄啟動內部服務)"""
+    if args.url:
+        report = run_api_load_test(args.url, args.threads, args.requests, args.token)
+    else:
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as workdir:
+            os.chdir(workdir)
+            lottery = LotterySystem(compact=args.compact)
+            server = LotteryAPIServer(lottery, port=0)
+            server.start()
+            try:
+                report = run_api_load_test(server.url, args.threads, args.requests)
+            finally:
+                server.shutdown()
+                server.server_close()
+                lottery.close()
+                atexit.unregister(lottery.close)
+                os.chdir(cwd)
+
+    print(f"請求: {report['requests']} ({report['threads']} 執行緒), {report['seconds']:.2f} 秒, "
+          f"{report['rps']:.0f} req/s")
+    print(f"延遲: p50 {report['p50_ms']:.2f} ms, p95 {report['p95_ms']:.2f} ms, "
+          f"p99 {report['p99_ms']:.2f} ms, 錯誤 {report['errors']}")
+    delta = report['delta']
+    print(f"成功新增 {report['added']} 位、抽籤 {report['drawn']} 次 -> 參與者 +{delta['participants']}, "
+          f"已抽取 +{delta['drawn']}, 歷史記錄 +{delta['history']}")
+    if report['lost_updates']:
+        print("發現遺失的更新!", file=sys.stderr)
+        return 1
+    print("沒有遺失的更新")
+    return 0 if not report['errors'] else 1
+
+
 def main():
     """主函数"""
+    main_start = time.perf_counter()
+    parser = argparse.ArgumentParser(description='聖誕交換禮物抽籤系統')
+    parser.add_argument('--compact', action='store_true',
+                        help='使用緊湊名冊模型 (適合大量參與者)')
+    parser.add_argument('--rng', choices=RandomSource.BACKENDS, default='seeded',
+                        help='抽籤亂數來源: seeded (可重播, 預設) / system (作業系統亂數) / numpy')
+    parser.add_argument('--seed', help='固定種子 (每次抽籤依序使用 <seed>-1, <seed>-2...)')
+    parser.add_argument('--audit', action='store_true',
+                        help='保存每次抽籤的輸入到 draw_audit/ 供 replay 重播驗證 (大量參與者時較慢)')
+    parser.add_argument('--profile-startup', nargs='?', const='startup_profile.json', metavar='PATH',
+                        help='分析啟動各階段耗時並寫入報表 (預設 startup_profile.json)')
+    parser.add_argument('--exit-after-startup', action='store_true',
+                        help='啟動分析完成 (第一次畫面繪製) 後直接結束')
+    parser.add_argument('--headless', action='store_true',
+                        help='啟動分析時不建立視窗, 只量測資料載入')
+    parser.add_argument('--budget-ms', type=float, help='啟動時間預算, 超過時結束代碼為 1')
+    parser.add_argument('--latency-monitor', action='store_true',
+                        help='啟動時開啟事件迴圈延遲監測 (卡頓記錄寫入 ui_stalls.jsonl, F12 開關)')
+    subparsers = parser.add_subparsers(dest='command')
+
+    stream_parser = subparsers.add_parser('stream-draw', help='直接從名單檔案串流抽籤 (不啟動 GUI)')
+    stream_parser.add_argument('roster', help='名單檔案 (CSV / JSONL)')
+    stream_parser.add_argument('-n', '--count', type=int, default=1, help='抽取數量')
+    stream_parser.add_argument('--exclude', help='已抽取郵箱檔案 (每行一個), 中獎者會附加到此檔案')
+    stream_parser.add_argument('--no-record', action='store_true', help='不將中獎者附加到排除檔案')
+
+    history_parser = subparsers.add_parser('history', help='歷史記錄封存與整理')
+    history_parser.add_argument('action', choices=['rotate', 'compact', 'info'],
+                                help='rotate: 封存目前期間之前的記錄; compact: 合併並重新壓縮分段; info: 顯示狀態')
+    history_parser.add_argument('--period', choices=['month', 'year'], default='month', help='分段期間')
+    history_parser.add_argument('--codec', choices=['gzip', 'lzma', 'none'], default='gzip', help='壓縮方式')
+
+    serve_parser = subparsers.add_parser('serve', help='啟動 HTTP JSON API 服務 (不啟動 GUI)')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='監聽位址 (預設只接受本機連線)')
+    serve_parser.add_argument('--port', type=int, default=8765, help='監聽埠')
+    serve_parser.add_argument('--token', help='要求 Authorization: Bearer <token>')
+    serve_parser.add_argument('-v', '--verbose', action='store_true', help='輸出每個請求的記錄')
+
+    replay_parser = subparsers.add_parser('replay', help='以記錄的種子重播抽籤並比對結果')
+    replay_parser.add_argument('number', type=int, nargs='?', default=-1,
+                               help='記錄編號 (預設為最新一筆, 負數由最新往回數)')
+    replay_parser.add_argument('--keyword', action='store_true', help='重播關鍵字抽籤記錄')
+    replay_parser.add_argument('--roster', help='禮物抽籤當時的候選名單 (CSV / JSONL, 未以 --audit 抽籤時使用)')
+
+    startup_parser = subparsers.add_parser('startup-check', help='以合成資料量測冷啟動並與預算比較')
+    startup_parser.add_argument('-p', '--participants', type=int, default=2000, help='合成名冊人數')
+    startup_parser.add_argument('-H', '--history', type=int, default=5000, help='合成歷史記錄筆數')
+    startup_parser.add_argument('--budget-ms', type=float, default=1500.0, help='冷啟動中位數預算 (毫秒)')
+    startup_parser.add_argument('--runs', type=int, default=5, help='冷啟動次數')
+    startup_parser.add_argument('--headless', action='store_true', help='不建立視窗 (沒有顯示器時)')
+    startup_parser.add_argument('--report', help='寫入所有次數的完整報表 (JSON)')
+
+    teams_parser = subparsers.add_parser('teams', help='將所有參與者隨機分組 (不啟動 GUI)')
+    teams_parser.add_argument('-n', '--teams', type=int, required=True, help='組數')
+    teams_parser.add_argument('--balance', help='平衡屬性的 CSV (郵箱,屬性), 例如部門')
+    teams_parser.add_argument('--separate', help='必須分開的名單 (每行以逗號分隔的郵箱)')
+    teams_parser.add_argument('-o', '--output', help='輸出 CSV 檔案 (預設輸出到標準輸出)')
+    teams_parser.add_argument('--email', action='store_true', help='以郵件通知每位參與者的組別')
+    teams_parser.add_argument('--no-record', action='store_true', help='不寫入分組歷史記錄')
+
+    group_draw_parser = subparsers.add_parser('group-keyword-draw',
+                                              help='分群關鍵字抽籤: 各群組並行各自交換關鍵字 (不啟動 GUI)')
+    group_draw_parser.add_argument('groups', help='分群 CSV (郵箱,群組), 例如樓層或部門; 未列出的人不參加')
+    group_draw_parser.add_argument('--workers', type=int, help='工作行程數 (預設為 CPU 數, 1 表示不使用行程池)')
+    group_draw_parser.add_argument('--recent-window', type=int, default=0,
+                                   help='排除最近幾次抽籤中分配給同一人的關鍵字 (預設 0: 不限制)')
+    group_draw_parser.add_argument('-o', '--output', help='輸出 CSV 檔案 (預設輸出到標準輸出)')
+    group_draw_parser.add_argument('--email', action='store_true', help='以郵件通知每位參與者的關鍵字')
+    group_draw_parser.add_argument('--no-record', action='store_true', help='不寫入關鍵字抽籤歷史記錄')
+
+    scenario_parser = subparsers.add_parser('scenario', help='依情境腳本進行無視窗的端對端演練 (本機 SMTP 替身)')
+    scenario_parser.add_argument('script', help='情境腳本 (JSON 或 YAML)')
+    scenario_parser.add_argument('--workdir', help='資料目錄 (預設為暫存目錄, 結束後刪除)')
+    scenario_parser.add_argument('--duration', type=float, help='執行秒數 (覆蓋腳本的 duration)')
+    scenario_parser.add_argument('--report-every', type=float, help='快照間隔秒數 (覆蓋腳本的 report_every)')
+    scenario_parser.add_argument('--report', help='寫入完整報表與時間序列 (JSON)')
+
+    load_parser = subparsers.add_parser('api-loadtest', help='HTTP API 並行壓力測試')
+    load_parser.add_argument('--url', help='測試既有的服務 (預設在暫存目錄啟動內部服務)')
+    load_parser.add_argument('--token', help='既有服務的 token')
+    load_parser.add_argument('-t', '--threads', type=int, default=8, help='並行執行緒數')
+    load_parser.add_argument('-n', '--requests', type=int, default=250, help='每個執行緒的請求數')
+
+    args = parser.parse_args()
+    try:
+        args.random_source = RandomSource(args.rng, args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.command == 'stream-draw':
+        sys.exit(run_stream_draw(args))
+    if args.command == 'history':
+        sys.exit(run_history_maintenance(args))
+    if args.command == 'serve':
+        sys.exit(run_api_server(args))
+    if args.command == 'replay':
+        sys.exit(run_replay(args))
+    if args.command == 'startup-check':
+        sys.exit(run_startup_check(args))
+    if args.command == 'scenario':
+        sys.exit(run_scenario(args))
+    if args.command == 'teams':
+        sys.exit(run_teams(args))
+    if args.command == 'group-keyword-draw':
+        sys.exit(run_group_keyword_draw(args))
+    if args.command == 'api-loadtest':
+        sys.exit(run_api_benchmark(args))
+
+    if args.profile_startup:
+        sys.exit(run_startup_profile(args, main_start))
+
     root = tk.Tk()
-    app = LotteryGUI(root)
+    app = LotteryGUI(root, LotterySystem(compact=args.compact, rng=args.random_source, audit=args.audit))
+    if args.latency_monitor:
+        app.toggle_latency_monitor()
     root.mainloop()
 
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # 打包後的執行檔啟動行程池的工作行程時需要
     main()